@@ -0,0 +1,306 @@
+import asyncio
+import json
+import queue
+import re
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from fastapi.concurrency import run_in_threadpool
+from metrics import SMTP_SEND_SECONDS
+
+
+class SMTPPool:
+    """
+        Small pool of authenticated SMTP connections (STARTTLS + login done once per connection).
+        Idle connections are checked with NOOP before reuse and replaced when stale or broken.
+    """
+
+    def __init__(self, host, port, user=None, password=None, size=2, timeout=10, max_idle=60):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.timeout = timeout
+        self.max_idle = max_idle
+
+        self._idle = queue.LifoQueue()  # (server, last_used)
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls()
+            if self.user:
+                server.login(self.user, self.password)
+        except Exception:
+            self._discard(server)
+            raise
+        return server
+
+    @staticmethod
+    def _discard(server):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    @staticmethod
+    def _alive(server):
+        try:
+            return server.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except OSError:
+            return False
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    server, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - last_used < self.max_idle and self._alive(server):
+                    return server
+                self._discard(server)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, server, broken=False):
+        if broken:
+            self._discard(server)
+        else:
+            self._idle.put((server, time.monotonic()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        server = self.acquire()
+        try:
+            yield server
+        except Exception:
+            self.release(server, broken=True)
+            raise
+        else:
+            self.release(server)
+
+    def close(self):
+        while True:
+            try:
+                server, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(server)
+
+
+class AlertDispatcher:
+    """
+        Sends alert emails from background tasks so the ingest request never waits on SMTP.
+        Each alert is one message to all its recipients, retried with exponential backoff.
+    """
+
+    def __init__(self, pool, sender, max_queue=1000, workers=2, max_retries=3, backoff=1.0):
+        self.pool = pool
+        self.sender = sender
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._tasks = []
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._tasks:
+            return
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker(), name=f'alert-dispatcher-{i}') for i in range(self.workers)]
+
+    def submit(self, subject, recipients, content):
+        """
+                Queues an alert without blocking. Returns False if there is nothing to send or the queue is full.
+        """
+        if not recipients:
+            return False
+        try:
+            self._queue.put_nowait((subject, list(recipients), content))
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print(f"Cola de alertas llena, alerta descartada: {subject}")
+            return False
+
+    def build_message(self, subject, recipients, content):
+        msg = MIMEMultipart()
+        msg['From'] = self.sender
+        msg['To'] = ', '.join(recipients)
+        msg['Subject'] = subject
+        msg.attach(MIMEText(json.dumps(content, indent=2, default=str), 'plain'))
+        return msg
+
+    def send(self, subject, recipients, content):
+        msg = self.build_message(subject, recipients, content)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            with self.pool.connection() as server:
+                server.sendmail(self.sender, recipients, msg.as_string())
+            outcome = 'ok'
+        finally:
+            SMTP_SEND_SECONDS.observe(time.perf_counter() - started, outcome)
+
+    async def _deliver(self, subject, recipients, content):
+        for attempt in range(self.max_retries + 1):
+            try:
+                await run_in_threadpool(self.send, subject, recipients, content)
+                self.sent += 1
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self.failed += 1
+                    print(f"No se pudo enviar la alerta a {recipients}: {e}")
+                    return
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    async def _worker(self):
+        while True:
+            alert = await self._queue.get()
+            try:
+                await self._deliver(*alert)
+            finally:
+                self._queue.task_done()
+
+    async def stop(self, timeout=10):
+        """
+                Waits (up to timeout seconds) for queued alerts, then stops the workers and closes the pool.
+        """
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+        await run_in_threadpool(self.pool.close)
+
+    def stats(self):
+        return {'queue_depth': self._queue.qsize(),
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped}
+
+
+# Variable parts of a message, replaced to obtain its template
+TEMPLATE_PATTERNS = [
+    (re.compile(r'\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b'), '<uuid>'),
+    (re.compile(r'\b\d{1,3}(?:\.\d{1,3}){3}\b'), '<ip>'),
+    (re.compile(r'\b0x[0-9a-fA-F]+\b'), '<hex>'),
+    (re.compile(r'"[^"]*"|\'[^\']*\''), '<str>'),
+    (re.compile(r'\d+'), '<n>'),
+]
+
+
+def message_template(message):
+    for pattern, placeholder in TEMPLATE_PATTERNS:
+        message = pattern.sub(placeholder, message)
+    return message
+
+
+def alert_fingerprint(log_data):
+    """ (service, host, event.action, message template) of a log."""
+    event = log_data.get('event') or {}
+    return (log_data.get('service'),
+            log_data.get('host'),
+            event.get('action'),
+            message_template(log_data.get('message') or ''))
+
+
+class AlertCoalescer:
+    """
+        Coalesces alert storms per company. Within a window, the first immediate_limit logs with the
+        same fingerprint are sent right away; the rest are counted and sent as one digest when the
+        window closes. Companies can override window_seconds and immediate_limit in 'alert_policy'.
+    """
+
+    def __init__(self, dispatcher, window=300, immediate_limit=1, max_windows=10000):
+        self.dispatcher = dispatcher
+        self.window = window
+        self.immediate_limit = immediate_limit
+        self.max_windows = max_windows
+
+        self._windows = {}  # (company_name, fingerprint) -> open window state
+
+    def policy(self, company):
+        policy = company.get('alert_policy') or {}
+        return (policy.get('window_seconds', self.window),
+                policy.get('immediate_limit', self.immediate_limit))
+
+    def alert(self, company, subject, log_data):
+        """
+                Sends or coalesces the alert for a log. Returns 'sent' or 'coalesced'.
+        """
+        recipients = company.get('alert_emails', [])
+        window, immediate_limit = self.policy(company)
+        key = (company.get('company_name'), alert_fingerprint(log_data))
+
+        state = self._windows.get(key)
+        if state is None:
+            if window <= 0 or len(self._windows) >= self.max_windows:
+                self.dispatcher.submit(subject=subject, recipients=recipients, content=log_data)
+                return 'sent'
+
+            now = datetime.now(timezone.utc).isoformat()
+            state = {'subject': subject, 'recipients': recipients, 'count': 0, 'suppressed': 0,
+                     'first_seen': now, 'last_seen': now, 'sample': log_data,
+                     'timer': asyncio.get_running_loop().call_later(window, self._close, key)}
+            self._windows[key] = state
+
+        state['count'] += 1
+        state['last_seen'] = datetime.now(timezone.utc).isoformat()
+        if state['count'] <= immediate_limit:
+            self.dispatcher.submit(subject=subject, recipients=recipients, content=log_data)
+            return 'sent'
+
+        state['suppressed'] += 1
+        state['sample'] = log_data
+        return 'coalesced'
+
+    def _close(self, key):
+        state = self._windows.pop(key, None)
+        if not state or not state['suppressed']:
+            return
+
+        company_name, (service, host, action, template) = key
+        self.dispatcher.submit(
+            subject=f"Alert digest - {state['suppressed']} more similar errors",
+            recipients=state['recipients'],
+            content={'company': company_name,
+                     'service': service,
+                     'host': host,
+                     'action': action,
+                     'message_template': template,
+                     'occurrences': state['count'],
+                     'suppressed': state['suppressed'],
+                     'first_seen': state['first_seen'],
+                     'last_seen': state['last_seen'],
+                     'last_log': state['sample']})
+
+    def flush(self):
+        """
+                Closes every open window now, sending the pending digests. Called on shutdown.
+        """
+        for key in list(self._windows):
+            self._windows[key]['timer'].cancel()
+            self._close(key)
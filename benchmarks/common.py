@@ -0,0 +1,192 @@
+import json
+import os
+import platform
+import random
+import statistics
+import time
+from datetime import datetime, timedelta, timezone
+
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+# The API reads its settings on import; the fake database does not need real ones
+for name, value in {'NOSQL_USER': 'bench', 'NOSQL_PASSWORD': 'bench', 'NOSQL_HOST': 'localhost',
+                    'BD': 'logdata_bench', 'COLLECTION_LOGS': 'logs', 'COLLECTION_COMPANIES': 'companies',
+                    'SECRET_KEY': 'bench-secret', 'ALGORITHM': 'HS256', 'ENSURE_INDEXES': 'False'}.items():
+    os.environ.setdefault(name, value)
+
+LEVELS = ('DEBUG', 'INFO', 'INFO', 'INFO', 'WARNING', 'ERROR')
+SERVICES = ('auth', 'billing', 'search', 'gateway', 'worker')
+ACTIONS = ('login', 'logout', 'payment', 'query', 'upload')
+WORDS = ('timeout', 'connection', 'refused', 'user', 'payment', 'declined', 'cache', 'miss', 'disk',
+         'full', 'request', 'completed', 'retry', 'scheduled', 'token', 'expired')
+
+
+class Company:
+    """ A simulated tenant: name, RSA key pair and the company_id given at registration."""
+
+    def __init__(self, name):
+        self.name = name
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.public_pem = self.private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo).decode('ascii')
+        self.company_id = None
+
+    def token(self, lifetime=3600):
+        """ RS256 ingest token, as a client of the API signs it."""
+        now = datetime.now(timezone.utc)
+        return jwt.encode({'iss': self.name, 'iat': now, 'exp': now + timedelta(seconds=lifetime)},
+                          self.private_key, algorithm='RS256')
+
+
+def make_companies(count, prefix='bench-company'):
+    return [Company(f'{prefix}-{i}') for i in range(count)]
+
+
+def make_log(rng, error_rate=0.0):
+    """ Random log with the LogSchema fields. Only error_rate of them are ERROR (they trigger alerts)."""
+    level = 'ERROR' if rng.random() < error_rate else rng.choice([level for level in LEVELS if level != 'ERROR'])
+    return {'timestamp': datetime.now(timezone.utc).isoformat(),
+            'host': f'host-{rng.randrange(20)}',
+            'service': rng.choice(SERVICES),
+            'level': level,
+            'event': {'action': rng.choice(ACTIONS),
+                      'category': rng.choice(('security', 'payments', 'system')),
+                      'outcome': rng.choice(('success', 'failure')),
+                      'reason': ' '.join(rng.choices(WORDS, k=3))},
+            'user': {'id': str(rng.randrange(10000)),
+                     'name': f'user{rng.randrange(500)}',
+                     'ip': f'10.0.{rng.randrange(256)}.{rng.randrange(256)}',
+                     'agent': 'bench/1.0'},
+            'message': ' '.join(rng.choices(WORDS, k=rng.randint(4, 12))),
+            'tags': rng.sample(('api', 'db', 'cache', 'auth', 'network'), k=2)}
+
+
+def make_documents(companies, count, days, seed=0):
+    """ count stored log documents spread over the last days days, as the API stores them."""
+    from db_nosql_async import AsyncNosql
+
+    rng = random.Random(seed)
+    now = datetime.now()
+    return [AsyncNosql.build_log_document(make_log(rng, error_rate=0.05), company.company_id, company.name,
+                                          now - timedelta(seconds=rng.uniform(0, days * 86400)))
+            for company in (rng.choice(companies) for _ in range(count))]
+
+
+def search_filters(rng, company, days, text=False):
+    """ A /logs/search body over a random window of the dataset."""
+    end = datetime.now(timezone.utc) - timedelta(hours=rng.uniform(0, days * 24 / 2))
+    filters = {'company_id': company.company_id,
+               'start_date': (end - timedelta(hours=rng.choice((1, 6, 24)))).isoformat(),
+               'end_date': end.isoformat(),
+               'page_size': 50}
+    if rng.random() < 0.3:
+        filters['level'] = rng.choice(('INFO', 'WARNING', 'ERROR'))
+    if text:
+        filters['text'] = rng.choice(WORDS)
+    return filters
+
+
+async def open_database(mongo_uri=None):
+    """
+        The database the benchmark runs against: a local mongod (fresh logdata_bench database)
+        when mongo_uri is given, otherwise the in-memory fake.
+    """
+    if not mongo_uri:
+        from benchmarks.fake_mongo import FakeDatabase
+        return FakeDatabase(), 'fake'
+
+    from pymongo import AsyncMongoClient
+    from indexes import IndexManager
+
+    client = AsyncMongoClient(mongo_uri)
+    await client.drop_database(os.environ['BD'])
+    db = client[os.environ['BD']]
+    await IndexManager(db).ensure()
+    return db, 'mongod'
+
+
+class Recorder:
+    """ Latencies (seconds) and errors per operation name."""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.elapsed = {}
+
+    def add(self, name, seconds, error=None):
+        self.samples.setdefault(name, []).append(seconds)
+        if error:
+            errors = self.errors.setdefault(name, {})
+            errors[error] = errors.get(error, 0) + 1
+
+    async def measure(self, name, operation, iterations):
+        """ Runs the async operation(i) iterations times, one after the other."""
+        started = time.perf_counter()
+        for i in range(iterations):
+            begin = time.perf_counter()
+            error = None
+            try:
+                await operation(i)
+            except Exception as e:
+                error = type(e).__name__
+            self.add(name, time.perf_counter() - begin, error)
+        self.elapsed[name] = time.perf_counter() - started
+
+    def summary(self, wall_time=None):
+        return {name: summarize(samples, self.elapsed.get(name, wall_time), self.errors.get(name, {}))
+                for name, samples in self.samples.items()}
+
+
+def summarize(samples, elapsed, errors):
+    ordered = sorted(samples)
+    if len(ordered) > 1:
+        cuts = statistics.quantiles(ordered, n=100, method='inclusive')
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = ordered[0]
+    return {'count': len(ordered),
+            'errors': errors,
+            'throughput_per_s': round(len(ordered) / elapsed, 2) if elapsed else None,
+            'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+            'p50_ms': round(p50 * 1000, 3),
+            'p95_ms': round(p95 * 1000, 3),
+            'p99_ms': round(p99 * 1000, 3),
+            'max_ms': round(ordered[-1] * 1000, 3)}
+
+
+def save_results(path, kind, params, results):
+    report = {'kind': kind,
+              'created_at': datetime.now(timezone.utc).isoformat(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'cpus': os.cpu_count(),
+              'params': params,
+              'results': results}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def print_results(results, baseline=None):
+    """ Table of the results; with a baseline report, the change of throughput and p95 against it."""
+    previous = {}
+    if baseline:
+        with open(baseline) as f:
+            previous = json.load(f)['results']
+
+    print(f"{'operation':32} {'count':>8} {'ops/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  errors")
+    for name, result in results.items():
+        line = (f"{name:32} {result['count']:>8} {result['throughput_per_s'] or 0:>10.1f} "
+                f"{result['p50_ms']:>9.3f} {result['p95_ms']:>9.3f} {result['p99_ms']:>9.3f}  "
+                f"{sum(result['errors'].values())}")
+        before = previous.get(name)
+        if before and before.get('throughput_per_s') and before.get('p95_ms'):
+            line += (f"  (ops/s {change(result['throughput_per_s'], before['throughput_per_s'])}, "
+                     f"p95 {change(result['p95_ms'], before['p95_ms'])})")
+        print(line)
+
+
+def change(now, before):
+    return f'{(now - before) / before * 100:+.1f}%'
@@ -0,0 +1,225 @@
+import re
+from datetime import datetime, timezone
+
+from bson import ObjectId
+
+# Same weights as the company_message_text index (see indexes.py)
+TEXT_FIELDS = {'log.message': 10, 'log.event.reason': 3}
+MISSING = object()
+
+
+def get_path(document, path):
+    """ Value at a dotted path; a list on the way is searched element by element (like MongoDB)."""
+    value = document
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list):
+            values = [get_path(item, part) for item in value if isinstance(item, dict)]
+            value = [item for item in values if item is not MISSING] or MISSING
+        else:
+            return MISSING
+    return value
+
+
+def stored(value):
+    """ Aware datetimes are compared as naive UTC, which is what pymongo sends."""
+    if isinstance(value, datetime) and value.tzinfo:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def candidates(value):
+    return value if isinstance(value, list) else [value]
+
+
+def compare(value, condition):
+    if isinstance(condition, dict) and any(key.startswith('$') for key in condition):
+        return all(operator(value, name, argument) for name, argument in condition.items())
+    condition = stored(condition)
+    return any(item == condition for item in candidates(value)) or value == condition
+
+
+def operator(value, name, argument):
+    if name == '$in':
+        return any(item in argument for item in candidates(value))
+    if name == '$nin':
+        return not any(item in argument for item in candidates(value))
+    if name == '$ne':
+        return not compare(value, argument)
+    if name == '$exists':
+        return (value is not MISSING) == bool(argument)
+    if value is MISSING:
+        return False
+    argument = stored(argument)
+    checks = {'$gt': lambda a, b: a > b, '$gte': lambda a, b: a >= b,
+              '$lt': lambda a, b: a < b, '$lte': lambda a, b: a <= b}
+    if name not in checks:
+        raise NotImplementedError(f'fake_mongo does not support {name}')
+    return any(item is not None and checks[name](item, argument) for item in candidates(value))
+
+
+def text_terms(search):
+    return [term.lower() for term in re.findall(r'\w+', search)]
+
+
+def text_score(document, terms):
+    """ Rough textScore: weighted count of the query terms found in the text fields."""
+    score = 0.0
+    for path, weight in TEXT_FIELDS.items():
+        value = get_path(document, path)
+        if isinstance(value, str):
+            words = text_terms(value)
+            score += weight * sum(words.count(term) for term in terms) / (len(words) or 1)
+    return score
+
+
+def matches(document, query):
+    for key, condition in query.items():
+        if key == '$and':
+            if not all(matches(document, part) for part in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif key == '$text':
+            if not text_score(document, text_terms(condition['$search'])):
+                return False
+        elif not compare(get_path(document, key), condition):
+            return False
+    return True
+
+
+def sort_documents(documents, spec):
+    def key(value):
+        # None / missing first in ascending order, then by value
+        return (value is not MISSING and value is not None, value if value not in (MISSING, None) else 0)
+
+    for path, direction in reversed(list(spec.items())):
+        documents.sort(key=lambda document: key(get_path(document, path)), reverse=direction < 0)
+    return documents
+
+
+def evaluate(expression, document, score):
+    if isinstance(expression, str) and expression.startswith('$'):
+        return get_path(document, expression[1:])
+    if isinstance(expression, dict):
+        if expression.get('$meta') == 'textScore':
+            return score
+        if '$cond' in expression:
+            condition, then, otherwise = expression['$cond']
+            return evaluate(then if evaluate(condition, document, score) else otherwise, document, score)
+        if '$lt' in expression:
+            left, right = (evaluate(value, document, score) for value in expression['$lt'])
+            return left < right
+        if '$mergeObjects' in expression:
+            merged = {}
+            for part in expression['$mergeObjects']:
+                value = evaluate(part, document, score)
+                if isinstance(value, dict):
+                    merged.update(value)
+            return merged
+        values = {name: evaluate(value, document, score) for name, value in expression.items()}
+        return {name: value for name, value in values.items() if value is not MISSING}
+    return expression
+
+
+def window_fields(documents, index, output):
+    """ $setWindowFields outputs of the document at index: only $count over a documents window."""
+    fields = {}
+    for name, spec in output.items():
+        if set(spec) != {'$count', 'window'}:
+            raise NotImplementedError(f'fake_mongo does not support the {name} window output')
+        lower, upper = spec['window']['documents']
+        lower = 0 if lower == 'unbounded' else index + (0 if lower == 'current' else lower)
+        upper = len(documents) if upper == 'unbounded' else index + (0 if upper == 'current' else upper)
+        fields[name] = len(documents[max(lower, 0):upper + 1])
+    return fields
+
+
+class FakeCursor:
+
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def to_list(self, length=None):
+        return self.documents[:length] if length else list(self.documents)
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self.documents:
+            yield document
+
+    async def close(self):
+        pass
+
+
+class FakeCollection:
+    """
+        In-memory stand-in for the pymongo asyncio collection, limited to what the ingest and
+        search paths use ($match, $addFields, $sort, $limit, $setWindowFields, $replaceRoot).
+        Not a MongoDB emulator: every query is a full scan, so it measures the API code rather than the database.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.documents = []
+
+    async def find_one(self, query):
+        return next((document for document in self.documents if matches(document, query)), None)
+
+    async def insert_one(self, document):
+        document.setdefault('_id', ObjectId())
+        self.documents.append(document)
+
+    async def insert_many(self, documents, ordered=True):
+        for document in documents:
+            document.setdefault('_id', ObjectId())
+        self.documents.extend(documents)
+
+    async def count_documents(self, query):
+        return sum(1 for document in self.documents if matches(document, query))
+
+    async def aggregate(self, pipeline, **kwargs):
+        documents = self.documents
+        terms = None
+        for stage in pipeline:
+            (name, argument), = stage.items()
+            if name == '$match':
+                if '$text' in argument:
+                    terms = text_terms(argument['$text']['$search'])
+                documents = [document for document in documents if matches(document, argument)]
+            elif name == '$addFields':
+                documents = [{**document,
+                              **evaluate(argument, document, text_score(document, terms) if terms else None)}
+                             for document in documents]
+            elif name == '$sort':
+                documents = sort_documents(list(documents), argument)
+            elif name == '$limit':
+                documents = documents[:argument]
+            elif name == '$setWindowFields':
+                documents = sort_documents(list(documents), argument['sortBy'])
+                documents = [{**document, **window_fields(documents, index, argument['output'])}
+                             for index, document in enumerate(documents)]
+            elif name == '$replaceRoot':
+                documents = [evaluate(argument['newRoot'], document, document.get('score'))
+                             for document in documents]
+            else:
+                raise NotImplementedError(f'fake_mongo does not support the {name} stage')
+        return FakeCursor(list(documents))
+
+
+class FakeDatabase:
+
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name)
+        return self.collections[name]
+
+    async def list_collection_names(self):
+        return list(self.collections)
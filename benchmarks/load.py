@@ -0,0 +1,147 @@
+"""
+    End-to-end load generator for POST /logs and POST /logs/search. Many simulated companies
+    register, then sign RS256 tokens and send logs and searches from concurrent clients.
+
+    Without --url the app runs in this process on the in-memory fake database (client and server
+    share the event loop, so compare runs with each other rather than with production numbers).
+    With --url it drives a running server; its SECRET_KEY must be set here to register companies.
+
+        python -m benchmarks.load --requests 20000 --concurrency 64 --search-ratio 0.2
+        python -m benchmarks.load --url http://127.0.0.1:8000 --baseline benchmarks/results/load.json
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from benchmarks.common import (Recorder, make_companies, make_log, open_database, print_results, save_results,
+                               summarize)
+from serialization import dumps
+from services import Service
+
+
+async def in_process_client(mongo_uri):
+    from main import app
+    from routers.router import service
+
+    db, backend = await open_database(mongo_uri)
+    service.nosql.db = db
+    service.nosql.ready = True
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench'), backend
+
+
+async def register(client, companies):
+    for company in companies:
+        response = await client.post('/register_company', json={
+            'token': Service.generate_registration_token(f'{company.name}@bench.local'),
+            'company_name': company.name,
+            'company_public_key': company.public_pem,
+            'alert_emails': []})  # ERROR logs must not send emails during the run
+        response.raise_for_status()
+        company.company_id = response.json()['company_id']
+
+
+def search_body(rng, company):
+    # Recent windows: the logs of this run were all received in the last minutes
+    end = datetime.now(timezone.utc) + timedelta(minutes=1)
+    # The LogFilters fields are nullable but required
+    body = {'company_id': company.company_id,
+            'level': None,
+            'user': None,
+            'tags': None,
+            'start_date': (end - timedelta(minutes=rng.choice((5, 15, 60)))).isoformat(),
+            'end_date': end.isoformat(),
+            'page_size': 50}
+    if rng.random() < 0.3:
+        body['level'] = rng.choice(('INFO', 'WARNING', 'ERROR'))
+    return body
+
+
+async def run(args):
+    if args.url:
+        client, backend = httpx.AsyncClient(base_url=args.url, timeout=args.timeout,
+                                            limits=httpx.Limits(max_connections=args.concurrency)), 'server'
+    else:
+        client, backend = await in_process_client(args.mongo_uri)
+
+    companies = make_companies(args.companies, prefix=f'bench-{int(time.time())}')
+    async with client:
+        await register(client, companies)
+        # Tokens are signed up front, like clients that reuse a token until it expires
+        tokens = {company.name: [company.token() for _ in range(args.tokens_per_company)] for company in companies}
+
+        recorder = Recorder()
+        remaining = [args.requests]
+
+        async def simulated_client(worker):
+            worker_rng = random.Random(args.seed * 1000 + worker)
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                company = worker_rng.choice(companies)
+                headers = {'Authorization': f'Bearer {worker_rng.choice(tokens[company.name])}',
+                           'Content-Type': 'application/json'}
+                if worker_rng.random() < args.search_ratio:
+                    name, path, body = 'POST /logs/search', '/logs/search', dumps(search_body(worker_rng, company))
+                else:
+                    name, path, body = 'POST /logs', '/logs', dumps(make_log(worker_rng, args.error_rate))
+
+                begin = time.perf_counter()
+                error = None
+                try:
+                    response = await client.post(path, content=body, headers=headers)
+                    if response.status_code >= 400:
+                        error = str(response.status_code)
+                except httpx.HTTPError as e:
+                    error = type(e).__name__
+                recorder.add(name, time.perf_counter() - begin, error)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(simulated_client(worker) for worker in range(args.concurrency)))
+        wall_time = time.perf_counter() - started
+
+    results = recorder.summary(wall_time)
+    results['all'] = overall(recorder, wall_time)
+    params = {**vars(args), 'backend': backend, 'wall_time_s': round(wall_time, 3)}
+    params.pop('output'), params.pop('baseline'), params.pop('mongo_uri')
+    return params, results
+
+
+def overall(recorder, wall_time):
+    """ Summary of every request of the run, whatever its endpoint."""
+    errors = {}
+    for counts in recorder.errors.values():
+        for error, count in counts.items():
+            errors[error] = errors.get(error, 0) + count
+    return summarize([sample for samples in recorder.samples.values() for sample in samples], wall_time, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for /logs and /logs/search.')
+    parser.add_argument('--url', help='Running server to drive. Default: the app in this process.')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--companies', type=int, default=50)
+    parser.add_argument('--tokens-per-company', type=int, default=3)
+    parser.add_argument('--search-ratio', type=float, default=0.2)
+    parser.add_argument('--error-rate', type=float, default=0.01)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongo-uri', default=os.environ.get('BENCH_MONGO_URI'),
+                        help='Local mongod for the in-process app instead of the in-memory fake.')
+    parser.add_argument('--output', default='benchmarks/results/load.json')
+    parser.add_argument('--baseline', help='Earlier result file to compare with.')
+    args = parser.parse_args()
+
+    params, results = asyncio.run(run(args))
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    save_results(args.output, 'load', params, results)
+    print_results(results, args.baseline)
+    print(f'Resultados guardados en {args.output}')
+
+
+if __name__ == '__main__':
+    main()
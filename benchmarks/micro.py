@@ -0,0 +1,126 @@
+"""
+    Micro-benchmarks of the ingest and search paths, run in-process against the in-memory fake
+    database (or a local mongod with --mongo-uri).
+
+        python -m benchmarks.micro --logs 20000 --iterations 1000 --baseline benchmarks/results/micro.json
+"""
+import argparse
+import asyncio
+import os
+import random
+import uuid
+
+from benchmarks.common import (Recorder, make_companies, make_documents, make_log, open_database, print_results,
+                               save_results, search_filters)
+from fastapi.security import HTTPAuthorizationCredentials
+from routers.router import LogSchema, parse_log
+from serialization import dumps
+from services import Service
+
+
+async def prepare(args):
+    db, backend = await open_database(args.mongo_uri)
+    service = Service()
+    service.nosql.db = db
+    service.nosql.ready = True
+
+    companies = make_companies(args.companies)
+    for company in companies:
+        company.company_id = str(uuid.uuid4())
+        # No alert emails: ERROR logs go through the coalescer without reaching SMTP
+        await service.nosql.store_company_in_db(company.company_id, company.public_pem, company.name, [])
+
+    documents = make_documents(companies, args.logs, args.days, seed=args.seed)
+    for start in range(0, len(documents), 10000):
+        await db[service.nosql.settings.collection_logs].insert_many(documents[start:start + 10000])
+    return service, companies, backend
+
+
+async def run(args):
+    service, companies, backend = await prepare(args)
+    rng = random.Random(args.seed)
+    recorder = Recorder()
+    n = args.iterations
+
+    tokens = [HTTPAuthorizationCredentials(scheme='Bearer', credentials=rng.choice(companies).token())
+              for _ in range(min(n, 200))]
+
+    async def verify_cold(i):
+        service.issuer_keys.clear()
+        await service.verify_logs_token(tokens[i % len(tokens)])
+
+    async def verify(i):
+        await service.verify_logs_token(tokens[i % len(tokens)])
+
+    await recorder.measure('verify_logs_token_cold', verify_cold, n)
+    await recorder.measure('verify_logs_token', verify, n)
+
+    bodies = [dumps(make_log(rng)) for _ in range(min(n, 1000))]
+
+    async def validate_fast(i):
+        parse_log(bodies[i % len(bodies)])
+
+    async def validate_model(i):
+        LogSchema.model_validate_json(bodies[i % len(bodies)]).model_dump()
+
+    await recorder.measure('parse_log', validate_fast, n)
+    await recorder.measure('LogSchema.model_validate_json', validate_model, n)
+
+    searches = [search_filters(rng, rng.choice(companies), args.days) for _ in range(n)]
+    text_searches = [search_filters(rng, rng.choice(companies), args.days, text=True) for _ in range(n)]
+    search_iterations = min(n, args.search_iterations)
+
+    async def search_cold(i):
+        await service.consult_filtered_logs(dict(searches[i]))
+
+    async def search_text(i):
+        await service.consult_filtered_logs(dict(text_searches[i]))
+
+    async def search_cached(i):
+        await service.consult_filtered_logs(dict(searches[i % 10]))
+
+    max_size = service.search_results.max_size
+    service.search_results.max_size = 0  # cache disabled: every search reaches the database
+    await recorder.measure('consult_filtered_logs', search_cold, search_iterations)
+    await recorder.measure('consult_filtered_logs_text', search_text, search_iterations)
+    service.search_results.max_size = max_size
+    await recorder.measure('consult_filtered_logs_cached', search_cached, n)
+
+    logs = [(make_log(rng, error_rate=args.error_rate), rng.choice(companies).name) for _ in range(n)]
+
+    async def process(i):
+        await service.process_log(*logs[i])
+
+    await recorder.measure('process_log', process, n)
+    service.alert_coalescer.flush()
+
+    params = {**vars(args), 'backend': backend}
+    params.pop('output'), params.pop('baseline'), params.pop('mongo_uri')
+    return params, recorder.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the ingest and search paths.')
+    parser.add_argument('--companies', type=int, default=20)
+    parser.add_argument('--logs', type=int, default=20000, help='Logs stored before the search benchmarks.')
+    parser.add_argument('--days', type=int, default=7, help='Time span of the stored logs.')
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--search-iterations', type=int, default=200,
+                        help='Iterations of the uncached searches (full scans on the fake database).')
+    parser.add_argument('--error-rate', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mongo-uri', default=os.environ.get('BENCH_MONGO_URI'),
+                        help='Local mongod to use instead of the in-memory fake (its database is dropped).')
+    parser.add_argument('--output', default='benchmarks/results/micro.json')
+    parser.add_argument('--baseline', help='Earlier result file to compare with.')
+    args = parser.parse_args()
+
+    params, results = asyncio.run(run(args))
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    save_results(args.output, 'micro', params, results)
+    print_results(results, args.baseline)
+    print(f'Resultados guardados en {args.output}')
+
+
+if __name__ == '__main__':
+    main()
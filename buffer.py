@@ -0,0 +1,269 @@
+import asyncio
+import queue
+import threading
+import time
+
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError
+
+
+class _BaseBuffer:
+    """
+        Limits and counters shared by the thread and asyncio write-behind buffers.
+    """
+
+    def __init__(self, flush, max_size=10000, batch_size=500, max_delay=1.0, max_retries=3, backoff=0.5):
+        self.flush = flush  # callable that receives a list of documents (insert_many)
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        # A batch that fails is retried with exponential backoff; the queue keeps filling meanwhile
+        # and put() answers 503 once it is full, so clients back off while MongoDB is unavailable
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._queue = None
+
+        self.flushed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def _reject(self):
+        self.rejected += 1
+        raise HTTPException(status_code=503, detail='Log buffer is full, retry later.',
+                            headers={'Retry-After': '1'})
+
+    def _retry_delay(self, batch, attempt, error):
+        """ Seconds to wait before retrying a failed batch, or None when it must not be retried."""
+        # After a BulkWriteError the rest of the batch is stored: retrying would only repeat the rejected ones
+        if isinstance(error, BulkWriteError) or attempt == self.max_retries:
+            return None
+        print(f"Reintentando la escritura de {len(batch)} logs en MongoDB: {error}")
+        return self.backoff * 2 ** attempt
+
+    def _record_flush(self, size, seconds, error=None):
+        failed = 0
+        if isinstance(error, BulkWriteError):
+            # Unordered insert_many: only the documents in writeErrors were not written
+            failed = len(error.details.get('writeErrors', []))
+        elif error is not None:
+            failed = size
+        self.flushed += size - failed
+        self.failed += failed
+        if failed:
+            print(f"Error al escribir {failed} logs en MongoDB: {error}")
+        self.last_flush_seconds = seconds
+        self.total_flush_seconds += seconds
+        self.flushes += 1
+
+    def stats(self):
+        return {'queue_depth': self._queue.qsize(),
+                'capacity': self.max_size,
+                'flushed': self.flushed,
+                'failed': self.failed,
+                'rejected': self.rejected,
+                'flushes': self.flushes,
+                'last_flush_seconds': self.last_flush_seconds,
+                'avg_flush_seconds': self.total_flush_seconds / self.flushes if self.flushes else 0.0}
+
+
+class WriteBehindBuffer(_BaseBuffer):
+    """
+        Bounded in-memory queue of log documents that a background thread writes to MongoDB.
+        A flush happens when batch_size documents are waiting or max_delay seconds after the
+        first queued document, whichever comes first.
+    """
+
+    def __init__(self, flush, max_size=10000, batch_size=500, max_delay=1.0, max_retries=3, backoff=0.5):
+        super().__init__(flush, max_size, batch_size, max_delay, max_retries, backoff)
+
+        self._queue = queue.Queue(maxsize=max_size)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='log-write-buffer', daemon=True)
+        self._thread.start()
+
+    def put(self, document):
+        """
+                Queues a document without blocking. Raises 503 when the buffer is full so clients back off.
+        """
+        try:
+            self._queue.put_nowait(document)
+        except queue.Full:
+            self._reject()
+
+    def _take_batch(self):
+        """
+                Waits for the first document, then collects more until the batch is full or max_delay expires.
+                Waits are sliced so a shutdown request is noticed quickly.
+        """
+        poll = min(self.max_delay, 0.1)
+        try:
+            batch = [self._queue.get(timeout=poll)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size and not self._stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=min(remaining, poll)))
+            except queue.Empty:
+                continue
+        return batch
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.flush(batch)
+                self._record_flush(len(batch), time.perf_counter() - started)
+                return
+            except Exception as e:
+                delay = self._retry_delay(batch, attempt, e)
+                if delay is None:
+                    self._record_flush(len(batch), time.perf_counter() - started, e)
+                    return
+                time.sleep(delay)
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._take_batch()
+            if batch:
+                self._write(batch)
+
+        # Shutdown: write whatever is still queued
+        batch = self._drain()
+        while batch:
+            self._write(batch)
+            batch = self._drain()
+
+    def stop(self, timeout=30):
+        """
+                Stops the background thread after flushing every queued document.
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+
+class AsyncWriteBehindBuffer(_BaseBuffer):
+    """
+        asyncio version of WriteBehindBuffer: the flush is a coroutine run by a background task.
+        start() must be called from the running event loop (application lifespan).
+    """
+
+    def __init__(self, flush, max_size=10000, batch_size=500, max_delay=1.0, max_retries=3, backoff=0.5):
+        super().__init__(flush, max_size, batch_size, max_delay, max_retries, backoff)
+
+        self._queue = asyncio.Queue(maxsize=max_size)
+        self._stopping = False
+        self._task = None
+
+    def start(self):
+        if self._task and not self._task.done():
+            return
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run(), name='log-write-buffer')
+
+    def put(self, document):
+        """
+                Queues a document without blocking. Raises 503 when the buffer is full so clients back off.
+        """
+        try:
+            self._queue.put_nowait(document)
+        except asyncio.QueueFull:
+            self._reject()
+
+    async def _get(self, timeout):
+        try:
+            async with asyncio.timeout(timeout):
+                return await self._queue.get()
+        except TimeoutError:
+            return None
+
+    async def _take_batch(self):
+        poll = min(self.max_delay, 0.1)
+        document = await self._get(poll)
+        if document is None:
+            return []
+
+        batch = [document]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.batch_size and not self._stopping:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            document = await self._get(min(remaining, poll))
+            if document is not None:
+                batch.append(document)
+        return batch
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _write(self, batch):
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self.flush(batch)
+                self._record_flush(len(batch), time.perf_counter() - started)
+                return
+            except Exception as e:
+                delay = self._retry_delay(batch, attempt, e)
+                if delay is None:
+                    self._record_flush(len(batch), time.perf_counter() - started, e)
+                    return
+                await asyncio.sleep(delay)
+
+    async def _run(self):
+        while not self._stopping:
+            batch = await self._take_batch()
+            if batch:
+                await self._write(batch)
+
+        # Shutdown: write whatever is still queued
+        batch = self._drain()
+        while batch:
+            await self._write(batch)
+            batch = self._drain()
+
+    async def stop(self):
+        """
+                Stops the background task after flushing every queued document.
+        """
+        self._stopping = True
+        if self._task:
+            await self._task
+            self._task = None
+        else:
+            batch = self._drain()
+            while batch:
+                await self._write(batch)
+                batch = self._drain()
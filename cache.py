@@ -0,0 +1,144 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+        Thread-safe LRU cache with a time-to-live per entry.
+        Misses are loaded by a single caller while concurrent callers for the same key wait,
+        and selected loader errors can be remembered for a short negative TTL.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, negative_ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self._entries = OrderedDict()  # key -> (expires_at, value, error)
+        self._lock = threading.Lock()
+        self._loading = {}
+        self._pending = {}  # key -> asyncio task loading it
+        self._generation = 0  # bumped on invalidation so in-flight loads do not store stale values
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _lookup(self, key):
+        """
+                Returns the live entry for the key (refreshing its LRU position) or None.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def _store(self, key, value, error, ttl, generation=None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[key] = (time.monotonic() + ttl, value, error)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _resolve(entry):
+        _, value, error = entry
+        if error is not None:
+            raise error.with_traceback(None)
+        return value
+
+    def get(self, key, default=None):
+        entry = self._lookup(key)
+        if entry is None or entry[2] is not None:
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        self._store(key, value, None, self.ttl if ttl is None else ttl)
+
+    def get_or_load(self, key, loader, is_negative=None, ttl=None):
+        """
+                Returns the cached value for the key, calling loader(key) on a miss.
+                If the loader raises an error for which is_negative(error) is true, the error is
+                cached for negative_ttl seconds and raised again to later callers.
+                ttl overrides the cache TTL for the loaded value.
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            return self._resolve(entry)
+
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            try:
+                # Another caller may have loaded the key while we were waiting
+                entry = self._lookup(key)
+                if entry is not None:
+                    return self._resolve(entry)
+
+                generation = self._generation
+                try:
+                    value = loader(key)
+                except Exception as e:
+                    if self.negative_ttl and is_negative and is_negative(e):
+                        self._store(key, None, e, self.negative_ttl, generation)
+                    raise
+
+                self._store(key, value, None, self.ttl if ttl is None else ttl, generation)
+                return value
+            finally:
+                with self._lock:
+                    if self._loading.get(key) is key_lock:
+                        del self._loading[key]
+
+    async def _load_async(self, key, loader, is_negative, ttl):
+        generation = self._generation
+        try:
+            value = await loader(key)
+        except Exception as e:
+            if self.negative_ttl and is_negative and is_negative(e):
+                self._store(key, None, e, self.negative_ttl, generation)
+            raise
+
+        self._store(key, value, None, self.ttl if ttl is None else ttl, generation)
+        return value
+
+    async def get_or_load_async(self, key, loader, is_negative=None, ttl=None):
+        """
+                Same as get_or_load for coroutine loaders: concurrent misses on the same key
+                await a single load task.
+        """
+        entry = self._lookup(key)
+        if entry is not None:
+            return self._resolve(entry)
+
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load_async(key, loader, is_negative, ttl))
+            self._pending[key] = task
+            task.add_done_callback(lambda done: self._pending.pop(key, None)
+                                   if self._pending.get(key) is done else None)
+
+        # shield: a cancelled caller must not cancel the load the others are waiting for
+        return await asyncio.shield(task)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._pending.pop(key, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
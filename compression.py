@@ -0,0 +1,135 @@
+import zlib
+
+import zstandard
+from fastapi import HTTPException
+from settings import get_settings
+
+# Encodings offered and accepted, by preference
+SUPPORTED_ENCODINGS = ('zstd', 'gzip')
+
+# Compressed bytes given to each zstd decompress() call. One input byte inflates to at most ~32 KiB
+# (a 128 KiB RLE block takes 4 bytes), so a call outputs at most ~2 MiB past MAX_DECOMPRESSED_BODY
+ZSTD_INPUT_SLICE = 64
+
+
+def negotiate(accept_encoding):
+    """
+        Best encoding the client accepts (Accept-Encoding, with q-values), preferring zstd, or None.
+    """
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+
+    for encoding in SUPPORTED_ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def too_large():
+    return HTTPException(status_code=413, detail='Decompressed body is too large.')
+
+
+async def read_body(request):
+    """
+        Request body, decompressed while it is received when Content-Encoding is gzip or zstd.
+        Stops with 413 as soon as more than MAX_DECOMPRESSED_BODY bytes come out (zip bombs).
+    """
+    encoding = request.headers.get('content-encoding', 'identity').strip().lower()
+    if encoding == 'identity':
+        return await request.body()
+    if encoding not in SUPPORTED_ENCODINGS:
+        raise HTTPException(status_code=415, detail=f'Unsupported Content-Encoding: {encoding}.')
+
+    limit = get_settings().max_decompressed_body
+    if encoding == 'gzip':
+        return await read_gzip(request.stream(), limit)
+    return await read_zstd(request.stream(), limit)
+
+
+async def read_gzip(stream, limit):
+    decompressor = zlib.decompressobj(wbits=31)
+    parts, size = [], 0
+    try:
+        async for chunk in stream:
+            data = chunk
+            while data:
+                # max_length bounds the output of each call; the rest stays in unconsumed_tail
+                part = decompressor.decompress(data, limit - size + 1)
+                size += len(part)
+                if size > limit:
+                    raise too_large()
+                parts.append(part)
+                data = decompressor.unconsumed_tail
+        parts.append(decompressor.flush())
+    except zlib.error:
+        raise HTTPException(status_code=400, detail='Invalid gzip body.')
+
+    if not decompressor.eof:
+        raise HTTPException(status_code=400, detail='Truncated gzip body.')
+    return b''.join(parts)
+
+
+async def read_zstd(stream, limit):
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    parts, size = [], 0
+    try:
+        async for chunk in stream:
+            data = memoryview(chunk)
+            # decompress() has no max_length: small input slices bound what each call can output
+            for start in range(0, len(data), ZSTD_INPUT_SLICE):
+                part = decompressor.decompress(data[start:start + ZSTD_INPUT_SLICE])
+                size += len(part)
+                if size > limit:
+                    raise too_large()
+                parts.append(part)
+    except zstandard.ZstdError:
+        raise HTTPException(status_code=400, detail='Invalid zstd body.')
+
+    if not decompressor.eof:
+        raise HTTPException(status_code=400, detail='Truncated zstd body.')
+    return b''.join(parts)
+
+
+def compressor(encoding):
+    """ Object with compress(data) / flush() for the negotiated encoding."""
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=get_settings().zstd_level).compressobj()
+    return zlib.compressobj(get_settings().gzip_level, wbits=31)
+
+
+def compress_response(response, accept_encoding):
+    """
+        Compresses a rendered response in place when the client accepts it and the body
+        is at least COMPRESS_MIN_SIZE bytes.
+    """
+    response.headers['Vary'] = 'Accept-Encoding'
+    encoding = negotiate(accept_encoding)
+    if not encoding or len(response.body) < get_settings().compress_min_size:
+        return response
+
+    engine = compressor(encoding)
+    response.body = engine.compress(response.body) + engine.flush()
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Content-Length'] = str(len(response.body))
+    return response
+
+
+async def compress_stream(chunks, encoding):
+    """ Compresses an async iterator of byte chunks, one output chunk per input chunk."""
+    engine = compressor(encoding)
+    async for chunk in chunks:
+        data = engine.compress(chunk)
+        if data:
+            yield data
+    yield engine.flush()
@@ -1,13 +1,21 @@
 from decouple import config
-from pymongo import MongoClient
+from pymongo import MongoClient, AsyncMongoClient
 from pymongo.errors import PyMongoError, ConnectionFailure, ServerSelectionTimeoutError
 import certifi
+from metrics import MongoCommandMetrics
+from settings import get_settings
+
+
+def build_mongo_uri(settings=None):
+    settings = settings or get_settings()
+    return (f"mongodb+srv://{settings.nosql_user}:{settings.nosql_password}"
+            f"@{settings.nosql_host}/{settings.database}"
+            f"?retryWrites=true&w=majority&tls=true&tlsAllowInvalidCertificates=false")
+
 
 class Connection:
     def __init__(self):
-        self.mongo_uri = (f"mongodb+srv://{config('NOSQL_USER')}:{config('NOSQL_PASSWORD')}"
-                     f"@{config('NOSQL_HOST')}/{config('BD')}"
-                     f"?retryWrites=true&w=majority&tls=true&tlsAllowInvalidCertificates=false")
+        self.mongo_uri = build_mongo_uri()
 
         self.client = None
 
@@ -41,4 +49,58 @@ class Connection:
 
         if not self.client:
             self.connection_nosql()
-        return self.client[config('BD')]
\ No newline at end of file
+        return self.client[config('BD')]
+
+    def close(self):
+        if self.client:
+            self.client.close()
+            self.client = None
+
+
+class AsyncConnection:
+    """
+        Same connection as Connection but using PyMongo's asyncio client, for the FastAPI routes.
+        The client connects lazily: no I/O happens until the first operation or ping().
+    """
+    def __init__(self, settings=None):
+        self.settings = settings or get_settings()
+        self.mongo_uri = build_mongo_uri(self.settings)
+
+        self.client = None
+
+    def connection_nosql(self):
+        if self.client:
+            return self.client
+
+        self.client = AsyncMongoClient(self.mongo_uri,
+                                       tls=True,
+                                       tlsAllowInvalidCertificates=False,
+                                       tlsCAFile=certifi.where(),
+                                       serverSelectionTimeoutMS=self.settings.mongo_server_selection_timeout_ms,
+                                       maxPoolSize=self.settings.mongo_max_pool_size,
+                                       minPoolSize=self.settings.mongo_min_pool_size,
+                                       maxIdleTimeMS=self.settings.mongo_max_idle_time_ms,
+                                       # Command latency by collection/operation for /metrics
+                                       event_listeners=[MongoCommandMetrics()])
+        return self.client
+
+    async def ping(self):
+        try:
+            await self.connection_nosql().admin.command('ping')
+        except (ConnectionFailure, ServerSelectionTimeoutError) as cf:
+            print(f"Error de conexión: {cf}")
+            raise cf
+        except PyMongoError as err:
+            print(f"Ocurrió un error con MongoDB: {err}")
+            raise err
+
+    def get_database(self):
+        """
+               Returns the database object configured in the .env.
+        """
+        return self.connection_nosql()[self.settings.database]
+
+    async def close(self):
+        if self.client:
+            await self.client.close()
+            self.client = None
@@ -1,6 +1,9 @@
 from decouple import config
 from fastapi import HTTPException
 from datetime import datetime
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from buffer import WriteBehindBuffer
+from retention import default_policy, expires_at
 from conection import Connection
 
 
@@ -8,6 +11,24 @@ class Nosql:
     def __init__(self):
         self.conn = Connection()
         self.db = self.conn.get_database()
+        self.write_buffer = None
+        self.retention_defaults = default_policy()
+
+        if config('LOG_WRITE_MODE', default='direct') == 'buffered':
+            self.write_buffer = WriteBehindBuffer(self.insert_log_documents,
+                                                  max_size=config('LOG_BUFFER_MAX_SIZE', default=10000, cast=int),
+                                                  batch_size=config('LOG_BUFFER_BATCH_SIZE', default=500, cast=int),
+                                                  max_delay=config('LOG_BUFFER_MAX_DELAY', default=1.0, cast=float),
+                                                  max_retries=config('LOG_BUFFER_MAX_RETRIES', default=3, cast=int),
+                                                  backoff=config('LOG_BUFFER_RETRY_BACKOFF', default=0.5, cast=float))
+            self.write_buffer.start()
+
+    def close(self):
+        """
+               Flushes the pending buffered logs. Called on application shutdown.
+        """
+        if self.write_buffer:
+            self.write_buffer.stop()
 
     def verify_company(self, company_name):
         try:
@@ -27,20 +48,31 @@ class Nosql:
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Error accessing database{str(e)}")
 
-    def store_company_in_db(self, company_id, public_key, company_name, alert_emails):
+    def store_company_in_db(self, company_id, public_key, company_name, alert_emails, alert_policy=None,
+                            retention=None):
         try:
             collection = self.db[config('COLLECTION_COMPANIES')]
 
+            # Fallback for databases without the unique company_name index (ENSURE_INDEXES=False or a failed ensure)
             existing = collection.find_one({'company_name': company_name})
             if existing:
                 raise HTTPException(status_code=409, detail='Company already exists.')
 
-            collection.insert_one({'company_id': company_id,
-                                   'company_public_key': public_key,
-                                   'company_name': company_name,
-                                   'alert_emails': alert_emails})
+            document = {'company_id': company_id,
+                        'company_public_key': public_key,
+                        'company_name': company_name,
+                        'alert_emails': alert_emails}
+            if alert_policy:
+                document['alert_policy'] = alert_policy
+            if retention:
+                document['retention'] = retention
+
+            # The unique company_name index also rejects the concurrent duplicates the check above misses
+            collection.insert_one(document)
 
             return {'message': 'Company successfully registered.'}
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail='Company already exists.')
         except Exception:
             raise
 
@@ -56,23 +88,64 @@ class Nosql:
         except Exception:
             raise
 
-    def store_log_in_db(self, log_data, company_name):
+    @staticmethod
+    def build_log_document(log_data, company_id, company_name, received_at, expires_at=None):
+        # Ensure timestamp exists
+        log_data['timestamp'] = log_data.get('timestamp', datetime.now())
+
+        document = {'company_id': company_id,
+                    'company_name': company_name,
+                    'log': log_data,
+                    'received_at': received_at}
+        if expires_at:
+            document['expires_at'] = expires_at  # TTL index: removed by MongoDB after the company retention
+        return document
+
+    def store_log_in_db(self, log_data, company_name, company=None):
         try:
             collection = self.db[config('COLLECTION_LOGS')]
 
-            company = self.get_company(company_name)
+            # Callers that already resolved the company pass it to skip the lookup
+            company = company or self.get_company(company_name)
 
-            # Ensure timestamp exists
-            log_data['timestamp'] = log_data.get('timestamp', datetime.now())
+            received_at = datetime.now()
+            document = self.build_log_document(log_data, company['company_id'], company_name, received_at,
+                                               expires_at(company, received_at, self.retention_defaults))
 
-            collection.insert_one({'company_id': company['company_id'],
-                                   'company_name': company_name,
-                                   'log': log_data,
-                                   'received_at': datetime.now()})
+            if self.write_buffer:
+                self.write_buffer.put(document)
+            else:
+                collection.insert_one(document)
 
         except Exception:
             raise
 
+    def store_logs_in_db(self, logs, company_name, company=None):
+        """
+                Stores several logs with a single unordered insert_many.
+                Returns a dict {position: error message} with the logs MongoDB rejected.
+        """
+        if not logs:
+            return {}
+
+        collection = self.db[config('COLLECTION_LOGS')]
+        company = company or self.get_company(company_name)
+
+        received_at = datetime.now()
+        expiry = expires_at(company, received_at, self.retention_defaults)
+        documents = [self.build_log_document(log_data, company['company_id'], company_name, received_at, expiry)
+                     for log_data in logs]
+
+        try:
+            collection.insert_many(documents, ordered=False)
+            return {}
+        except BulkWriteError as bwe:
+            return {err['index']: err.get('errmsg', 'Write error.') for err in bwe.details.get('writeErrors', [])}
+
+    def insert_log_documents(self, documents):
+        collection = self.db[config('COLLECTION_LOGS')]
+        collection.insert_many(documents, ordered=False)
+
     def search_log_in_db(self, filters):
         try:
             collection = self.db[config('COLLECTION_LOGS')]
@@ -0,0 +1,393 @@
+import asyncio
+
+from fastapi import HTTPException
+from datetime import datetime
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from buffer import AsyncWriteBehindBuffer
+from conection import AsyncConnection
+from db_nosql import Nosql
+from indexes import IndexManager
+from profiling import note_query
+from rollups import RollupAggregator, RollupStore, rollup_segments
+from retention import expires_at
+from settings import get_settings
+from storage import ensure_log_collection
+
+LOG_SORT = {'received_at': -1, '_id': -1}
+# Response shape built by MongoDB: the stored log with the company fields added next to it
+LOG_RESPONSE_SHAPE = {'$replaceRoot': {'newRoot': {'$mergeObjects': [
+    '$log', {'company_id': '$company_id', 'company_name': '$company_name'}]}}}
+# Text searches: relevance first, then the usual position
+LOG_RANKED_SORT = {'score': -1, 'received_at': -1, '_id': -1}
+
+
+def page_stages(sort, position):
+    """
+        Search page stages: only the stored log fields, plus the cursor position on the last two logs
+        (the last one of the page, and the extra one that tells whether there is a next page).
+    """
+    return [{'$setWindowFields': {'sortBy': sort, 'output': {
+                'following': {'$count': {}, 'window': {'documents': [1, 'unbounded']}}}}},
+            {'$replaceRoot': {'newRoot': {'$mergeObjects': [
+                '$log', {'$cond': [{'$lt': ['$following', 2]}, {'position': position}, {}]}]}}}]
+
+
+LOG_PAGE_STAGES = page_stages(LOG_SORT, {'received_at': '$received_at', '_id': '$_id'})
+LOG_RANKED_PAGE_STAGES = page_stages(LOG_RANKED_SORT, {'received_at': '$received_at', '_id': '$_id',
+                                                       'score': '$score'})
+
+# Group-by dimensions accepted by the analytics endpoint and the log field each one reads
+LOG_DIMENSIONS = {'level': '$log.level',
+                  'service': '$log.service',
+                  'host': '$log.host',
+                  'event.category': '$log.event.category',
+                  'tag': '$log.tags'}
+# Dimensions kept in the per-minute rollups
+ROLLUP_DIMENSIONS = {'level': '$level', 'service': '$service'}
+
+
+class AsyncNosql:
+    """
+        asyncio version of Nosql used by the API routes.
+        Nosql stays available for scripts and other synchronous code.
+        Nothing connects on construction: the client is created by start() (application lifespan)
+        or on first use, and the pool is warmed up in the background.
+    """
+    def __init__(self, settings=None):
+        self.settings = settings or get_settings()
+        self.conn = AsyncConnection(self.settings)
+        self._db = None
+        self.write_buffer = None
+
+        # Readiness: set once the background warm-up reached MongoDB and provisioned the collections
+        self.ready = False
+        self.warmup_error = None
+        self._warmup = None
+
+        if self.settings.log_write_mode == 'buffered':
+            self.write_buffer = AsyncWriteBehindBuffer(self.insert_log_documents,
+                                                       max_size=self.settings.log_buffer_max_size,
+                                                       batch_size=self.settings.log_buffer_batch_size,
+                                                       max_delay=self.settings.log_buffer_max_delay,
+                                                       max_retries=self.settings.log_buffer_max_retries,
+                                                       backoff=self.settings.log_buffer_retry_backoff)
+
+        self.retention_defaults = (self.settings.log_hot_days, self.settings.log_retention_days)
+
+        self.rollup_store = None
+        self.rollups = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = self.conn.get_database()
+        return self._db
+
+    @db.setter
+    def db(self, value):
+        self._db = value
+
+    async def start(self):
+        """
+               Creates the client and starts the background tasks without waiting for MongoDB.
+               Called on application startup.
+        """
+        if self.settings.log_rollups and not self.rollups:
+            self.rollup_store = RollupStore(self.db[self.settings.collection_rollups],
+                                            grace=self.settings.rollup_grace_seconds)
+            self.rollups = RollupAggregator(self.rollup_store,
+                                            flush_interval=self.settings.rollup_flush_interval,
+                                            max_keys=self.settings.rollup_max_keys,
+                                            compact_interval=self.settings.rollup_compact_interval)
+
+        if self.write_buffer:
+            self.write_buffer.start()
+        if self.rollups:
+            self.rollups.start()
+
+        if not self._warmup:
+            self._warmup = asyncio.get_running_loop().create_task(self.warm_up(), name='mongo-warm-up')
+
+    async def provision(self):
+        """
+               Creates the logs collection (time-series mode) and the declared indexes, and records
+               since when the rollups count logs.
+        """
+        # Time-series mode: the collection must exist before create_indexes makes it a plain one
+        await ensure_log_collection(self.db, self.settings.collection_logs)
+
+        if self.rollups:
+            await self.rollup_store.mark_start(self.rollups.started_at)
+
+        if self.settings.ensure_indexes:
+            manager = IndexManager(self.db)
+            await manager.ensure()
+            for collection_name, status in (await manager.report()).items():
+                if status.get('missing') or status.get('unused'):
+                    print(f"Índices de {collection_name}: faltan {status.get('missing')}, "
+                          f"sin uso {status.get('unused')}")
+
+    async def warm_up(self):
+        """
+               Background task: pings MongoDB until it answers (the driver then opens minPoolSize
+               connections), provisions the collections and marks the instance ready.
+        """
+        while True:
+            try:
+                await self.conn.ping()
+                await self.provision()
+            except Exception as e:
+                self.warmup_error = str(e)
+                await asyncio.sleep(self.settings.warmup_retry_seconds)
+                continue
+            self.warmup_error = None
+            self.ready = True
+            return
+
+    async def close(self):
+        """
+               Flushes the pending buffered logs and closes the client. Called on application shutdown.
+        """
+        if self._warmup:
+            self._warmup.cancel()
+            await asyncio.gather(self._warmup, return_exceptions=True)
+            self._warmup = None
+        if self.write_buffer:
+            await self.write_buffer.stop()
+        if self.rollups:
+            await self.rollups.stop()
+        await self.conn.close()
+
+    async def verify_company(self, company_name):
+        try:
+            collection = self.db[self.settings.collection_companies]
+            company = await collection.find_one({'company_name': company_name})
+
+            if not company:
+                raise HTTPException(status_code=404, detail='Company does not exist.')
+
+            public_key = company.get('company_public_key')
+            if not public_key:
+                raise HTTPException(status_code=404, detail='Public key not found for the company.')
+
+            return public_key
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error accessing database{str(e)}")
+
+    async def store_company_in_db(self, company_id, public_key, company_name, alert_emails, alert_policy=None,
+                                  retention=None):
+        collection = self.db[self.settings.collection_companies]
+
+        # Fallback for databases without the unique company_name index (ENSURE_INDEXES=False or a failed ensure)
+        if await collection.find_one({'company_name': company_name}):
+            raise HTTPException(status_code=409, detail='Company already exists.')
+
+        document = {'company_id': company_id,
+                    'company_public_key': public_key,
+                    'company_name': company_name,
+                    'alert_emails': alert_emails}
+        if alert_policy:
+            document['alert_policy'] = alert_policy
+        if retention:
+            document['retention'] = retention
+
+        # The unique company_name index also rejects the concurrent duplicates the check above misses
+        try:
+            await collection.insert_one(document)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=409, detail='Company already exists.')
+
+        return {'message': 'Company successfully registered.'}
+
+    async def get_company(self, company_name):
+        collection = self.db[self.settings.collection_companies]
+
+        company = await collection.find_one({'company_name': company_name})
+        if not company:
+            raise HTTPException(status_code=404, detail='Company not found.')
+
+        return company
+
+    build_log_document = staticmethod(Nosql.build_log_document)
+
+    async def store_log_in_db(self, log_data, company_name, company=None):
+        collection = self.db[self.settings.collection_logs]
+
+        # Callers that already resolved the company pass it to skip the lookup
+        company = company or await self.get_company(company_name)
+
+        received_at = datetime.now()
+        document = self.build_log_document(log_data, company['company_id'], company_name, received_at,
+                                           expires_at(company, received_at, self.retention_defaults))
+
+        if self.write_buffer:
+            self.write_buffer.put(document)
+        else:
+            await collection.insert_one(document)
+
+        if self.rollups:
+            self.rollups.add(document)
+
+    async def store_logs_in_db(self, logs, company_name, company=None):
+        """
+                Stores several logs with a single unordered insert_many.
+                Returns a dict {position: error message} with the logs MongoDB rejected.
+        """
+        if not logs:
+            return {}
+
+        collection = self.db[self.settings.collection_logs]
+        company = company or await self.get_company(company_name)
+
+        received_at = datetime.now()
+        expiry = expires_at(company, received_at, self.retention_defaults)
+        documents = [self.build_log_document(log_data, company['company_id'], company_name, received_at, expiry)
+                     for log_data in logs]
+
+        try:
+            await collection.insert_many(documents, ordered=False)
+            rejected = {}
+        except BulkWriteError as bwe:
+            rejected = {err['index']: err.get('errmsg', 'Write error.') for err in bwe.details.get('writeErrors', [])}
+
+        if self.rollups:
+            for position, document in enumerate(documents):
+                if position not in rejected:
+                    self.rollups.add(document)
+        return rejected
+
+    async def insert_log_documents(self, documents):
+        collection = self.db[self.settings.collection_logs]
+        await collection.insert_many(documents, ordered=False)
+
+    async def search_log_in_db(self, filters, limit=None):
+        """
+                Newest logs first, already flattened to the response shape by the aggregation
+                (the last two carry their position for the cursor, see page_stages).
+                The (received_at, _id) sort matches the compound indexes so a limited page is
+                an index range scan instead of an in-memory sort.
+        """
+        collection = self.db[self.settings.collection_logs]
+        pipeline = [{'$match': filters}, {'$sort': LOG_SORT}]
+        if limit:
+            pipeline.append({'$limit': limit})
+        pipeline += LOG_PAGE_STAGES
+        note_query(collection.name, pipeline)
+        cursor = await collection.aggregate(pipeline)
+        return await cursor.to_list()
+
+    async def search_ranked_logs_in_db(self, filters, after=None, limit=100):
+        """
+                Text search results, most relevant first (then newest first), in the response shape
+                (with the score in the position of the last two). after filters on (score, received_at, _id) once the score is known.
+        """
+        collection = self.db[self.settings.collection_logs]
+        pipeline = [{'$match': filters}, {'$addFields': {'score': {'$meta': 'textScore'}}}]
+        if after:
+            pipeline.append({'$match': after})
+        pipeline += [{'$sort': LOG_RANKED_SORT}, {'$limit': limit}, *LOG_RANKED_PAGE_STAGES]
+        note_query(collection.name, pipeline)
+        cursor = await collection.aggregate(pipeline)
+        return await cursor.to_list()
+
+    async def iter_logs_in_db(self, filters, batch_size=1000):
+        """
+                Streams matching logs (response shape) from a server-side cursor, batch_size documents per round trip.
+        """
+        collection = self.db[self.settings.collection_logs]
+        cursor = await collection.aggregate([{'$match': filters}, {'$sort': LOG_SORT}, LOG_RESPONSE_SHAPE],
+                                            batchSize=batch_size)
+        try:
+            async for document in cursor:
+                yield document
+        finally:
+            await cursor.close()
+
+    async def count_logs_in_db(self, filters, group_by=(), unit=None, bin_size=1, limit=10000):
+        """
+                Counts matching logs per time bucket (received_at truncated with $dateTrunc) and dimension.
+        """
+        collection = self.db[self.settings.collection_logs]
+
+        pipeline = [{'$match': filters}]
+        if 'tag' in group_by:
+            # A log with several tags counts once for each of them
+            pipeline.append({'$unwind': LOG_DIMENSIONS['tag']})
+        pipeline += self.count_stages(LOG_DIMENSIONS, group_by, '$received_at', 1, unit, bin_size, limit)
+
+        return await self.run_count(collection, pipeline, group_by, unit)
+
+    async def rollups_cover(self, start):
+        """ Whether the rollups counted every log received from start on (rollups are not backfilled)."""
+        since = await self.rollup_store.counting_since()
+        return since is not None and start >= since
+
+    async def count_rollups_in_db(self, company_id, start, end, level=None, group_by=(), unit=None, bin_size=1,
+                                  limit=10000):
+        """
+                Same result as count_logs_in_db read from the rollups: compacted day/hour buckets for
+                the middle of [start, end) and minute buckets for the edges (minute precision).
+        """
+        max_unit = unit if unit in ('minute', 'hour') else 'day'
+        segments = rollup_segments(start, end, await self.rollup_store.watermarks(), max_unit)
+        if not segments:
+            return self.empty_columns(group_by, unit)
+
+        match = {'company_id': company_id,
+                 '$or': [{'unit': segment_unit, 'bucket': {'$gte': first, '$lt': last}}
+                         for segment_unit, first, last in segments]}
+        if level:
+            match['level'] = level
+        pipeline = [{'$match': match}] + self.count_stages(ROLLUP_DIMENSIONS, group_by, '$bucket', '$count',
+                                                           unit, bin_size, limit)
+
+        return await self.run_count(self.rollup_store.collection, pipeline, group_by, unit)
+
+    async def explain(self, collection_name, pipeline):
+        """
+                Query plan of an aggregation (queryPlanner verbosity: the pipeline is not run again).
+        """
+        return await self.db.command('explain', {'aggregate': collection_name, 'pipeline': pipeline, 'cursor': {}},
+                                     verbosity='queryPlanner')
+
+    @staticmethod
+    def count_stages(dimensions, group_by, time_field, count, unit, bin_size, limit):
+        """
+                $group/$sort stages that build a single columnar document
+                {'time': [...], 'd0': [...], ..., 'count': [...]} ordered by bucket.
+        """
+        # Positional keys: dimension names such as event.category are not valid field names here
+        key = {f'd{i}': dimensions[dimension] for i, dimension in enumerate(group_by)}
+        if unit:
+            key['time'] = {'$dateTrunc': {'date': time_field, 'unit': unit, 'binSize': bin_size}}
+
+        columns = {f'd{i}': f'$_id.d{i}' for i in range(len(group_by))}
+        if unit:
+            columns['time'] = '$_id.time'
+        columns['count'] = '$count'
+
+        return [{'$group': {'_id': key, 'count': {'$sum': count}}},
+                {'$sort': {'_id.time': 1, **{f'_id.d{i}': 1 for i in range(len(group_by))}}},
+                {'$limit': limit},
+                {'$group': {'_id': None, **{name: {'$push': value} for name, value in columns.items()}}}]
+
+    @staticmethod
+    def empty_columns(group_by, unit):
+        return {**({'time': []} if unit else {}), **{dimension: [] for dimension in group_by}, 'count': []}
+
+    async def run_count(self, collection, pipeline, group_by, unit):
+        note_query(collection.name, pipeline)
+        cursor = await collection.aggregate(pipeline)
+        result = await cursor.to_list()
+        if not result:
+            return self.empty_columns(group_by, unit)
+
+        # Back to the dimension names requested by the caller
+        result = result[0]
+        response = {'time': result['time']} if unit else {}
+        for i, dimension in enumerate(group_by):
+            response[dimension] = result[f'd{i}']
+        response['count'] = result['count']
+        return response
@@ -0,0 +1,106 @@
+import asyncio
+
+from decouple import config
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+from storage import storage_mode
+
+
+def declared_indexes():
+    """
+        Indexes the application relies on, by collection.
+        Log indexes follow the filters of consult_filtered_logs: company_id first, then the
+        (received_at, _id) search order so paginated searches never sort in memory.
+    """
+    indexes = {
+        config('COLLECTION_LOGS'): [
+            IndexModel([('company_id', ASCENDING), ('received_at', DESCENDING), ('_id', DESCENDING)],
+                       name='company_received_at'),
+            IndexModel([('company_id', ASCENDING), ('log.level', ASCENDING),
+                        ('received_at', DESCENDING), ('_id', DESCENDING)],
+                       name='company_level_received_at'),
+            # log.tags is an array, so this is a multikey index
+            IndexModel([('company_id', ASCENDING), ('log.tags', ASCENDING),
+                        ('received_at', DESCENDING), ('_id', DESCENDING)],
+                       name='company_tags_received_at'),
+        ],
+        config('COLLECTION_COMPANIES'): [
+            IndexModel([('company_name', ASCENDING)], name='company_name_unique', unique=True),
+        ],
+    }
+    if storage_mode() == 'plain':
+        # Per-company retention: expires_at is set at ingest only for companies with retention_days
+        indexes[config('COLLECTION_LOGS')].append(
+            IndexModel([('expires_at', ASCENDING)], name='expires_at_ttl', expireAfterSeconds=0))
+        # Full-text search (not supported on time-series collections). The company_id prefix keeps each
+        # search inside one tenant; the received_at suffix lets time windows be checked on index entries.
+        indexes[config('COLLECTION_LOGS')].append(
+            IndexModel([('company_id', ASCENDING), ('log.message', TEXT), ('log.event.reason', TEXT),
+                        ('received_at', DESCENDING)],
+                       name='company_message_text', weights={'log.message': 10, 'log.event.reason': 3},
+                       default_language=config('TEXT_SEARCH_LANGUAGE', default='none')))
+    if config('LOG_ROLLUPS', default=False, cast=bool):
+        # Identifies a rollup document ($inc upserts and compaction $merge) and serves the range reads
+        indexes[config('COLLECTION_ROLLUPS', default='log_rollups')] = [
+            IndexModel([('company_id', ASCENDING), ('unit', ASCENDING), ('bucket', ASCENDING),
+                        ('level', ASCENDING), ('service', ASCENDING)], name='rollup_key', unique=True),
+        ]
+    return indexes
+
+
+class IndexManager:
+    """
+        Creates the declared indexes (idempotent: existing identical indexes are left untouched)
+        and reports declared indexes that are missing and existing ones that are never used.
+    """
+
+    def __init__(self, db, indexes=None):
+        self.db = db
+        self.indexes = indexes if indexes is not None else declared_indexes()
+
+    async def ensure(self):
+        created = {}
+        for collection_name, models in self.indexes.items():
+            try:
+                created[collection_name] = await self.db[collection_name].create_indexes(models)
+            except OperationFailure as e:
+                # e.g. an index with the same name but another definition, or duplicated company names
+                print(f"No se pudieron crear los índices de {collection_name}: {e}")
+        return created
+
+    async def report(self):
+        report = {}
+        for collection_name, models in self.indexes.items():
+            collection = self.db[collection_name]
+            declared = {model.document['name'] for model in models}
+
+            try:
+                existing = {index['name'] async for index in await collection.list_indexes()}
+                usage = {stat['name']: stat['accesses']['ops']
+                         async for stat in await collection.aggregate([{'$indexStats': {}}])}
+            except PyMongoError as e:
+                report[collection_name] = {'error': str(e)}
+                continue
+
+            report[collection_name] = {
+                'missing': sorted(declared - existing),
+                'unused': sorted(name for name, ops in usage.items() if ops == 0 and name != '_id_'),
+                'undeclared': sorted(existing - declared - {'_id_'}),
+            }
+        return report
+
+
+async def main():
+    from db_nosql_async import AsyncNosql
+
+    nosql = AsyncNosql()
+    manager = IndexManager(nosql.db)
+    try:
+        print(await manager.ensure())
+        print(await manager.report())
+    finally:
+        await nosql.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
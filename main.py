@@ -1,9 +1,21 @@
 import uvicorn
+from contextlib import asynccontextmanager
 from routers import router
+from profiling import RequestProfiler
 from fastapi import FastAPI
 from __version__ import __version__
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await router.service.start()
+    yield
+    # Enviamos las alertas pendientes, vaciamos el buffer de escritura y cerramos el cliente
+    await router.service.close()
+
+app = FastAPI(lifespan=lifespan)
+# Slow and profiled requests are kept for /admin/slow-requests
+app.add_middleware(RequestProfiler, explain=router.service.nosql.explain)
 
 # Definimos las rutas
 app.include_router(router.router)
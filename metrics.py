@@ -0,0 +1,218 @@
+import bisect
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from pymongo import monitoring
+
+# Seconds per stage of the current request, set by the request profiler (profiling.py) when it records it
+request_stages = ContextVar('request_stages', default=None)
+
+# Latency buckets in seconds, from sub-millisecond stages to slow SMTP sends
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """ Monotonic counter per label values."""
+
+    type = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Histogram:
+    """
+        Cumulative-bucket histogram per label values. observe() is a bisect and three additions
+        under a lock, cheap enough for every request.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, *label_values):
+        """ Context manager observing the seconds spent in its block."""
+        return Timer(self, label_values)
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, list(counts), total) for label_values, (counts, total) in self._values.items()]
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket', format_labels(self.labels, label_values, le), cumulative
+            yield f'{self.name}_sum', format_labels(self.labels, label_values), total
+            yield f'{self.name}_count', format_labels(self.labels, label_values), cumulative
+
+
+class Gauge:
+    """ Value read when the metrics are rendered: collect() returns {label values: value}."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, collect, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.collect = collect
+
+    def samples(self):
+        for label_values, value in self.collect().items():
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Timer:
+
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.started
+        self.histogram.observe(elapsed, *self.label_values)
+        add_request_stage('.'.join(self.label_values), elapsed)
+
+
+def add_request_stage(name, seconds):
+    stages = request_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def threadpool_usage():
+    """ Threads of the run_in_threadpool limiter in use / available, and tasks waiting for one."""
+    try:
+        from anyio import to_thread
+        limiter = to_thread.current_default_thread_limiter()
+        statistics = limiter.statistics()
+    except Exception:  # outside an event loop
+        return {}
+    return {('busy',): statistics.borrowed_tokens,
+            ('capacity',): limiter.total_tokens,
+            ('waiting',): statistics.tasks_waiting}
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'logdata_stage_seconds', 'Time spent in each stage of the ingest, search and token checks.', ('stage',)))
+MONGO_OPERATION_SECONDS = REGISTRY.register(Histogram(
+    'logdata_mongo_operation_seconds', 'MongoDB command latency by collection and operation.',
+    ('collection', 'operation', 'outcome')))
+SMTP_SEND_SECONDS = REGISTRY.register(Histogram(
+    'logdata_smtp_send_seconds', 'Time to send one alert email over a pooled SMTP connection.', ('outcome',)))
+LOGS_INGESTED = REGISTRY.register(Counter(
+    'logdata_logs_ingested_total', 'Logs stored per company.', ('company',)))
+LOGS_REJECTED = REGISTRY.register(Counter(
+    'logdata_logs_rejected_total', 'Logs of a batch MongoDB rejected, per company.', ('company',)))
+TOKEN_CACHE = REGISTRY.register(Counter(
+    'logdata_token_cache_total', 'Ingest token checks answered from the verified-token cache (hit) or not.',
+    ('result',)))
+THREADPOOL = REGISTRY.register(Gauge(
+    'logdata_threadpool_threads', 'Worker threads of run_in_threadpool: busy, capacity and tasks waiting.',
+    threadpool_usage, ('state',)))
+REGISTRY.register(Gauge('logdata_worker_pid', 'Process that answered this scrape (one per uvicorn worker).',
+                        lambda: {(): os.getpid()}))
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+        PyMongo command listener feeding MONGO_OPERATION_SECONDS. Runs inline in the driver,
+        so it only records: the collection is remembered from the started event by request id.
+    """
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        # getMore names its collection in 'collection'; the other commands under their own name
+        collection = event.command.get('collection' if event.command_name == 'getMore' else event.command_name)
+        self._collections[(event.connection_id, event.request_id)] = (
+            collection if isinstance(collection, str) else '')
+
+    def succeeded(self, event):
+        self._record(event, 'ok')
+
+    def failed(self, event):
+        self._record(event, 'error')
+
+    def _record(self, event, outcome):
+        collection = self._collections.pop((event.connection_id, event.request_id), '')
+        seconds = event.duration_micros / 1e6
+        MONGO_OPERATION_SECONDS.observe(seconds, collection, event.command_name, outcome)
+        # The asyncio client runs the command in the task of the request that sent it
+        add_request_stage(f'mongo.{event.command_name}', seconds)
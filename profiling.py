@@ -0,0 +1,240 @@
+import asyncio
+import hmac
+import random
+import sys
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from decouple import config
+from metrics import request_stages
+
+try:
+    import pyinstrument
+except ImportError:  # optional: the built-in stack sampler is used instead
+    pyinstrument = None
+
+# Capture of the request being served: filled in by the routes (note / note_query) and the stage timers
+current_capture = ContextVar('current_capture', default=None)
+
+
+def note(key, value):
+    """ Adds a field (filters...) to the capture of the current request."""
+    capture = current_capture.get()
+    if capture is not None:
+        capture[key] = value
+
+
+def note_query(collection, pipeline):
+    """ Remembers an aggregation of the current request, to explain() it if the request turns out slow."""
+    capture = current_capture.get()
+    if capture is not None:
+        capture.setdefault('queries', []).append({'collection': collection, 'pipeline': pipeline})
+
+
+def admin_authorized(token):
+    """ Whether token is ADMIN_TOKEN. Without ADMIN_TOKEN nothing is authorized."""
+    admin_token = config('ADMIN_TOKEN', default='')
+    return bool(admin_token and token) and hmac.compare_digest(token.encode(), admin_token.encode())
+
+
+def explain_summary(explain):
+    """
+        Short form of an aggregate explain(): plan stages, indexes used, whether it scans the
+        collection, and the pipeline stages MongoDB could not push down to the query.
+    """
+    planner = find_key(explain, 'queryPlanner') or {}
+    plan_stages, indexes = [], []
+
+    def walk(plan):
+        if not isinstance(plan, dict):
+            return
+        plan_stages.append(plan.get('stage'))
+        if plan.get('indexName'):
+            indexes.append(plan['indexName'])
+        for child in [plan.get('inputStage'), plan.get('queryPlan'), *plan.get('inputStages', [])]:
+            walk(child)
+
+    walk(planner.get('winningPlan'))
+    pipeline = [name for stage in explain.get('stages', []) for name in stage if name != '$cursor']
+    return {'plan': [stage for stage in plan_stages if stage],
+            'indexes': indexes,
+            'collection_scan': 'COLLSCAN' in plan_stages,
+            'rejected_plans': len(planner.get('rejectedPlans', [])),
+            'pipeline': pipeline}
+
+
+def find_key(value, key):
+    if isinstance(value, dict):
+        if key in value:
+            return value[key]
+        children = value.values()
+    elif isinstance(value, list):
+        children = value
+    else:
+        return None
+    for child in children:
+        found = find_key(child, key)
+        if found is not None:
+            return found
+    return None
+
+
+class SlowRequestLog:
+    """ The most recent max_entries captures of this process (oldest dropped first)."""
+
+    def __init__(self, max_entries=200):
+        self._entries = deque(maxlen=max_entries)
+
+    def add(self, capture):
+        self._entries.append(capture)
+
+    def recent(self, limit=50):
+        return list(reversed(self._entries))[:limit]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+SLOW_REQUESTS = SlowRequestLog(config('SLOW_REQUEST_LOG_SIZE', default=200, cast=int))
+
+
+class StackSampler:
+    """
+        Samples the stack of the event loop thread every interval seconds from a helper thread and
+        counts identical stacks. Requests share the loop, so concurrent requests appear in the samples.
+    """
+
+    def __init__(self, interval=0.001, max_depth=40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.counts = {}
+        self.samples = 0
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})')
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def result(self, top=25):
+        stacks = sorted(self.counts.items(), key=lambda item: -item[1])[:top]
+        return {'engine': 'sampler', 'interval': self.interval, 'samples': self.samples,
+                'stacks': [{'count': count, 'stack': stack} for stack, count in stacks]}
+
+
+class PyinstrumentProfiler:
+    """ pyinstrument in async mode: only the time of the profiled request's task is attributed to it."""
+
+    def __init__(self, interval=0.001):
+        self.profiler = pyinstrument.Profiler(interval=interval, async_mode='enabled')
+
+    def start(self):
+        self.profiler.start()
+
+    def stop(self):
+        self.profiler.stop()
+
+    def result(self):
+        return {'engine': 'pyinstrument', 'text': self.profiler.output_text(unicode=False, color=False)}
+
+
+class RequestProfiler:
+    """
+        ASGI middleware. Requests slower than SLOW_REQUEST_SECONDS are written to SLOW_REQUESTS with
+        their route, status, noted filters, stage timings and an explain() summary of their queries.
+        A request with the header X-Profile: <ADMIN_TOKEN> (or a PROFILE_SAMPLE_RATE fraction of them)
+        also runs a sampling profiler and is always recorded.
+    """
+
+    def __init__(self, app, explain=None, log=SLOW_REQUESTS):
+        self.app = app
+        self.explain = explain
+        self.log = log
+        self.threshold = config('SLOW_REQUEST_SECONDS', default=1.0, cast=float)
+        self.sample_rate = config('PROFILE_SAMPLE_RATE', default=0.0, cast=float)
+        self.interval = config('PROFILE_INTERVAL', default=0.001, cast=float)
+        self._explains = set()
+
+    def wants_profile(self, scope):
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        for name, value in scope['headers']:
+            if name == b'x-profile':
+                return admin_authorized(value.decode('latin-1'))
+        return False
+
+    def profiler(self):
+        return PyinstrumentProfiler(self.interval) if pyinstrument else StackSampler(self.interval)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        capture = {'method': scope['method'], 'path': scope['path'], 'query_string': scope['query_string'].decode(),
+                   'status': 500, 'stages': {}}
+
+        async def send_and_note_status(message):
+            if message['type'] == 'http.response.start':
+                capture['status'] = message['status']
+            await send(message)
+
+        profiler = self.profiler() if self.wants_profile(scope) else None
+        capture_token = current_capture.set(capture)
+        stages_token = request_stages.set(capture['stages'])
+        started = time.perf_counter()
+        if profiler:
+            profiler.start()
+        try:
+            await self.app(scope, receive, send_and_note_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            if profiler:
+                profiler.stop()
+            current_capture.reset(capture_token)
+            request_stages.reset(stages_token)
+            if profiler or elapsed >= self.threshold:
+                self.record(capture, elapsed, profiler)
+
+    def record(self, capture, elapsed, profiler):
+        capture['started_at'] = datetime.now(timezone.utc).isoformat()
+        capture['duration_ms'] = round(elapsed * 1000, 3)
+        capture['stages'] = {name: round(seconds * 1000, 3) for name, seconds in capture['stages'].items()}
+        if profiler:
+            capture['profile'] = profiler.result()
+        self.log.add(capture)
+
+        if capture.get('queries') and self.explain:
+            # After the response: the client does not wait for the explain() round trips
+            capture['explain'] = 'pending'
+            task = asyncio.get_running_loop().create_task(self.add_explain(capture))
+            self._explains.add(task)
+            task.add_done_callback(self._explains.discard)
+
+    async def add_explain(self, capture):
+        summaries = []
+        for query in capture['queries']:
+            try:
+                summaries.append(explain_summary(await self.explain(query['collection'], query['pipeline'])))
+            except Exception as e:
+                summaries.append({'error': str(e)})
+        capture['explain'] = summaries
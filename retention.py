@@ -0,0 +1,254 @@
+import gzip
+import json
+import os
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from decouple import config
+
+
+def default_policy():
+    """ (LOG_HOT_DAYS, LOG_RETENTION_DAYS): read once by the callers, not for every log."""
+    return config('LOG_HOT_DAYS', default=0, cast=int), config('LOG_RETENTION_DAYS', default=0, cast=int)
+
+
+def retention_policy(company, defaults):
+    """
+        (hot_days, retention_days) of a company: days its logs stay in MongoDB before being archived,
+        and days they are kept at all. Company 'retention' settings override the defaults
+        (default_policy()); None disables.
+    """
+    policy = company.get('retention') or {}
+    hot_days = policy.get('hot_days', defaults[0])
+    retention_days = policy.get('retention_days', defaults[1])
+    return hot_days or None, retention_days or None
+
+
+def expires_at(company, received_at, defaults):
+    """ Value of the TTL-indexed expires_at field of a new log, or None when it never expires."""
+    _, retention_days = retention_policy(company, defaults)
+    return received_at + timedelta(days=retention_days) if retention_days else None
+
+
+def to_archive(document):
+    return json.dumps({**document, '_id': str(document['_id']), 'received_at': document['received_at'].isoformat()},
+                      default=str)
+
+
+def from_archive(line):
+    document = json.loads(line)
+    document['_id'] = ObjectId(document['_id'])
+    document['received_at'] = datetime.fromisoformat(document['received_at'])
+    return document
+
+
+def matches(document, query):
+    """
+        Evaluates the queries built by Service.build_log_query (equality, $in, $gte, $lte)
+        against an archived document.
+    """
+    for path, condition in query.items():
+        value = document
+        for part in path.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        if '$in' in condition:
+            values = value if isinstance(value, list) else [value]
+            if not set(values) & set(condition['$in']):
+                return False
+        if '$gte' in condition and not (value is not None and value >= condition['$gte']):
+            return False
+        if '$lte' in condition and not (value is not None and value <= condition['$lte']):
+            return False
+    return True
+
+
+class LogArchive:
+    """
+        Archived logs on local disk, one gzip NDJSON file per company and day:
+        <root>/<company_id>/<YYYY>/<MM>/<DD>.ndjson.gz, described by <root>/manifest.json
+        ({company_id: {day: {file, count, first, last}}}) so reads only open the days they need.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, 'manifest.json')
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def save_manifest(self, manifest):
+        os.makedirs(self.root, exist_ok=True)
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    @staticmethod
+    def partition_file(company_id, day):
+        return os.path.join(company_id, f'{day:%Y}', f'{day:%m}', f'{day:%d}.ndjson.gz')
+
+    def read_partition(self, entry):
+        with gzip.open(os.path.join(self.root, entry['file']), 'rt', encoding='utf-8') as f:
+            return [from_archive(line) for line in f if line.strip()]
+
+    def write(self, company_id, documents, checked_days=None):
+        """
+                Appends documents to their day partitions (a new gzip member per write) and updates the manifest.
+                Documents already in a partition (a run interrupted before deleting them) are skipped. The days
+                of checked_days are not read back for that, and the days written are added to it: a caller that
+                only writes new documents from then on reads each partition at most once.
+        """
+        manifest = self.load_manifest()
+        partitions = manifest.setdefault(company_id, {})
+
+        by_day = {}
+        for document in documents:
+            by_day.setdefault(document['received_at'].date(), []).append(document)
+
+        for day, day_documents in by_day.items():
+            entry = partitions.get(day.isoformat())
+            if entry and (checked_days is None or day not in checked_days):
+                archived = {document['_id'] for document in self.read_partition(entry)}
+                day_documents = [document for document in day_documents if document['_id'] not in archived]
+            if checked_days is not None:
+                checked_days.add(day)
+            if not day_documents:
+                continue
+            if not entry:
+                entry = {'file': self.partition_file(company_id, day), 'count': 0}
+
+            path = os.path.join(self.root, entry['file'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with gzip.open(path, 'at', encoding='utf-8') as f:
+                f.writelines(to_archive(document) + '\n' for document in day_documents)
+
+            times = [document['received_at'].isoformat() for document in day_documents]
+            entry['count'] += len(day_documents)
+            entry['first'] = min(times + [entry.get('first', times[0])])
+            entry['last'] = max(times + [entry.get('last', times[0])])
+            partitions[day.isoformat()] = entry
+
+        self.save_manifest(manifest)
+
+    def drop_before(self, company_id, day):
+        """ Deletes the partitions of the days before day. Returns the number of logs removed."""
+        manifest = self.load_manifest()
+        partitions = manifest.get(company_id, {})
+        removed = 0
+        for key in [key for key in partitions if key < day.isoformat()]:
+            entry = partitions.pop(key)
+            try:
+                os.remove(os.path.join(self.root, entry['file']))
+            except FileNotFoundError:
+                pass
+            removed += entry['count']
+        if removed:
+            self.save_manifest(manifest)
+        return removed
+
+    def search(self, company_id, query, start, end, before=None, limit=100):
+        """
+                Newest first archived logs of the company received in [start, end] that match the query,
+                strictly before the (received_at, _id) position when given, in the search response shape
+                (the last two with their position, like MongoDB's pages).
+        """
+        found = []
+        partitions = self.load_manifest().get(company_id, {})
+        for key in sorted(partitions, reverse=True):
+            entry = partitions[key]
+            if entry['first'] > end.isoformat() or entry['last'] < start.isoformat():
+                continue
+
+            documents = [document for document in self.read_partition(entry)
+                         if start <= document['received_at'] <= end and matches(document, query)
+                         and (before is None or (document['received_at'], document['_id']) < before)]
+            documents.sort(key=lambda document: (document['received_at'], document['_id']), reverse=True)
+            found += documents[:limit - len(found)]
+            if len(found) >= limit:
+                break
+
+        results = [dict(document.get('log', {})) for document in found]
+        for log, document in zip(results[-2:], found[-2:]):
+            log['position'] = {'received_at': document['received_at'], '_id': document['_id']}
+        return results
+
+
+class LogArchiver:
+    """
+        Moves the logs older than each company's hot window from MongoDB to a LogArchive
+        (written before deleting, batch_size logs at a time) and drops archived days past retention.
+        Uses the synchronous client: it runs as a script (python retention.py), e.g. from cron.
+    """
+
+    def __init__(self, db, archive, batch_size=5000):
+        self.db = db
+        self.archive = archive
+        self.batch_size = batch_size
+
+    def archive_company(self, company, cutoff):
+        logs = self.db[config('COLLECTION_LOGS')]
+        cursor = logs.find({'company_id': company['company_id'], 'received_at': {'$lt': cutoff}})
+        archived, batch = 0, []
+        # The cursor yields each log once: a day checked for already archived logs needs no second check
+        checked_days = set()
+
+        def move(batch):
+            self.archive.write(company['company_id'], batch, checked_days)
+            logs.delete_many({'_id': {'$in': [document['_id'] for document in batch]}})
+
+        for document in cursor.sort('received_at', 1).batch_size(self.batch_size):
+            batch.append(document)
+            if len(batch) >= self.batch_size:
+                move(batch)
+                archived += len(batch)
+                batch = []
+        if batch:
+            move(batch)
+            archived += len(batch)
+        return archived
+
+    def run(self, now=None):
+        now = now or datetime.now()
+        summary = {}
+        defaults = default_policy()
+        for company in self.db[config('COLLECTION_COMPANIES')].find({}):
+            hot_days, retention_days = retention_policy(company, defaults)
+            archived = dropped = 0
+            if hot_days:
+                # Whole days only: a later run appends to an archived day only after an interrupted run
+                cutoff = (now - timedelta(days=hot_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+                archived = self.archive_company(company, cutoff)
+            if retention_days:
+                dropped = self.archive.drop_before(company['company_id'], (now - timedelta(days=retention_days)).date())
+            if archived or dropped:
+                summary[company['company_name']] = {'archived': archived, 'dropped': dropped}
+        return summary
+
+
+def main():
+    from conection import Connection
+
+    root = config('ARCHIVE_DIR', default='')
+    if not root:
+        raise SystemExit('ARCHIVE_DIR no está configurado.')
+
+    conn = Connection()
+    try:
+        archiver = LogArchiver(conn.get_database(), LogArchive(root),
+                               batch_size=config('ARCHIVE_BATCH_SIZE', default=5000, cast=int))
+        print(archiver.run())
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+ROLLUP_UNITS = {'minute': timedelta(minutes=1), 'hour': timedelta(hours=1), 'day': timedelta(days=1)}
+# Unit each compacted level is built from
+COMPACTION_SOURCES = {'hour': 'minute', 'day': 'hour'}
+# Fields that identify a rollup document (unique index)
+ROLLUP_KEY = ['company_id', 'unit', 'bucket', 'level', 'service']
+
+
+def truncate(moment, unit):
+    if unit == 'minute':
+        return moment.replace(second=0, microsecond=0)
+    if unit == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def ceil(moment, unit):
+    floor = truncate(moment, unit)
+    return floor if floor == moment else floor + ROLLUP_UNITS[unit]
+
+
+def rollup_segments(start, end, watermarks, max_unit='day'):
+    """
+        Splits [start, end) into (unit, from, to) ranges: whole compacted day/hour buckets where
+        the watermarks allow it (never coarser than max_unit), minute rollups for the edges.
+    """
+    if start >= end:
+        return []
+
+    for unit in ('day', 'hour'):
+        if ROLLUP_UNITS[unit] > ROLLUP_UNITS[max_unit] or not watermarks.get(unit):
+            continue
+        first = ceil(start, unit)
+        last = min(truncate(end, unit), watermarks[unit])
+        if first < last:
+            finer = 'hour' if unit == 'day' else 'minute'
+            return (rollup_segments(start, first, watermarks, finer) +
+                    [(unit, first, last)] +
+                    rollup_segments(last, end, watermarks, finer))
+
+    return [('minute', start, end)]
+
+
+class RollupStore:
+    """
+        Pre-aggregated log counts {company_id, unit, bucket, level, service, count} in one collection.
+        Minute rollups are incremented at ingest; hour and day rollups are compacted from the unit
+        below once their buckets are closed. One watermark document per unit (company_id and bucket
+        None) records up to where that unit has been compacted, and the minute one since when logs
+        are counted: nothing is backfilled, so earlier ranges must be counted from the logs.
+    """
+
+    # The minute watermark: counting_since, the first minute counted in full
+    START_MARK = {'company_id': None, 'unit': 'minute', 'bucket': None, 'level': None, 'service': None}
+
+    def __init__(self, collection, grace=120):
+        self.collection = collection
+        self.grace = timedelta(seconds=grace)  # Minute buckets may still receive counters for this long
+
+    async def increment(self, counters):
+        """
+                counters: {(company_id, minute, level, service): count}, written as unordered $inc upserts.
+        """
+        requests = [UpdateOne({'company_id': company_id, 'unit': 'minute', 'bucket': bucket,
+                               'level': level, 'service': service},
+                              {'$inc': {'count': count}}, upsert=True)
+                    for (company_id, bucket, level, service), count in counters.items()]
+        if requests:
+            await self.collection.bulk_write(requests, ordered=False)
+
+    async def watermarks(self):
+        return {document['unit']: document['compacted_until']
+                async for document in self.collection.find({'company_id': None, 'bucket': None,
+                                                            'compacted_until': {'$exists': True}})}
+
+    async def mark_start(self, started_at):
+        """
+                Records that logs are counted from the minute after started_at (that one may be partial).
+                $min keeps the earliest start when several workers or restarts record one.
+        """
+        await self.collection.update_one(self.START_MARK, {'$min': {'counting_since': ceil(started_at, 'minute')}},
+                                         upsert=True)
+
+    async def counting_since(self):
+        """ First minute the rollups count in full, or None when counting has not been recorded yet."""
+        document = await self.collection.find_one(self.START_MARK)
+        return document.get('counting_since') if document else None
+
+    async def compact(self, unit, now=None):
+        """
+                Rebuilds the closed unit buckets after the watermark from the source unit and moves the
+                watermark. Buckets are replaced, not incremented, so running it twice is harmless.
+        """
+        source = COMPACTION_SOURCES[unit]
+        marks = await self.watermarks()
+
+        until = truncate((now or datetime.now()) - self.grace, unit)
+        if source != 'minute':
+            # Only what the source unit already covers
+            if not marks.get(source):
+                return None
+            until = min(until, truncate(marks[source], unit))
+
+        since = marks.get(unit)
+        if since and since >= until:
+            return since
+
+        bucket = {'$lt': until}
+        if since:
+            bucket['$gte'] = since
+        pipeline = [{'$match': {'unit': source, 'company_id': {'$ne': None}, 'bucket': bucket}},
+                    {'$group': {'_id': {'company_id': '$company_id',
+                                        'bucket': {'$dateTrunc': {'date': '$bucket', 'unit': unit}},
+                                        'level': '$level',
+                                        'service': '$service'},
+                                'count': {'$sum': '$count'}}},
+                    {'$replaceRoot': {'newRoot': {'$mergeObjects': ['$_id', {'unit': unit, 'count': '$count'}]}}},
+                    {'$merge': {'into': self.collection.name, 'on': ROLLUP_KEY,
+                                'whenMatched': 'replace', 'whenNotMatched': 'insert'}}]
+        cursor = await self.collection.aggregate(pipeline)
+        await cursor.to_list()
+
+        await self.collection.update_one({'company_id': None, 'unit': unit, 'bucket': None,
+                                          'level': None, 'service': None},
+                                         {'$set': {'compacted_until': until}}, upsert=True)
+        return until
+
+
+class RollupAggregator:
+    """
+        Coalesces per-minute log counters in memory and writes them with one batched $inc upsert per
+        key every flush_interval seconds (sooner when max_keys keys are pending). Every compact_interval
+        seconds it also runs the hour and day compactions. start() must be called from the running loop.
+    """
+
+    def __init__(self, store, flush_interval=5.0, max_keys=10000, compact_interval=300):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self.compact_interval = compact_interval
+        # Logs are counted from here on (see RollupStore.mark_start)
+        self.started_at = datetime.now()
+
+        self._counters = {}
+        self._stopping = False
+        self._task = None
+
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.compactions = 0
+
+    def add(self, document):
+        """
+                Counts a stored log document (received_at, company_id, log.level, log.service).
+        """
+        log = document['log']
+        key = (document['company_id'], truncate(document['received_at'], 'minute'),
+               log.get('level'), log.get('service'))
+        self._counters[key] = self._counters.get(key, 0) + 1
+
+    def start(self):
+        if self._task and not self._task.done():
+            return
+        self._stopping = False
+        self._task = asyncio.get_running_loop().create_task(self._run(), name='log-rollups')
+
+    async def flush(self):
+        counters, self._counters = self._counters, {}
+        if not counters:
+            return
+        try:
+            await self.store.increment(counters)
+            self.flushes += 1
+        except Exception as e:
+            # Keep the counts for the next flush
+            for key, count in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + count
+            self.failed_flushes += 1
+            print(f"Error al actualizar los rollups de logs: {e}")
+
+    async def compact(self):
+        try:
+            for unit in ('hour', 'day'):
+                await self.store.compact(unit)
+            self.compactions += 1
+        except Exception as e:
+            print(f"Error al compactar los rollups de logs: {e}")
+
+    async def _run(self):
+        last_flush = last_compaction = time.monotonic()
+        while not self._stopping:
+            await asyncio.sleep(min(self.flush_interval, 0.1))
+            now = time.monotonic()
+            if now - last_flush >= self.flush_interval or len(self._counters) >= self.max_keys:
+                await self.flush()
+                last_flush = now
+            if self.compact_interval and now - last_compaction >= self.compact_interval:
+                await self.compact()
+                last_compaction = now
+
+    async def stop(self):
+        """
+                Stops the background task and writes the pending counters.
+        """
+        self._stopping = True
+        if self._task:
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {'pending_keys': len(self._counters),
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+                'compactions': self.compactions}
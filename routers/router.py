@@ -1,10 +1,16 @@
 import services
 from services import Service
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from pydantic import BaseModel, EmailStr, Field, TypeAdapter, ValidationError
+from serialization import FastJSONResponse, fast_json_enabled, loads
+from typing import Dict, Literal, Optional, List
+from typing_extensions import TypedDict
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import JSONResponse
+from compression import compress_response, compress_stream, negotiate, read_body
+from metrics import REGISTRY, STAGE_SECONDS
+from profiling import SLOW_REQUESTS, admin_authorized, note
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer
 
 
@@ -16,11 +22,21 @@ security = HTTPBearer()
 class RegisterRequestSchema(BaseModel):
     email: EmailStr
 
+class AlertPolicySchema(BaseModel):
+    window_seconds: Optional[int] = Field(default=None, ge=0)  # 0 disables coalescing
+    immediate_limit: Optional[int] = Field(default=None, ge=1)  # Alerts sent right away per window
+
+class RetentionPolicySchema(BaseModel):
+    hot_days: Optional[int] = Field(default=None, ge=1)  # Days in MongoDB before being archived
+    retention_days: Optional[int] = Field(default=None, ge=1)  # Days before logs are deleted everywhere
+
 class CompanyRegisterSchema(BaseModel):
     token: str
     company_name: str
     company_public_key: str  # PEM format as text
     alert_emails: list[EmailStr]  # List of valid emails
+    alert_policy: Optional[AlertPolicySchema] = None
+    retention: Optional[RetentionPolicySchema] = None
 
 # Log structure schema
 class EventShema(BaseModel):
@@ -45,6 +61,25 @@ class LogSchema(BaseModel):
     message: str
     tags: list
 
+def record_type(model):
+    """
+        TypedDict with the fields (and name) of a pydantic model, nested models included: validating
+        into it skips building models and dumping them again. Same name, so both JSON schemas match.
+    """
+    fields = {}
+    for name, field in model.model_fields.items():
+        annotation = field.annotation
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            annotation = record_type(annotation)
+        fields[name] = annotation
+    return TypedDict(model.__name__, fields)
+
+LogRecord = record_type(LogSchema)
+
+log_adapter = TypeAdapter(LogSchema)
+log_record_adapter = TypeAdapter(LogRecord)
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
 class LogItem(BaseModel):
     timestamp: Optional[str]
     host: Optional[str]
@@ -57,47 +92,255 @@ class LogItem(BaseModel):
 
 class LogResponse(BaseModel):
     logs: List[LogItem]
+    next_cursor: Optional[str] = None  # Pass it back as 'cursor' to get the next page
 
-class LogSearchRequest(BaseModel):
+class LogFilters(BaseModel):
     company_id: Optional[str]
     level: Optional[str]
     user: Optional[str]
     start_date: Optional[datetime]
     end_date: Optional[datetime]
     tags: Optional[List[str]]
+    text: Optional[str] = None  # Words or "quoted phrases" in log.message / log.event.reason (needs company_id)
+    text_window_hours: Optional[int] = Field(default=None, ge=1)  # Only match text in the last N hours
+
+class LogSearchRequest(LogFilters):
+    page_size: Optional[int] = Field(default=None, ge=1)
+    cursor: Optional[str] = None
+
+class LogExportRequest(LogFilters):
+    compress: bool = False  # gzip the NDJSON stream
+
+class LogAnalyticsRequest(LogFilters):
+    group_by: List[Literal['level', 'service', 'host', 'event.category', 'tag']] = []
+    bucket: Optional[Literal['second', 'minute', 'hour', 'day', 'week', 'month']] = 'minute'  # None: no time axis
+    bucket_size: int = Field(default=1, ge=1)  # e.g. bucket='minute', bucket_size=5 -> 5 minute buckets
+
+class LogAnalyticsResponse(BaseModel):
+    bucket: Optional[str]
+    bucket_size: Optional[int]
+    group_by: List[str]
+    columns: Dict[str, list]  # One array per column ('time', each dimension, 'count'), same length
+
+def request_body_schema(model):
+    """
+        openapi_extra documenting a model as the JSON body of a route that reads the raw body.
+    """
+    schema = model.model_json_schema()
+    definitions = schema.pop('$defs', {})
+
+    def inline(node):
+        if isinstance(node, dict):
+            if '$ref' in node:
+                return inline(definitions[node['$ref'].split('/')[-1]])
+            return {key: inline(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [inline(value) for value in node]
+        return node
+
+    return {'requestBody': {'required': True, 'content': {'application/json': {'schema': inline(schema)}}}}
+
+def validate_log_json(raw):
+    if fast_json_enabled():
+        return log_record_adapter.validate_json(raw)
+    return log_adapter.validate_json(raw).model_dump()
+
+def validate_log_python(item):
+    if fast_json_enabled():
+        return log_record_adapter.validate_python(item)
+    return log_adapter.validate_python(item).model_dump()
+
+def parse_log(body: bytes):
+    """
+        Validates a single JSON log straight from the raw body. Errors are reported like FastAPI's (422).
+    """
+    try:
+        return validate_log_json(body)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, 'loc': ('body', *error['loc'])}
+                                      for error in e.errors(include_url=False)], body=body)
+
+def search_response(result):
+    """
+        Search results as LogItem lists. MongoDB already returns only the log fields (see
+        AsyncNosql.search_log_in_db), so in fast mode they are encoded as they are: they were validated on ingest.
+    """
+    if not fast_json_enabled():
+        return JSONResponse(LogResponse.model_validate(result).model_dump(mode='json'))
+    return FastJSONResponse(result)
+
+def parse_log_batch(body: bytes, content_type: str):
+    """
+        Validates a JSON array or NDJSON body in a single pass.
+        Returns the valid logs (with their position in the batch) and the rejected positions.
+    """
+    if content_type.split(';')[0].strip().lower() in NDJSON_CONTENT_TYPES:
+        items = [line for line in body.splitlines() if line.strip()]
+        validate = validate_log_json
+    else:
+        try:
+            items = loads(body)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Body must be a JSON array or NDJSON.')
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail='Body must be a JSON array or NDJSON.')
+        validate = validate_log_python
+
+    if not items:
+        raise HTTPException(status_code=400, detail='Empty batch.')
+    if len(items) > service.settings.log_batch_max_items:
+        raise HTTPException(status_code=413, detail='Too many logs in a single batch.')
+
+    accepted, rejected = [], {}
+    for position, item in enumerate(items):
+        try:
+            accepted.append((position, validate(item)))
+        except ValidationError as e:
+            rejected[position] = loads(e.json(include_url=False, include_input=False))
+    return accepted, rejected
 
 # Endpoints
 @router.post('/request_registration')
-def request_registration(data: RegisterRequestSchema):
+async def request_registration(data: RegisterRequestSchema):
     token = service.generate_registration_token(data.email)
-    service.send_registration_email(data.email, token)
+    await service.send_registration_email(data.email, token)
     return {'message': 'A temporary registration email has been sent to your email.'}
 
 @router.post("/register_company")
-def register_company(data: CompanyRegisterSchema):
+async def register_company(data: CompanyRegisterSchema):
     try:
         service.verify_registration_token(data.token)
-        company_id = service.register_company(data)
+        company_id = await service.register_company(data)
         return {'message': 'Company successfully registered.', 'company_id': company_id}
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.post("/logs", dependencies=[Depends(security)])
-def receive_logs(log: LogSchema, payload=Depends(service.verify_logs_token)):
+@router.post("/logs", dependencies=[Depends(security)], openapi_extra=request_body_schema(LogSchema))
+async def receive_logs(request: Request, payload=Depends(service.verify_logs_token)):
+    with STAGE_SECONDS.time('ingest.read_body'):
+        body = await read_body(request)
+    with STAGE_SECONDS.time('ingest.validate'):
+        log = parse_log(body)
     try:
         company_name = payload['iss']
-        service.process_log(log.model_dump(), company_name)
+        await service.process_log(log, company_name)
         return {'message': 'Log successfully received', 'company': company_name}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/logs/batch", dependencies=[Depends(security)])
+async def receive_logs_batch(request: Request, payload=Depends(service.verify_logs_token)):
+    company_name = payload['iss']
+    with STAGE_SECONDS.time('batch.read_body'):
+        body = await read_body(request)
+    with STAGE_SECONDS.time('batch.validate'):
+        valid, rejected = parse_log_batch(body, request.headers.get('content-type', ''))
+    total = len(valid) + len(rejected)
+
+    try:
+        logs = [log for _, log in valid]
+        write_errors = await service.process_logs_batch(logs, company_name)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    for index, (position, _) in enumerate(valid):
+        if index in write_errors:
+            rejected[position] = [{'type': 'write_error', 'msg': write_errors[index]}]
+
+    results = [{'index': position, 'status': 'rejected', 'errors': rejected[position]}
+               if position in rejected else {'index': position, 'status': 'accepted'}
+               for position in range(total)]
+
+    return {'message': 'Batch processed', 'company': company_name,
+            'accepted': total - len(rejected), 'rejected': len(rejected), 'results': results}
+
+@router.get('/ready')
+async def readiness():
+    """ 200 once the background warm-up reached MongoDB, 503 until then (for load balancer checks)."""
+    if service.nosql.ready:
+        return {'status': 'ready'}
+    return JSONResponse(status_code=503, content={'status': 'starting', 'error': service.nosql.warmup_error})
+
+@router.get('/metrics')
+async def metrics():
+    """ Prometheus metrics of this worker process (each uvicorn worker keeps its own)."""
+    return Response(REGISTRY.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+@router.get('/admin/slow-requests')
+async def slow_requests(limit: int = 50, x_admin_token: Optional[str] = Header(default=None)):
+    """ Recent slow or profiled requests of this worker process, newest first (needs X-Admin-Token)."""
+    if not admin_authorized(x_admin_token):
+        raise HTTPException(status_code=403, detail='Admin token required.')
+    return FastJSONResponse({'count': len(SLOW_REQUESTS), 'requests': SLOW_REQUESTS.recent(limit)})
+
+@router.get('/logs/buffer/stats')
+async def write_buffer_stats():
+    if not service.nosql.write_buffer:
+        return {'mode': 'direct'}
+    return {'mode': 'buffered', **service.nosql.write_buffer.stats()}
+
 @router.post('/logs/search', response_model=LogResponse)
-def search_logs(request: LogSearchRequest, payload=Depends(service.verify_logs_token)):
+async def search_logs(request: LogSearchRequest, payload=Depends(service.verify_logs_token),
+                      accept_encoding: Optional[str] = Header(default=None)):
     try:
         filters = request.model_dump(exclude_none=True)
-        logs = service.consult_filtered_logs(filters)
-        return {'logs': logs}
+        note('filters', filters)
+        with STAGE_SECONDS.time('search.query'):
+            result = await service.consult_filtered_logs(filters)
+        with STAGE_SECONDS.time('search.render'):
+            return compress_response(search_response(result), accept_encoding)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f'Error while searching logs: {str(e)}')
+
+async def issuer_filters(filters, payload):
+    """ Scopes the filters to the company that issued the token: 403 when they name another company."""
+    company = await service.get_company(payload['iss'])
+    if filters.get('company_id', company['company_id']) != company['company_id']:
+        raise HTTPException(status_code=403, detail='Token is not valid for this company.')
+    filters['company_id'] = company['company_id']
+    return filters
+
+@router.post('/logs/export')
+async def export_logs(request: LogExportRequest, payload=Depends(service.verify_logs_token),
+                      accept_encoding: Optional[str] = Header(default=None)):
+    try:
+        filters = await issuer_filters(request.model_dump(exclude_none=True, exclude={'compress'}), payload)
+        chunks = service.export_filtered_logs(filters, compress=request.compress)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f'Error while exporting logs: {str(e)}')
+
+    if request.compress:
+        return StreamingResponse(chunks, media_type='application/gzip',
+                                 headers={'Content-Disposition': 'attachment; filename="logs.ndjson.gz"'})
+
+    # Exports are large by nature: compressed whenever the client accepts it, without a size threshold
+    encoding = negotiate(accept_encoding)
+    if encoding:
+        return StreamingResponse(compress_stream(chunks, encoding), media_type='application/x-ndjson',
+                                 headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
+    return StreamingResponse(chunks, media_type='application/x-ndjson')
+
+@router.post('/logs/analytics', response_model=LogAnalyticsResponse)
+async def analyze_logs(request: LogAnalyticsRequest, payload=Depends(service.verify_logs_token),
+                       accept_encoding: Optional[str] = Header(default=None)):
+    try:
+        filters = await issuer_filters(request.model_dump(exclude_none=True), payload)
+        note('filters', filters)
+        result = await service.analyze_logs(filters)
+        if not fast_json_enabled():
+            result = JSONResponse(LogAnalyticsResponse.model_validate(result).model_dump(mode='json'))
+        else:
+            result = FastJSONResponse(result)
+        return compress_response(result, accept_encoding)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f'Error while analyzing logs: {str(e)}')
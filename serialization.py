@@ -0,0 +1,37 @@
+import json
+
+from fastapi.responses import Response
+from pydantic_core import to_json
+from settings import get_settings
+
+try:
+    import orjson
+except ImportError:  # optional: pydantic_core's encoder is used instead
+    orjson = None
+
+
+def fast_json_enabled():
+    """ FAST_JSON: validate request bodies straight into dicts and encode responses without response models."""
+    return get_settings().fast_json
+
+
+def dumps(value):
+    """ Compact JSON bytes. Values JSON does not know (ObjectId, datetime...) are encoded as str()."""
+    if orjson:
+        return orjson.dumps(value, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return to_json(value, fallback=str)
+
+
+def loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+class FastJSONResponse(Response):
+    """
+        JSON response encoded with dumps(). The content is sent as it is: it is not validated
+        against the route response_model, so it must already have the documented shape.
+    """
+    media_type = 'application/json'
+
+    def render(self, content):
+        return dumps(content)
@@ -1,23 +1,80 @@
+import base64
+import hashlib
 import json
 
 import jwt
 import smtplib
+import time
 import uuid
+import zlib
+from bson import ObjectId
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
+from alerts import AlertCoalescer, AlertDispatcher, SMTPPool
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from datetime import datetime, timedelta, timezone
-from db_nosql import Nosql
+from cache import TTLCache
+from metrics import LOGS_INGESTED, LOGS_REJECTED, STAGE_SECONDS, TOKEN_CACHE
+from db_nosql_async import AsyncNosql
+from retention import LogArchive
+from serialization import dumps
+from settings import get_settings
 from decouple import config
 from fastapi import HTTPException, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBearer
 
 security = HTTPBearer()
 
 class Service:
     def __init__(self):
-        self.nosql = Nosql()
+        self.settings = get_settings()
+        self.nosql = AsyncNosql(self.settings)
+        # Issuer public keys already loaded as RSA objects, keyed by the token 'iss'
+        self.issuer_keys = TTLCache(max_size=config('ISSUER_KEY_CACHE_SIZE', default=1024, cast=int),
+                                    ttl=config('ISSUER_KEY_CACHE_TTL', default=300, cast=int),
+                                    negative_ttl=config('ISSUER_KEY_NEGATIVE_TTL', default=30, cast=int))
+        # Verified ingest tokens (payload, issuer key), keyed by the SHA-256 of the token (see verify_logs_token)
+        self.verified_tokens = TTLCache(max_size=config('TOKEN_CACHE_SIZE', default=10000, cast=int),
+                                        ttl=config('TOKEN_CACHE_MAX_TTL', default=3600, cast=int))
+        # Company documents (company_id, alert_emails...) used on the ingest path, keyed by company_name
+        self.companies = TTLCache(max_size=config('COMPANY_CACHE_SIZE', default=1024, cast=int),
+                                  ttl=config('COMPANY_CACHE_TTL', default=300, cast=int),
+                                  negative_ttl=config('COMPANY_CACHE_NEGATIVE_TTL', default=30, cast=int))
+        # /logs/search results by normalized query; live ranges are keyed by the company ingest generation
+        self.search_results = TTLCache(max_size=config('SEARCH_CACHE_SIZE', default=1024, cast=int),
+                                       ttl=config('SEARCH_CACHE_TTL', default=3600, cast=int))
+        self.search_generations = {}  # company_id (None: every company) -> ingest count
+        # Logs moved out of MongoDB by the archiver (python retention.py)
+        self.archive = LogArchive(config('ARCHIVE_DIR')) if config('ARCHIVE_DIR', default='') else None
+        # Critical alerts are sent in the background over pooled SMTP connections
+        self.alerts = AlertDispatcher(
+            SMTPPool(config('SMTP_HOST', default='sandbox.smtp.mailtrap.io'),
+                     config('SMTP_PORT', default=587, cast=int),
+                     user=config('MAILTRAP_USER', default=None),
+                     password=config('MAILTRAP_PASSWORD', default=None),
+                     size=config('ALERT_SMTP_POOL_SIZE', default=2, cast=int)),
+            sender=config('ALERT_SENDER', default='from@example.com'),
+            max_queue=config('ALERT_QUEUE_SIZE', default=1000, cast=int),
+            workers=config('ALERT_SMTP_POOL_SIZE', default=2, cast=int),
+            max_retries=config('ALERT_MAX_RETRIES', default=3, cast=int),
+            backoff=config('ALERT_RETRY_BACKOFF', default=1.0, cast=float))
+        # Repeated errors are grouped per company and sent as digests
+        self.alert_coalescer = AlertCoalescer(self.alerts,
+                                              window=config('ALERT_COALESCE_WINDOW', default=300, cast=int),
+                                              immediate_limit=config('ALERT_IMMEDIATE_LIMIT', default=1, cast=int))
+
+    async def start(self):
+        """ Start the background workers. Called on application startup."""
+        await self.nosql.start()
+        self.alerts.start()
+
+    async def close(self):
+        """ Drain pending alerts and buffered logs. Called on application shutdown."""
+        self.alert_coalescer.flush()
+        await self.alerts.stop()
+        await self.nosql.close()
 
     @staticmethod
     def generate_registration_token(email):
@@ -43,7 +100,8 @@ class Service:
 
         msg.attach(MIMEText(json.dumps(content_text, indent=2), 'plain'))
 
-        with smtplib.SMTP('sandbox.smtp.mailtrap.io', 587) as server:
+        with smtplib.SMTP(config('SMTP_HOST', default='sandbox.smtp.mailtrap.io'),
+                          config('SMTP_PORT', default=587, cast=int)) as server:
             server.starttls()
             server.login(sender_user, sender_password)
 
@@ -51,10 +109,12 @@ class Service:
 
         return {'success': True, 'message': f'O email foi enviado para {addressee}'}
 
-    def send_registration_email(self, email, token: str):
-        self.send_email(subject='Your registration token',
-                        addressee=email,
-                        content_text=f'Your verification token is:\n\n{token}\n\nValid for 15 minutes.')
+    async def send_registration_email(self, email, token: str):
+        # smtplib is blocking: run it outside the event loop
+        await run_in_threadpool(self.send_email,
+                                subject='Your registration token',
+                                addressee=email,
+                                content_text=f'Your verification token is:\n\n{token}\n\nValid for 15 minutes.')
 
     @staticmethod
     def verify_registration_token(token):
@@ -68,17 +128,31 @@ class Service:
         except jwt.InvalidTokenError:
             raise HTTPException(status_code=401, detail='Invalid token.')
 
-    def verify_logs_token(self, credentials=Depends(security)):
+    async def verify_logs_token(self, credentials=Depends(security)):
         token = credentials.credentials
+
+        # Tokens are reused for many requests: a verified one only needs a hash lookup.
+        # The entry is valid while the issuer key it was verified with is still the cached one, so it
+        # lasts at most until its exp and the reload of that key (ISSUER_KEY_CACHE_TTL): re-registration
+        # invalidates the key and a rotated key is seen on reload, then the token is verified again.
+        token_hash = hashlib.sha256(token.encode()).digest()
+        cached = self.verified_tokens.get(token_hash)
+        if cached is not None and self.issuer_keys.get(cached[0]['iss']) is cached[1]:
+            TOKEN_CACHE.inc('hit')
+            return cached[0]
+        TOKEN_CACHE.inc('miss')
+
         try:
-            unverified_payload = jwt.decode(token, options={'verify_signature': False})
+            with STAGE_SECONDS.time('auth.decode'):
+                unverified_payload = jwt.decode(token, options={'verify_signature': False})
 
             if 'iss' not in unverified_payload:
                 raise HTTPException(status_code=401, detail='Invalid token: missing "iss" field.' )
 
             iss = unverified_payload.get('iss')
 
-            public_key = self.nosql.verify_company(iss)
+            with STAGE_SECONDS.time('auth.issuer_key'):
+                public_key = await self.get_issuer_key(iss)
 
         except HTTPException:
             raise
@@ -86,14 +160,46 @@ class Service:
             raise HTTPException(status_code=401, detail='Invalid token.')
 
         try:
-            pyload = jwt.decode(token, public_key, algorithms='RS256')
-            return pyload
-
+            with STAGE_SECONDS.time('auth.verify'):
+                pyload = jwt.decode(token, public_key, algorithms='RS256')
         except jwt.ExpiredSignatureError:
             raise HTTPException(status_code=401, detail='Token has expired.')
         except jwt.InvalidTokenError:
             raise HTTPException(status_code=401, detail='Invalid token')
 
+        lifetime = self.token_lifetime(pyload, self.verified_tokens.ttl)
+        if lifetime > 0:
+            self.verified_tokens.set(token_hash, (pyload, public_key), ttl=lifetime)
+        return pyload
+
+    @staticmethod
+    def token_lifetime(payload, max_ttl):
+        """ Seconds a verified payload may be reused: until its exp, at most max_ttl."""
+        if 'exp' not in payload:
+            return max_ttl
+        return min(int(payload['exp']) - time.time(), max_ttl)
+
+    async def load_issuer_key(self, iss):
+        """ Load the issuer PEM from the database and parse it into an RSA public key."""
+        pem_str = await self.nosql.verify_company(iss)
+        return serialization.load_pem_public_key(pem_str.encode('utf-8'), backend=default_backend())
+
+    async def get_issuer_key(self, iss):
+        """ Return the parsed public key of the issuer, remembering unknown issuers for a short time."""
+        return await self.issuer_keys.get_or_load_async(
+            iss,
+            self.load_issuer_key,
+            is_negative=lambda e: isinstance(e, HTTPException) and e.status_code == 404
+        )
+
+    async def get_company(self, company_name):
+        """ Return the company document from the shared cache, reading the database only on a miss."""
+        return await self.companies.get_or_load_async(
+            company_name,
+            self.nosql.get_company,
+            is_negative=lambda e: isinstance(e, HTTPException) and e.status_code == 404
+        )
+
     @staticmethod
     def validate_public_key(pem_str: str):
         """ Validate that the public key is a proper RSA PEM format."""
@@ -111,36 +217,65 @@ class Service:
         except Exception as e:
             raise HTTPException(status_code=400, detail=f'Invalid public key: {str(e)}')
 
-    def register_company(self, data):
+    async def register_company(self, data):
         self.validate_public_key(data.company_public_key)
         company_id = str(uuid.uuid4())
-        self.nosql.store_company_in_db(
+        alert_policy = getattr(data, 'alert_policy', None)
+        retention = getattr(data, 'retention', None)
+        extra = {'alert_policy': alert_policy.model_dump(exclude_none=True)} if alert_policy else {}
+        if retention:
+            extra['retention'] = retention.model_dump(exclude_none=True)
+        await self.nosql.store_company_in_db(
             company_id=company_id,
             public_key=data.company_public_key,
             company_name=data.company_name,
-            alert_emails=data.alert_emails
+            alert_emails=data.alert_emails,
+            **extra
         )
+        self.issuer_keys.invalidate(data.company_name)
+        self.companies.invalidate(data.company_name)
         return company_id
 
-    def send_critical_alert(self, log_data, company_name):
-        obj = self.nosql.get_company(company_name)
-        for email in obj['alert_emails']:
-            self.send_email(
-                subject='Critical Alert - Severe Error Detected.',
-                addressee=email,
-                content_text=log_data
-            )
+    async def send_critical_alert(self, log_data, company_name, company=None):
+        obj = company or await self.get_company(company_name)
+        # Queued or coalesced into a digest: never blocks nor fails the ingest request
+        return self.alert_coalescer.alert(obj, 'Critical Alert - Severe Error Detected.', log_data)
 
-    def process_log(self, log_data: dict, company_name: str):
-        self.nosql.store_log_in_db(log_data, company_name)
+    async def process_log(self, log_data: dict, company_name: str):
+        # The company is resolved once and carried through storage and alerting
+        with STAGE_SECONDS.time('ingest.company'):
+            company = await self.get_company(company_name)
+        with STAGE_SECONDS.time('ingest.store'):
+            await self.nosql.store_log_in_db(log_data, company_name, company)
+        LOGS_INGESTED.inc(company_name)
+        self.logs_changed(company['company_id'])
         if log_data['level'] == 'ERROR':
-            self.send_critical_alert(log_data, company_name)
+            with STAGE_SECONDS.time('ingest.alert'):
+                await self.send_critical_alert(log_data, company_name, company)
             return {'message': 'Log stored and support alert sent.'}
         return {'message': 'Log stored successfully.'}
 
-    def consult_filtered_logs(self, data: dict):
-        if not data:
-            raise ValueError('No filters provided for log search')
+    async def process_logs_batch(self, logs: list, company_name: str):
+        """
+            Stores a batch of already validated logs with one insert_many.
+            Returns {position: error} for the logs that could not be stored.
+        """
+        with STAGE_SECONDS.time('batch.company'):
+            company = await self.get_company(company_name)
+        with STAGE_SECONDS.time('batch.store'):
+            rejected = await self.nosql.store_logs_in_db(logs, company_name, company)
+        LOGS_INGESTED.inc(company_name, amount=len(logs) - len(rejected))
+        if rejected:
+            LOGS_REJECTED.inc(company_name, amount=len(rejected))
+        if len(rejected) < len(logs):
+            self.logs_changed(company['company_id'])
+        for position, log_data in enumerate(logs):
+            if position not in rejected and log_data['level'] == 'ERROR':
+                await self.send_critical_alert(log_data, company_name, company)
+        return rejected
+
+    def build_log_query(self, data: dict):
+        """ Translate the search filters into a MongoDB query on the logs collection."""
         query = {}
 
         if data.get('company_id'):
@@ -163,14 +298,244 @@ class Service:
                 '$gte': start_dt,
                 '$lte': end_dt
             }
+        if (data.get('text') or '').strip():
+            # Time-series collections do not support text indexes (see indexes.py)
+            if self.settings.log_storage_mode == 'timeseries':
+                raise HTTPException(status_code=400, detail='Text search is not available in time-series mode.')
+            # The text index is prefixed by company_id, so MongoDB requires an equality on it
+            if not query.get('company_id'):
+                raise HTTPException(status_code=400, detail='Text search requires company_id.')
+            query['$text'] = {'$search': data['text'].strip()}
+
+            window = self.text_window(data)
+            if window:
+                # received_at is a suffix key of the text index: the window is checked on index entries
+                query['$and'] = [{'received_at': {'$gte': datetime.now() - timedelta(hours=window)}}]
+
+        return query
+
+    def text_window(self, data: dict):
+        """ Hours back from now a text search is limited to (text_window_hours or TEXT_SEARCH_WINDOW_HOURS), or 0."""
+        if not (data.get('text') or '').strip():
+            return 0
+        return data.get('text_window_hours') or self.settings.text_search_window_hours
+
+    @staticmethod
+    def encode_cursor(position):
+        """
+            Opaque continuation cursor: the (received_at, _id) position of the last returned log,
+            plus its relevance score in text searches.
+        """
+        values = [position['received_at'].isoformat(), str(position['_id'])]
+        if 'score' in position:
+            values.append(position['score'])
+        raw = json.dumps(values)
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def take_position(logs):
+        """
+            Removes the cursor position the last two logs of a page carry (see page_stages) and
+            returns the one of the last log.
+        """
+        position = None
+        for log in logs[-2:]:
+            position = log.pop('position', None)
+        return position
+
+    @staticmethod
+    def decode_cursor(cursor: str):
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            received_at, last_id, *score = json.loads(raw)
+            return (datetime.fromisoformat(received_at), ObjectId(last_id), *score)
+        except Exception:
+            raise HTTPException(status_code=400, detail='Invalid cursor.')
+
+    def search_cache_key(self, data: dict, page_size: int):
+        """
+            Normalized search (company, filters, time range, page) and whether its result can change.
+            Results of ranges ended before now - SEARCH_CACHE_SETTLE_SECONDS are immutable, unless a text
+            window (relative to now) applies; the key of the others includes the company ingest generation,
+            so new logs make them unreachable.
+        """
+        def moment(value):
+            if not isinstance(value, datetime):
+                value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+            return self.to_naive_utc(value)
+
+        def text(value):
+            return value.strip() if isinstance(value, str) else value
+
+        company_id = text(data.get('company_id')) or None
+        start = moment(data['start_date']) if data.get('start_date') else None
+        end = moment(data['end_date']) if data.get('end_date') else None
+        normalized = {'company_id': company_id,
+                      'level': text(data.get('level')) or None,
+                      'user': text(data.get('user')) or None,
+                      'tags': sorted({tag.strip() for tag in data.get('tags') or [] if tag.strip()}),
+                      # build_log_query only applies the range when both ends are given
+                      'range': [start.isoformat(), end.isoformat()] if start and end else None,
+                      'text': text(data.get('text')) or None,
+                      'text_window_hours': self.text_window(data),
+                      'page_size': page_size,
+                      'cursor': data.get('cursor')}
+
+        settled = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(
+            seconds=self.settings.search_cache_settle_seconds)
+        immutable = normalized['range'] is not None and end < settled and not normalized['text_window_hours']
+
+        key = json.dumps(normalized, sort_keys=True)
+        if immutable:
+            return key, True
+        # A company's search only depends on its own ingest; searches over every company on any ingest
+        return (key, self.search_generations.get(company_id, 0)), False
+
+    def logs_changed(self, company_id):
+        """ New logs for the company: cached searches that reach now must be recomputed."""
+        self.search_generations[company_id] = self.search_generations.get(company_id, 0) + 1
+        self.search_generations[None] = self.search_generations.get(None, 0) + 1
+
+    async def consult_filtered_logs(self, data: dict):
+        if not data:
+            raise ValueError('No filters provided for log search')
+
+        page_size = min(data.get('page_size') or self.settings.search_page_size,
+                        self.settings.search_max_page_size)
+        if not self.search_results.max_size:
+            return await self.run_log_search(data, page_size)
+
+        key, immutable = self.search_cache_key(data, page_size)
+        return await self.search_results.get_or_load_async(
+            key, lambda _: self.run_log_search(data, page_size),
+            ttl=None if immutable else self.settings.search_cache_live_ttl)
+
+    async def run_log_search(self, data: dict, page_size: int):
+        filters = query = self.build_log_query(data)
+        position = None
+
+        if '$text' in filters:
+            # Text searches are ranked by relevance, so their cursor also carries the score
+            after = None
+            if data.get('cursor'):
+                position = self.decode_cursor(data['cursor'])
+                if len(position) != 3:
+                    raise HTTPException(status_code=400, detail='Invalid cursor.')
+                received_at, last_id, score = position
+                after = {'$or': [{'score': {'$lt': score}},
+                                 {'score': score, 'received_at': {'$lt': received_at}},
+                                 {'score': score, 'received_at': received_at, '_id': {'$lt': last_id}}]}
+            result = await self.nosql.search_ranked_logs_in_db(query, after=after, limit=page_size + 1)
+        else:
+            # Keyset pagination: continue strictly after the last (received_at, _id) returned
+            if data.get('cursor'):
+                position = received_at, last_id = self.decode_cursor(data['cursor'])[:2]
+                query = {'$and': [query, {'$or': [{'received_at': {'$lt': received_at}},
+                                                  {'received_at': received_at, '_id': {'$lt': last_id}}]}]}
+
+            # One extra document tells whether there is a next page
+            result = await self.nosql.search_log_in_db(query, limit=page_size + 1)
+
+        # MongoDB ran out of logs: continue with the archived ones (always older) if the range reaches them.
+        # Not for text searches: archived logs have no relevance score to rank them with.
+        if (len(result) <= page_size and self.archive and data.get('company_id') and 'received_at' in filters
+                and '$text' not in filters):
+            if result:
+                last = self.take_position(result)
+                position = last['received_at'], last['_id']
+            result += await run_in_threadpool(
+                self.archive.search, filters['company_id'],
+                {key: value for key, value in filters.items() if key != 'received_at'},
+                self.to_naive_utc(filters['received_at']['$gte']), self.to_naive_utc(filters['received_at']['$lte']),
+                before=position, limit=page_size + 1 - len(result))
+
+        more = len(result) > page_size
+        result = result[:page_size]
+        position = self.take_position(result)
+        next_cursor = self.encode_cursor(position) if more else None
+
+        # MongoDB already returns the logs in the response shape
+        return {'logs': result, 'next_cursor': next_cursor}
+
+    def can_use_rollups(self, query: dict, group_by: list, unit):
+        """
+            Long date ranges grouped only by level/service, filtered only by company/level and with
+            buckets of at least a minute are answered from the rollups instead of the raw logs
+            (when the rollups also cover the start of the range, see AsyncNosql.rollups_cover).
+        """
+        if not self.nosql.rollups or unit == 'second' or 'received_at' not in query:
+            return False
+        if not set(group_by) <= {'level', 'service'} or not set(query) <= {'company_id', 'log.level', 'received_at'}:
+            return False
+        length = query['received_at']['$lte'] - query['received_at']['$gte']
+        return length >= timedelta(hours=self.settings.rollup_min_range_hours)
+
+    @staticmethod
+    def to_naive_utc(moment: datetime):
+        """ Rollup buckets are naive UTC datetimes, as returned by MongoDB."""
+        return moment.astimezone(timezone.utc).replace(tzinfo=None) if moment.tzinfo else moment
+
+    async def analyze_logs(self, data: dict):
+        """
+            Log counts per time bucket and group-by dimension, computed by MongoDB.
+            company_id is required so the aggregation starts from the (company_id, received_at) index.
+        """
+        if not data.get('company_id'):
+            raise HTTPException(status_code=400, detail='company_id is required for log analytics.')
+
+        group_by = list(dict.fromkeys(data.get('group_by') or []))
+        unit = data.get('bucket')
+        bin_size = data.get('bucket_size') or 1
+        limit = self.settings.analytics_max_groups
+        query = self.build_log_query(data)
+
+        use_rollups = self.can_use_rollups(query, group_by, unit)
+        if use_rollups:
+            start = self.to_naive_utc(query['received_at']['$gte'])
+            end = self.to_naive_utc(query['received_at']['$lte'])
+            use_rollups = await self.nosql.rollups_cover(start)
+
+        # One group more than the limit tells a complete result from a cut one
+        if use_rollups:
+            counts = await self.nosql.count_rollups_in_db(query['company_id'], start, end,
+                                                          level=query.get('log.level'), group_by=group_by,
+                                                          unit=unit, bin_size=bin_size, limit=limit + 1)
+        else:
+            counts = await self.nosql.count_logs_in_db(query, group_by, unit, bin_size, limit=limit + 1)
+        if len(counts['count']) > limit:
+            raise HTTPException(status_code=400,
+                                detail=f'The result has more than {limit} groups. Use a larger bucket or '
+                                       f'bucket_size, a shorter date range or fewer group_by dimensions.')
+        return {'bucket': unit, 'bucket_size': bin_size if unit else None, 'group_by': group_by, 'columns': counts}
+
+    def export_filtered_logs(self, data: dict, compress: bool = False):
+        """
+            Returns an async iterator of NDJSON chunks (optionally gzip) with every log matching the filters.
+            Documents are encoded as they arrive from the cursor, so memory use does not depend on the result size.
+        """
+        if not data:
+            raise ValueError('No filters provided for log export')
+        query = self.build_log_query(data)
+        batch_size = self.settings.export_batch_size
+        chunk_size = self.settings.export_chunk_size
+
+        async def chunks():
+            gzip = zlib.compressobj(wbits=31) if compress else None  # wbits=31: gzip container
+            pending = []
+            pending_size = 0
+            async for document in self.nosql.iter_logs_in_db(query, batch_size=batch_size):
+                line = dumps(document) + b'\n'
+                pending.append(line)
+                pending_size += len(line)
+                if pending_size >= chunk_size:
+                    chunk = b''.join(pending)
+                    pending, pending_size = [], 0
+                    yield gzip.compress(chunk) if gzip else chunk
 
-        result = self.nosql.search_log_in_db(query)
-        flattened = []
-        for r in result:
-            log = r.get('log', {})
-            log['company_id'] = r.get('company_id')
-            log['company_name'] = r.get('company_name')
-            flattened.append(log)
+            chunk = b''.join(pending)
+            if gzip:
+                yield gzip.compress(chunk) + gzip.flush()
+            elif chunk:
+                yield chunk
 
-        return flattened
-    
\ No newline at end of file
+        return chunks()
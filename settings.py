@@ -0,0 +1,120 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
+from decouple import config
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+        Settings used on the request path, read once from the environment / .env.
+        Values only needed at startup or in scripts (cache sizes, SMTP, retention...) are read with config() there.
+    """
+    nosql_user: str
+    nosql_password: str
+    nosql_host: str
+    database: str
+
+    # Connection pool of the asyncio client
+    mongo_max_pool_size: int
+    mongo_min_pool_size: int
+    mongo_max_idle_time_ms: int
+    mongo_server_selection_timeout_ms: int
+
+    collection_logs: str
+    collection_companies: str
+    collection_rollups: str
+    log_storage_mode: str  # 'plain' or 'timeseries' (see storage.py)
+
+    # Retention of companies without their own 'retention' settings (see retention.py)
+    log_hot_days: int
+    log_retention_days: int
+
+    log_write_mode: str
+    log_buffer_max_size: int
+    log_buffer_batch_size: int
+    log_buffer_max_delay: float
+    log_buffer_max_retries: int
+    log_buffer_retry_backoff: float
+
+    log_rollups: bool
+    rollup_grace_seconds: int
+    rollup_flush_interval: float
+    rollup_max_keys: int
+    rollup_compact_interval: int
+
+    ensure_indexes: bool
+    warmup_retry_seconds: float
+
+    log_batch_max_items: int
+
+    # /logs/search, /logs/analytics and /logs/export
+    search_page_size: int
+    search_max_page_size: int
+    search_cache_live_ttl: int
+    search_cache_settle_seconds: int
+    text_search_window_hours: int
+    rollup_min_range_hours: int
+    analytics_max_groups: int
+    export_batch_size: int
+    export_chunk_size: int
+
+    # Request and response encoding
+    fast_json: bool
+    max_decompressed_body: int
+    compress_min_size: int
+    gzip_level: int
+    zstd_level: int
+
+
+def load_settings():
+    return Settings(
+        nosql_user=config('NOSQL_USER'),
+        nosql_password=config('NOSQL_PASSWORD'),
+        nosql_host=config('NOSQL_HOST'),
+        database=config('BD'),
+        mongo_max_pool_size=config('MONGO_MAX_POOL_SIZE', default=100, cast=int),
+        mongo_min_pool_size=config('MONGO_MIN_POOL_SIZE', default=10, cast=int),
+        mongo_max_idle_time_ms=config('MONGO_MAX_IDLE_TIME_MS', default=300000, cast=int),
+        mongo_server_selection_timeout_ms=config('MONGO_SERVER_SELECTION_TIMEOUT_MS', default=20000, cast=int),
+        collection_logs=config('COLLECTION_LOGS'),
+        collection_companies=config('COLLECTION_COMPANIES'),
+        collection_rollups=config('COLLECTION_ROLLUPS', default='log_rollups'),
+        log_storage_mode=config('LOG_STORAGE_MODE', default='plain'),
+        log_hot_days=config('LOG_HOT_DAYS', default=0, cast=int),
+        log_retention_days=config('LOG_RETENTION_DAYS', default=0, cast=int),
+        log_write_mode=config('LOG_WRITE_MODE', default='direct'),
+        log_buffer_max_size=config('LOG_BUFFER_MAX_SIZE', default=10000, cast=int),
+        log_buffer_batch_size=config('LOG_BUFFER_BATCH_SIZE', default=500, cast=int),
+        log_buffer_max_delay=config('LOG_BUFFER_MAX_DELAY', default=1.0, cast=float),
+        log_buffer_max_retries=config('LOG_BUFFER_MAX_RETRIES', default=3, cast=int),
+        log_buffer_retry_backoff=config('LOG_BUFFER_RETRY_BACKOFF', default=0.5, cast=float),
+        log_rollups=config('LOG_ROLLUPS', default=False, cast=bool),
+        rollup_grace_seconds=config('ROLLUP_GRACE_SECONDS', default=120, cast=int),
+        rollup_flush_interval=config('ROLLUP_FLUSH_INTERVAL', default=5.0, cast=float),
+        rollup_max_keys=config('ROLLUP_MAX_KEYS', default=10000, cast=int),
+        rollup_compact_interval=config('ROLLUP_COMPACT_INTERVAL', default=300, cast=int),
+        ensure_indexes=config('ENSURE_INDEXES', default=True, cast=bool),
+        warmup_retry_seconds=config('WARMUP_RETRY_SECONDS', default=5.0, cast=float),
+        log_batch_max_items=config('LOG_BATCH_MAX_ITEMS', default=5000, cast=int),
+        search_page_size=config('SEARCH_PAGE_SIZE', default=100, cast=int),
+        search_max_page_size=config('SEARCH_MAX_PAGE_SIZE', default=1000, cast=int),
+        search_cache_live_ttl=config('SEARCH_CACHE_LIVE_TTL', default=5, cast=int),
+        search_cache_settle_seconds=config('SEARCH_CACHE_SETTLE_SECONDS', default=60, cast=int),
+        text_search_window_hours=config('TEXT_SEARCH_WINDOW_HOURS', default=0, cast=int),
+        rollup_min_range_hours=config('ROLLUP_MIN_RANGE_HOURS', default=24, cast=int),
+        analytics_max_groups=config('ANALYTICS_MAX_GROUPS', default=10000, cast=int),
+        export_batch_size=config('EXPORT_BATCH_SIZE', default=1000, cast=int),
+        export_chunk_size=config('EXPORT_CHUNK_SIZE', default=65536, cast=int),
+        fast_json=config('FAST_JSON', default=True, cast=bool),
+        max_decompressed_body=config('MAX_DECOMPRESSED_BODY', default=50 * 1024 * 1024, cast=int),
+        compress_min_size=config('COMPRESS_MIN_SIZE', default=1024, cast=int),
+        gzip_level=config('GZIP_LEVEL', default=6, cast=int),
+        zstd_level=config('ZSTD_LEVEL', default=3, cast=int),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_settings():
+    """ The process settings, loaded on first use."""
+    return load_settings()
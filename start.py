@@ -1,6 +1,90 @@
-#!/usr/bin/env bash
+import importlib.util
+import math
 import os
 
 import uvicorn
+from decouple import config
+from uvicorn.supervisors import Multiprocess
+
+
+def cgroup_cpu_limit(root='/sys/fs/cgroup'):
+    """
+        CPUs allowed by the container CPU quota (cgroup v2 cpu.max or v1 cfs quota), or None when unlimited.
+    """
+    try:
+        with open(os.path.join(root, 'cpu.max')) as f:
+            quota, period = f.read().split()[:2]
+        if quota != 'max':
+            return int(quota) / int(period)
+        return None
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open(os.path.join(root, 'cpu', 'cpu.cfs_quota_us')) as f:
+            quota = int(f.read())
+        with open(os.path.join(root, 'cpu', 'cpu.cfs_period_us')) as f:
+            period = int(f.read())
+        if quota > 0 and period > 0:
+            return quota / period
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def available_cpus():
+    """ CPUs this process may use: affinity mask and cgroup quota, at least 1."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS / Windows
+        cpus = os.cpu_count() or 1
+
+    limit = cgroup_cpu_limit()
+    if limit:
+        cpus = min(cpus, math.ceil(limit))
+    return max(cpus, 1)
+
+
+def worker_count():
+    """ WORKERS when set, otherwise one worker per available CPU (each worker is a single event loop)."""
+    return config('WORKERS', default=0, cast=int) or available_cpus()
+
+
+def installed(module):
+    return importlib.util.find_spec(module) is not None
+
+
+def server_options():
+    max_requests = config('WORKER_MAX_REQUESTS', default=0, cast=int)
+    return {'host': config('HOST', default='0.0.0.0'),
+            'port': config('PORT', default=8000, cast=int),
+            'workers': worker_count(),
+            'loop': 'uvloop' if installed('uvloop') else 'asyncio',
+            'http': 'httptools' if installed('httptools') else 'h11',
+            # A worker exits after this many requests and the supervisor starts a new one (see serve())
+            'limit_max_requests': max_requests or None,
+            # On shutdown in-flight requests get this long; then the lifespan drains buffers and alerts
+            'timeout_graceful_shutdown': config('GRACEFUL_TIMEOUT', default=30, cast=int),
+            'timeout_keep_alive': config('KEEP_ALIVE_TIMEOUT', default=5, cast=int),
+            'proxy_headers': True,
+            'access_log': config('ACCESS_LOG', default=False, cast=bool)}
+
+
+def serve(app, options):
+    """
+        Runs the server. uvicorn.run() only starts its supervisor, which replaces workers that exit,
+        for more than one worker: a single worker recycled by limit_max_requests would stop the server,
+        so that case runs under the supervisor too.
+    """
+    if options['workers'] == 1 and options['limit_max_requests']:
+        server_config = uvicorn.Config(app, **options)
+        Multiprocess(server_config, target=uvicorn.Server(server_config).run,
+                     sockets=[server_config.bind_socket()]).run()
+    else:
+        uvicorn.run(app, **options)
+
+
 if __name__ == "__main__":
-    uvicorn.run('main:app', host='0.0.0.0', port=int(os.environ.get ('$PORT', 8000)))
+    options = server_options()
+    print(f"Iniciando {options['workers']} workers ({options['loop']}, {options['http']})")
+    serve('main:app', options)
@@ -0,0 +1,118 @@
+import argparse
+
+from bson import ObjectId
+from decouple import config
+from pymongo.errors import BulkWriteError, CollectionInvalid
+
+
+def storage_mode():
+    """ 'plain' (regular collection) or 'timeseries' (MongoDB time-series collection)."""
+    return config('LOG_STORAGE_MODE', default='plain')
+
+
+def timeseries_options():
+    """
+        Stored logs are {company_id, company_name, log, received_at}: received_at is the time field
+        and company_id the meta field, so each bucket holds the logs of one company.
+    """
+    return {'timeField': 'received_at',
+            'metaField': 'company_id',
+            'granularity': config('TIMESERIES_GRANULARITY', default='seconds')}
+
+
+def timeseries_collection_options():
+    """
+        create_collection() options. Time-series collections expire on received_at for every company
+        (LOG_RETENTION_DAYS): TTL indexes on other fields, such as expires_at, are not supported.
+    """
+    options = {'timeseries': timeseries_options()}
+    retention_days = config('LOG_RETENTION_DAYS', default=0, cast=int)
+    if retention_days:
+        options['expireAfterSeconds'] = retention_days * 86400
+    return options
+
+
+async def ensure_log_collection(db, name=None):
+    """
+        Creates the logs collection as a time-series collection when that storage mode is configured.
+        An existing plain collection cannot be converted: it is reported and left as it is.
+    """
+    if storage_mode() != 'timeseries':
+        return None
+
+    name = name or config('COLLECTION_LOGS')
+    existing = await db.list_collections(filter={'name': name})
+    info = next(iter(await existing.to_list()), None)
+    if info is None:
+        try:
+            await db.create_collection(name, **timeseries_collection_options())
+        except CollectionInvalid:
+            pass  # Created meanwhile by another worker
+        return 'created'
+
+    if info.get('type') != 'timeseries':
+        print(f"La colección {name} no es de tipo time-series: migrarla con 'python storage.py <origen> <destino>'")
+        return 'plain'
+    return 'timeseries'
+
+
+def migrate_to_timeseries(db, source, target, batch_size=5000, after=None):
+    """
+        Copies the plain source collection into the time-series target collection (created if missing)
+        in _id order, batch_size documents per insert_many. Time-series collections do not enforce
+        unique _id, so an interrupted copy is resumed with after=<last copied _id> instead of re-run.
+        Returns (copied documents, last copied _id).
+    """
+    if target not in db.list_collection_names(filter={'name': target}):
+        db.create_collection(target, **timeseries_collection_options())
+
+    query = {'_id': {'$gt': after}} if after else {}
+    copied, last_id, batch = 0, after, []
+
+    def write(batch):
+        try:
+            db[target].insert_many(batch, ordered=False)
+        except BulkWriteError as bwe:
+            print(f"{len(bwe.details.get('writeErrors', []))} documentos no se pudieron copiar")
+
+    for document in db[source].find(query).sort('_id', 1).batch_size(batch_size):
+        batch.append(document)
+        if len(batch) >= batch_size:
+            write(batch)
+            copied += len(batch)
+            last_id = batch[-1]['_id']
+            batch = []
+            print(f"{copied} logs copiados (último _id {last_id})")
+
+    if batch:
+        write(batch)
+        copied += len(batch)
+        last_id = batch[-1]['_id']
+
+    return copied, last_id
+
+
+def main():
+    from conection import Connection
+
+    parser = argparse.ArgumentParser(description='Copy a plain logs collection into a time-series collection.')
+    parser.add_argument('source', help='plain collection, e.g. logs')
+    parser.add_argument('target', help='time-series collection to create and fill, e.g. logs_ts')
+    parser.add_argument('--batch-size', type=int, default=config('MIGRATION_BATCH_SIZE', default=5000, cast=int))
+    parser.add_argument('--after', help='resume after this _id (printed by a previous run)')
+    args = parser.parse_args()
+
+    conn = Connection()
+    try:
+        copied, last_id = migrate_to_timeseries(conn.get_database(), args.source, args.target,
+                                                batch_size=args.batch_size,
+                                                after=ObjectId(args.after) if args.after else None)
+        print(f"Migración terminada: {copied} logs copiados (último _id {last_id}).")
+        print(f"Configurar COLLECTION_LOGS={args.target} y LOG_STORAGE_MODE=timeseries; "
+              f"los índices se crean al arrancar la aplicación.")
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
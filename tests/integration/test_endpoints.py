@@ -1,8 +1,10 @@
+import gzip
+import json
 import unittest
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 from fastapi.testclient import TestClient
-from fastapi import HTTPException
-from routers.router import router
+from fastapi import FastAPI, HTTPException
+from routers.router import log_adapter, log_record_adapter, router, service
 
 class TestRequestRegistrationEndpoint(unittest.TestCase):
     def setUp(self):
@@ -73,3 +75,261 @@ class TestRequestRegistrationEndpoint(unittest.TestCase):
 
         self.assertEqual(http_exc.exception.status_code, 500)
         self.assertTrue(http_exc.exception.detail.startswith('Unexpected error'))
+
+
+class TestReceiveLogsBatchEndpoint(unittest.TestCase):
+    def setUp(self):
+        app = FastAPI()
+        app.include_router(router)
+        app.dependency_overrides[service.verify_logs_token] = lambda: {'iss': 'MyCompany'}
+        self.client = TestClient(app)
+        self.headers = {'Authorization': 'Bearer token'}
+        self.log = {'timestamp': '2025-05-21T14:32:00Z', 'host': 'server-01', 'service': 'auth', 'level': 'INFO',
+                    'event': {'action': 'login', 'category': 'auth', 'outcome': 'success', 'reason': None},
+                    'user': {'id': 'u1', 'name': 'juan', 'ip': '10.0.0.1', 'agent': 'curl'},
+                    'message': 'ok', 'tags': ['login']}
+
+    @patch('routers.router.service.process_logs_batch')
+    def test_batch_json_array_reports_per_item_results(self, mock_process_logs_batch):
+        mock_process_logs_batch.return_value = {}
+        invalid = {'host': 'server-01'}
+
+        response = self.client.post('/logs/batch', json=[self.log, invalid, self.log], headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['accepted'], 2)
+        self.assertEqual(body['rejected'], 1)
+        self.assertEqual([r['status'] for r in body['results']], ['accepted', 'rejected', 'accepted'])
+
+        args, _ = mock_process_logs_batch.call_args
+        self.assertEqual(len(args[0]), 2)
+        self.assertEqual(args[1], 'MyCompany')
+
+    @patch('routers.router.service.process_logs_batch')
+    def test_batch_ndjson_maps_write_errors_to_positions(self, mock_process_logs_batch):
+        mock_process_logs_batch.return_value = {1: 'document too large'}
+        body = '\n'.join([json.dumps(self.log), 'not json', json.dumps(self.log)])
+
+        response = self.client.post('/logs/batch', content=body,
+                                    headers={**self.headers, 'Content-Type': 'application/x-ndjson'})
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual([r['status'] for r in results], ['accepted', 'rejected', 'rejected'])
+        self.assertEqual(results[2]['errors'][0]['msg'], 'document too large')
+
+    @patch('routers.router.service.process_logs_batch', new_callable=AsyncMock)
+    def test_batch_accepts_gzip_body(self, mock_process_logs_batch):
+        mock_process_logs_batch.return_value = {}
+        body = gzip.compress(json.dumps([self.log, self.log]).encode('utf-8'))
+
+        response = self.client.post('/logs/batch', content=body,
+                                    headers={**self.headers, 'Content-Type': 'application/json',
+                                             'Content-Encoding': 'gzip'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['accepted'], 2)
+
+    def test_batch_rejects_non_array_body(self):
+        response = self.client.post('/logs/batch', json=self.log, headers=self.headers)
+
+        self.assertEqual(response.status_code, 400)
+
+
+class TestExportLogsEndpoint(unittest.TestCase):
+    def setUp(self):
+        app = FastAPI()
+        app.include_router(router)
+        app.dependency_overrides[service.verify_logs_token] = lambda: {'iss': 'MyCompany'}
+        self.client = TestClient(app)
+        self.filters = {'company_id': '12345', 'level': None, 'user': None, 'start_date': None, 'end_date': None,
+                        'tags': None}
+
+        patcher = patch('routers.router.service.get_company', new_callable=AsyncMock,
+                        return_value={'company_id': '12345', 'company_name': 'MyCompany'})
+        self.addCleanup(patcher.stop)
+        self.mock_get_company = patcher.start()
+
+    @patch('routers.router.service.export_filtered_logs')
+    def test_export_streams_ndjson(self, mock_export):
+        async def chunks():
+            yield b'{"message": "a"}\n'
+            yield b'{"message": "b"}\n'
+        mock_export.return_value = chunks()
+
+        response = self.client.post('/logs/export', json=self.filters)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('application/x-ndjson'))
+        self.assertEqual(response.text.splitlines(), ['{"message": "a"}', '{"message": "b"}'])
+        mock_export.assert_called_once_with({'company_id': '12345'}, compress=False)
+
+    @patch('routers.router.service.export_filtered_logs')
+    def test_export_is_compressed_when_negotiated(self, mock_export):
+        async def chunks():
+            yield b'{"message": "a"}\n'
+        mock_export.return_value = chunks()
+
+        response = self.client.post('/logs/export', json=self.filters, headers={'Accept-Encoding': 'gzip'})
+
+        self.assertEqual(response.headers['content-encoding'], 'gzip')
+        self.assertEqual(response.text, '{"message": "a"}\n')
+
+    @patch('routers.router.service.export_filtered_logs')
+    def test_export_is_scoped_to_the_token_issuer(self, mock_export):
+        async def chunks():
+            yield b''
+        mock_export.return_value = chunks()
+
+        self.client.post('/logs/export', json={**self.filters, 'company_id': None, 'level': 'ERROR'})
+
+        self.mock_get_company.assert_awaited_once_with('MyCompany')
+        mock_export.assert_called_once_with({'company_id': '12345', 'level': 'ERROR'}, compress=False)
+
+    @patch('routers.router.service.export_filtered_logs')
+    def test_export_of_another_company_is_forbidden(self, mock_export):
+        response = self.client.post('/logs/export', json={**self.filters, 'company_id': '99999'})
+
+        self.assertEqual(response.status_code, 403)
+        mock_export.assert_not_called()
+
+
+class TestAnalyzeLogsEndpoint(unittest.TestCase):
+    def setUp(self):
+        app = FastAPI()
+        app.include_router(router)
+        app.dependency_overrides[service.verify_logs_token] = lambda: {'iss': 'MyCompany'}
+        self.client = TestClient(app)
+        self.filters = {'company_id': '12345', 'level': None, 'user': None, 'start_date': None, 'end_date': None,
+                        'tags': None}
+
+        patcher = patch('routers.router.service.get_company', new_callable=AsyncMock,
+                        return_value={'company_id': '12345', 'company_name': 'MyCompany'})
+        self.addCleanup(patcher.stop)
+        self.mock_get_company = patcher.start()
+
+    @patch('routers.router.service.analyze_logs', new_callable=AsyncMock)
+    def test_analytics_returns_columns(self, mock_analyze):
+        mock_analyze.return_value = {'bucket': 'minute', 'bucket_size': 1, 'group_by': ['service'],
+                                     'columns': {'time': ['2024-05-01T12:00:00'], 'service': ['api'],
+                                                 'count': [4]}}
+
+        response = self.client.post('/logs/analytics', json={**self.filters, 'group_by': ['service']})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['columns']['count'], [4])
+        mock_analyze.assert_called_once_with({'company_id': '12345', 'group_by': ['service'],
+                                              'bucket': 'minute', 'bucket_size': 1})
+
+    @patch('routers.router.service.analyze_logs', new_callable=AsyncMock)
+    def test_analytics_is_scoped_to_the_token_issuer(self, mock_analyze):
+        mock_analyze.return_value = {'bucket': None, 'bucket_size': None, 'group_by': [], 'columns': {'count': [1]}}
+
+        self.client.post('/logs/analytics', json={**self.filters, 'company_id': None, 'bucket': None})
+
+        self.mock_get_company.assert_awaited_once_with('MyCompany')
+        self.assertEqual(mock_analyze.call_args.args[0]['company_id'], '12345')
+
+    @patch('routers.router.service.analyze_logs', new_callable=AsyncMock)
+    def test_analytics_of_another_company_is_forbidden(self, mock_analyze):
+        response = self.client.post('/logs/analytics', json={**self.filters, 'company_id': '99999'})
+
+        self.assertEqual(response.status_code, 403)
+        mock_analyze.assert_not_called()
+
+    def test_analytics_rejects_unknown_dimension(self):
+        response = self.client.post('/logs/analytics', json={**self.filters, 'group_by': ['user.ip']})
+
+        self.assertEqual(response.status_code, 422)
+
+
+class TestFastJsonEndpoints(unittest.TestCase):
+    def setUp(self):
+        app = FastAPI()
+        app.include_router(router)
+        app.dependency_overrides[service.verify_logs_token] = lambda: {'iss': 'MyCompany'}
+        self.client = TestClient(app)
+        self.log = {'timestamp': '2024-05-01T12:00:00Z', 'host': 'web-1', 'service': 'api', 'level': 'INFO',
+                    'event': {'action': 'login', 'category': 'auth', 'outcome': 'success', 'reason': None},
+                    'user': {'id': '1', 'name': 'Alberto', 'ip': '10.0.0.1', 'agent': 'curl'},
+                    'message': 'ok', 'tags': ['auth']}
+
+    @patch('routers.router.service.process_log', new_callable=AsyncMock)
+    def test_log_is_validated_into_a_plain_dict(self, mock_process_log):
+        response = self.client.post('/logs', json=self.log, headers={'Authorization': 'Bearer token'})
+
+        self.assertEqual(response.status_code, 200)
+        mock_process_log.assert_called_once_with(self.log, 'MyCompany')
+        self.assertIs(type(mock_process_log.call_args.args[0]), dict)
+
+    def test_invalid_log_is_rejected_with_field_errors(self):
+        response = self.client.post('/logs', json={**self.log, 'user': None}, headers={'Authorization': 'Bearer token'})
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.json()['detail'][0]['loc'], ['body', 'user'])
+
+    @patch('routers.router.service.consult_filtered_logs', new_callable=AsyncMock)
+    def test_search_response_encodes_the_logs_as_they_are(self, mock_consult):
+        mock_consult.return_value = {'logs': [self.log], 'next_cursor': 'abc'}
+
+        response = self.client.post('/logs/search', json={'company_id': '12345', 'level': None, 'user': None,
+                                                          'start_date': None, 'end_date': None, 'tags': None})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'logs': [self.log], 'next_cursor': 'abc'})
+
+    def test_log_records_match_the_log_schema(self):
+        self.assertEqual(log_record_adapter.json_schema(), log_adapter.json_schema())
+
+
+class TestReadinessEndpoint(unittest.TestCase):
+    def setUp(self):
+        app = FastAPI()
+        app.include_router(router)
+        self.client = TestClient(app)
+
+    def test_ready_only_after_warm_up(self):
+        with patch.object(service.nosql, 'ready', False), patch.object(service.nosql, 'warmup_error', 'timeout'):
+            response = self.client.get('/ready')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.json(), {'status': 'starting', 'error': 'timeout'})
+
+        with patch.object(service.nosql, 'ready', True):
+            self.assertEqual(self.client.get('/ready').status_code, 200)
+
+
+class TestMetricsEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(router)
+
+    def test_metrics_are_exposed_in_prometheus_format(self):
+        response = self.client.get('/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['content-type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn('# TYPE logdata_stage_seconds histogram', response.text)
+        self.assertIn('logdata_threadpool_threads{state="capacity"}', response.text)
+
+
+class TestSlowRequestsEndpoint(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(router)
+
+    @patch.dict('os.environ', {'ADMIN_TOKEN': 'admin-secret'})
+    def test_captures_need_the_admin_token(self):
+        for headers in ({}, {'X-Admin-Token': 'nope'}):
+            with self.assertRaises(HTTPException) as http_exc:
+                self.client.get('/admin/slow-requests', headers=headers)
+            self.assertEqual(http_exc.exception.status_code, 403)
+
+        response = self.client.get('/admin/slow-requests', headers={'X-Admin-Token': 'admin-secret'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('requests', response.json())
+
+    @patch.dict('os.environ', {'ADMIN_TOKEN': ''})
+    def test_disabled_without_admin_token(self):
+        with self.assertRaises(HTTPException) as http_exc:
+            self.client.get('/admin/slow-requests', headers={'X-Admin-Token': ''})
+        self.assertEqual(http_exc.exception.status_code, 403)
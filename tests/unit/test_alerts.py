@@ -0,0 +1,205 @@
+import asyncio
+import smtplib
+import unittest
+from unittest.mock import MagicMock, patch
+
+from alerts import AlertCoalescer, AlertDispatcher, SMTPPool, message_template
+
+
+class FakeSMTP:
+    """ Local SMTP stand-in that records connections and sent messages."""
+    instances = []
+
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.port = port
+        self.sent = []
+        self.closed = False
+        self.fail_sends = 0
+        FakeSMTP.instances.append(self)
+
+    def starttls(self):
+        pass
+
+    def login(self, user, password):
+        self.user = user
+
+    def noop(self):
+        return (250, b'OK')
+
+    def sendmail(self, sender, recipients, message):
+        if self.fail_sends:
+            self.fail_sends -= 1
+            raise smtplib.SMTPServerDisconnected('connection lost')
+        self.sent.append((sender, recipients, message))
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class TestSMTPPool(unittest.TestCase):
+
+    def setUp(self):
+        FakeSMTP.instances = []
+        patcher = patch('alerts.smtplib.SMTP', FakeSMTP)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_connection_is_reused(self):
+        pool = SMTPPool('localhost', 2525, user='user', password='pass', size=2)
+
+        for _ in range(3):
+            with pool.connection() as server:
+                server.sendmail('from@example.com', ['a@example.com'], 'msg')
+
+        self.assertEqual(len(FakeSMTP.instances), 1)
+        self.assertEqual(len(FakeSMTP.instances[0].sent), 3)
+
+    def test_broken_connection_is_discarded(self):
+        pool = SMTPPool('localhost', 2525, size=1)
+
+        with self.assertRaises(RuntimeError):
+            with pool.connection():
+                raise RuntimeError('boom')
+
+        with pool.connection():
+            pass
+
+        self.assertEqual(len(FakeSMTP.instances), 2)
+        self.assertTrue(FakeSMTP.instances[0].closed)
+
+    def test_stale_connection_is_replaced(self):
+        pool = SMTPPool('localhost', 2525, size=1)
+        with pool.connection() as server:
+            server.noop = MagicMock(side_effect=smtplib.SMTPServerDisconnected())
+
+        with pool.connection():
+            pass
+
+        self.assertEqual(len(FakeSMTP.instances), 2)
+
+
+class TestAlertDispatcher(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        FakeSMTP.instances = []
+        patcher = patch('alerts.smtplib.SMTP', FakeSMTP)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.pool = SMTPPool('localhost', 2525, size=1)
+
+    async def test_sends_one_message_to_all_recipients(self):
+        dispatcher = AlertDispatcher(self.pool, 'from@example.com', workers=1)
+        dispatcher.start()
+
+        self.assertTrue(dispatcher.submit('Alert', ['a@example.com', 'b@example.com'], {'level': 'ERROR'}))
+        await dispatcher.stop()
+
+        sent = FakeSMTP.instances[0].sent
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0][1], ['a@example.com', 'b@example.com'])
+        self.assertEqual(dispatcher.stats()['sent'], 1)
+
+    async def test_retries_with_backoff(self):
+        dispatcher = AlertDispatcher(self.pool, 'from@example.com', workers=1, max_retries=2, backoff=0.001)
+        original_connect = self.pool._connect
+
+        def flaky_connect():
+            server = original_connect()
+            if len(FakeSMTP.instances) == 1:
+                server.fail_sends = 1
+            return server
+
+        self.pool._connect = flaky_connect
+        dispatcher.start()
+        dispatcher.submit('Alert', ['a@example.com'], 'log')
+        await dispatcher.stop()
+
+        self.assertEqual(dispatcher.stats()['sent'], 1)
+        self.assertEqual(len(FakeSMTP.instances), 2)
+
+    async def test_gives_up_after_max_retries(self):
+        dispatcher = AlertDispatcher(self.pool, 'from@example.com', workers=1, max_retries=1, backoff=0.001)
+        self.pool._connect = MagicMock(side_effect=OSError('connection refused'))
+        dispatcher.start()
+
+        dispatcher.submit('Alert', ['a@example.com'], 'log')
+        await dispatcher.stop()
+
+        self.assertEqual(self.pool._connect.call_count, 2)
+        self.assertEqual(dispatcher.stats()['failed'], 1)
+
+    async def test_submit_never_blocks_when_queue_is_full(self):
+        dispatcher = AlertDispatcher(self.pool, 'from@example.com', max_queue=1)
+
+        self.assertTrue(dispatcher.submit('Alert', ['a@example.com'], 'log'))
+        self.assertFalse(dispatcher.submit('Alert', ['a@example.com'], 'log'))
+        self.assertFalse(dispatcher.submit('Alert', [], 'log'))
+        self.assertEqual(dispatcher.stats()['dropped'], 1)
+
+
+class TestAlertCoalescer(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.dispatcher = MagicMock()
+        self.company = {'company_name': 'MyCompany', 'alert_emails': ['a@example.com']}
+
+    @staticmethod
+    def log(message, host='server-01'):
+        return {'level': 'ERROR', 'service': 'auth', 'host': host, 'event': {'action': 'login'},
+                'message': message}
+
+    def test_message_template_replaces_variable_parts(self):
+        self.assertEqual(message_template('Timeout after 3000ms calling "users" from 10.0.0.1'),
+                         'Timeout after <n>ms calling <str> from <ip>')
+
+    async def test_first_alert_is_sent_and_repeats_are_coalesced_into_digest(self):
+        coalescer = AlertCoalescer(self.dispatcher, window=60, immediate_limit=1)
+
+        self.assertEqual(coalescer.alert(self.company, 'Alert', self.log('Timeout after 100ms')), 'sent')
+        self.assertEqual(coalescer.alert(self.company, 'Alert', self.log('Timeout after 250ms')), 'coalesced')
+        self.assertEqual(coalescer.alert(self.company, 'Alert', self.log('Timeout after 300ms')), 'coalesced')
+        self.assertEqual(self.dispatcher.submit.call_count, 1)
+
+        coalescer.flush()
+
+        self.assertEqual(self.dispatcher.submit.call_count, 2)
+        digest = self.dispatcher.submit.call_args.kwargs
+        self.assertEqual(digest['recipients'], ['a@example.com'])
+        self.assertEqual(digest['content']['occurrences'], 3)
+        self.assertEqual(digest['content']['suppressed'], 2)
+        self.assertEqual(digest['content']['message_template'], 'Timeout after <n>ms')
+
+    async def test_different_fingerprints_are_not_coalesced(self):
+        coalescer = AlertCoalescer(self.dispatcher, window=60)
+        self.addCleanup(coalescer.flush)
+
+        coalescer.alert(self.company, 'Alert', self.log('Timeout after 100ms', host='server-01'))
+        coalescer.alert(self.company, 'Alert', self.log('Timeout after 100ms', host='server-02'))
+
+        self.assertEqual(self.dispatcher.submit.call_count, 2)
+
+    async def test_window_close_sends_digest_and_reopens(self):
+        coalescer = AlertCoalescer(self.dispatcher)
+        company = {**self.company, 'alert_policy': {'window_seconds': 0.01, 'immediate_limit': 2}}
+
+        for _ in range(3):
+            coalescer.alert(company, 'Alert', self.log('Disk full'))
+        self.assertEqual(self.dispatcher.submit.call_count, 2)
+
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.dispatcher.submit.call_count, 3)
+        self.assertEqual(self.dispatcher.submit.call_args.kwargs['content']['suppressed'], 1)
+
+        self.assertEqual(coalescer.alert(company, 'Alert', self.log('Disk full')), 'sent')
+        coalescer.flush()
+
+    async def test_window_zero_disables_coalescing(self):
+        coalescer = AlertCoalescer(self.dispatcher, window=0)
+
+        for _ in range(3):
+            self.assertEqual(coalescer.alert(self.company, 'Alert', self.log('Disk full')), 'sent')
+        self.assertEqual(self.dispatcher.submit.call_count, 3)
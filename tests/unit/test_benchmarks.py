@@ -0,0 +1,52 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from benchmarks.common import summarize
+from benchmarks.fake_mongo import FakeDatabase
+from db_nosql_async import LOG_PAGE_STAGES, LOG_SORT
+
+
+class TestFakeMongo(unittest.IsolatedAsyncioTestCase):
+
+    async def test_search_pipeline(self):
+        collection = FakeDatabase()['logs']
+        now = datetime(2025, 1, 1, 12)
+        await collection.insert_many([
+            {'company_id': 'c1', 'company_name': 'acme', 'received_at': now - timedelta(minutes=i),
+             'log': {'level': 'ERROR' if i % 2 else 'INFO', 'message': f'log {i}', 'tags': ['api', 'db']}}
+            for i in range(10)])
+
+        cursor = await collection.aggregate([
+            {'$match': {'company_id': 'c1', 'log.level': 'INFO', 'log.tags': {'$in': ['db']},
+                        'received_at': {'$gte': (now - timedelta(minutes=5)).replace(tzinfo=timezone.utc)}}},
+            {'$sort': LOG_SORT}, {'$limit': 3}, *LOG_PAGE_STAGES])
+        result = await cursor.to_list()
+
+        self.assertEqual([log['message'] for log in result], ['log 0', 'log 2', 'log 4'])
+        # Only the last two logs keep their position, for the cursor
+        self.assertNotIn('position', result[0])
+        self.assertEqual([log['position']['received_at'] for log in result[1:]],
+                         [now - timedelta(minutes=2), now - timedelta(minutes=4)])
+
+    async def test_text_search_is_scored(self):
+        collection = FakeDatabase()['logs']
+        await collection.insert_many([{'log': {'message': 'disk full'}}, {'log': {'message': 'all good'}}])
+
+        cursor = await collection.aggregate([{'$match': {'$text': {'$search': 'disk'}}},
+                                             {'$addFields': {'score': {'$meta': 'textScore'}}}])
+        result = await cursor.to_list()
+
+        self.assertEqual(len(result), 1)
+        self.assertGreater(result[0]['score'], 0)
+
+
+class TestSummarize(unittest.TestCase):
+
+    def test_percentiles_and_throughput(self):
+        result = summarize([i / 1000 for i in range(1, 101)], elapsed=2.0, errors={'500': 1})
+
+        self.assertEqual(result['count'], 100)
+        self.assertEqual(result['throughput_per_s'], 50)
+        self.assertAlmostEqual(result['p50_ms'], 50.5)
+        self.assertAlmostEqual(result['p99_ms'], 99.01)
+        self.assertEqual(result['errors'], {'500': 1})
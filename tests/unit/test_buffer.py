@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import unittest
+from unittest.mock import MagicMock, AsyncMock
+
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError
+from buffer import WriteBehindBuffer, AsyncWriteBehindBuffer
+
+
+class TestWriteBehindBuffer(unittest.TestCase):
+
+    def test_flushes_when_batch_size_reached(self):
+        flushed = threading.Event()
+        batches = []
+
+        def flush(batch):
+            batches.append(batch)
+            flushed.set()
+
+        buffer = WriteBehindBuffer(flush, max_size=10, batch_size=3, max_delay=5)
+        buffer.start()
+        self.addCleanup(buffer.stop)
+
+        for i in range(3):
+            buffer.put({'n': i})
+
+        self.assertTrue(flushed.wait(2))
+        self.assertEqual(batches[0], [{'n': 0}, {'n': 1}, {'n': 2}])
+
+    def test_flushes_after_max_delay(self):
+        flushed = threading.Event()
+        flush = MagicMock(side_effect=lambda batch: flushed.set())
+
+        buffer = WriteBehindBuffer(flush, max_size=10, batch_size=100, max_delay=0.05)
+        buffer.start()
+        self.addCleanup(buffer.stop)
+        buffer.put({'n': 1})
+
+        self.assertTrue(flushed.wait(2))
+        flush.assert_called_once_with([{'n': 1}])
+
+    def test_put_raises_503_when_full(self):
+        buffer = WriteBehindBuffer(MagicMock(), max_size=1, batch_size=10, max_delay=1)
+        buffer.put({'n': 1})
+
+        with self.assertRaises(HTTPException) as cm:
+            buffer.put({'n': 2})
+
+        self.assertEqual(cm.exception.status_code, 503)
+        self.assertEqual(buffer.stats()['rejected'], 1)
+        self.assertEqual(buffer.stats()['queue_depth'], 1)
+
+    def test_stop_flushes_pending_documents(self):
+        flush = MagicMock()
+        buffer = WriteBehindBuffer(flush, max_size=10, batch_size=100, max_delay=10)
+        for i in range(4):
+            buffer.put({'n': i})
+
+        buffer.start()
+        buffer.stop()
+
+        written = [doc for call in flush.call_args_list for doc in call.args[0]]
+        self.assertEqual(written, [{'n': i} for i in range(4)])
+        self.assertEqual(buffer.stats()['flushed'], 4)
+
+    def test_failed_flush_is_counted_after_retries(self):
+        flush = MagicMock(side_effect=Exception('boom'))
+        buffer = WriteBehindBuffer(flush, max_size=10, batch_size=2, max_delay=10, max_retries=2, backoff=0)
+        buffer.put({'n': 1})
+        buffer.put({'n': 2})
+
+        buffer.start()
+        buffer.stop()
+
+        self.assertEqual(flush.call_count, 3)
+        self.assertEqual(buffer.stats()['failed'], 2)
+        self.assertEqual(buffer.stats()['flushed'], 0)
+
+    def test_transient_failure_is_retried(self):
+        flush = MagicMock(side_effect=[Exception('not primary'), None])
+        buffer = WriteBehindBuffer(flush, max_size=10, batch_size=2, max_delay=10, backoff=0)
+        buffer.put({'n': 1})
+        buffer.put({'n': 2})
+
+        buffer.start()
+        buffer.stop()
+
+        self.assertEqual(flush.call_count, 2)
+        self.assertEqual(buffer.stats()['flushed'], 2)
+        self.assertEqual(buffer.stats()['failed'], 0)
+
+
+class TestAsyncWriteBehindBuffer(unittest.IsolatedAsyncioTestCase):
+
+    async def test_flushes_when_batch_size_reached(self):
+        flush = AsyncMock()
+        buffer = AsyncWriteBehindBuffer(flush, max_size=10, batch_size=2, max_delay=5)
+        buffer.start()
+
+        buffer.put({'n': 1})
+        buffer.put({'n': 2})
+        await asyncio.sleep(0.05)
+
+        flush.assert_awaited_once_with([{'n': 1}, {'n': 2}])
+        await buffer.stop()
+
+    async def test_bulk_write_error_counts_only_rejected_documents(self):
+        flush = AsyncMock(side_effect=BulkWriteError({'writeErrors': [{'index': 1, 'errmsg': 'document too large'}]}))
+        buffer = AsyncWriteBehindBuffer(flush, max_size=10, batch_size=3, max_delay=10, backoff=0)
+        for i in range(3):
+            buffer.put({'n': i})
+
+        await buffer.stop()
+
+        flush.assert_awaited_once()
+        self.assertEqual(buffer.stats()['flushed'], 2)
+        self.assertEqual(buffer.stats()['failed'], 1)
+
+    async def test_put_raises_503_when_full(self):
+        buffer = AsyncWriteBehindBuffer(AsyncMock(), max_size=1, batch_size=10, max_delay=1)
+        buffer.put({'n': 1})
+
+        with self.assertRaises(HTTPException) as cm:
+            buffer.put({'n': 2})
+
+        self.assertEqual(cm.exception.status_code, 503)
+
+    async def test_stop_flushes_pending_documents(self):
+        flush = AsyncMock()
+        buffer = AsyncWriteBehindBuffer(flush, max_size=10, batch_size=100, max_delay=10)
+        buffer.start()
+        for i in range(3):
+            buffer.put({'n': i})
+
+        await buffer.stop()
+
+        written = [doc for call in flush.await_args_list for doc in call.args[0]]
+        self.assertEqual(written, [{'n': i} for i in range(3)])
+        self.assertEqual(buffer.stats()['queue_depth'], 0)
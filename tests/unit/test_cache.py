@@ -0,0 +1,137 @@
+import asyncio
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, AsyncMock, patch
+
+from cache import TTLCache
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_get_or_load_calls_loader_once(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        loader = MagicMock(return_value='value')
+
+        self.assertEqual(cache.get_or_load('key', loader), 'value')
+        self.assertEqual(cache.get_or_load('key', loader), 'value')
+
+        loader.assert_called_once_with('key')
+
+    @patch('cache.time.monotonic')
+    def test_entries_expire_after_ttl(self, mock_monotonic):
+        cache = TTLCache(max_size=10, ttl=60)
+        mock_monotonic.return_value = 100
+        cache.set('key', 'value')
+
+        mock_monotonic.return_value = 159
+        self.assertEqual(cache.get('key'), 'value')
+
+        mock_monotonic.return_value = 161
+        self.assertIsNone(cache.get('key'))
+
+    def test_evicts_least_recently_used(self):
+        cache = TTLCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_negative_entries_raise_without_calling_loader(self):
+        cache = TTLCache(max_size=10, ttl=60, negative_ttl=30)
+        loader = MagicMock(side_effect=LookupError('missing'))
+
+        for _ in range(3):
+            with self.assertRaises(LookupError):
+                cache.get_or_load('key', loader, is_negative=lambda e: isinstance(e, LookupError))
+
+        loader.assert_called_once_with('key')
+
+    def test_errors_not_cached_without_negative_ttl(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        loader = MagicMock(side_effect=LookupError('missing'))
+
+        for _ in range(2):
+            with self.assertRaises(LookupError):
+                cache.get_or_load('key', loader, is_negative=lambda e: True)
+
+        self.assertEqual(loader.call_count, 2)
+
+    def test_concurrent_misses_load_once(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        calls = []
+
+        def slow_loader(key):
+            calls.append(key)
+            time.sleep(0.05)
+            return 'value'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_load('key', slow_loader)))
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(calls, ['key'])
+        self.assertEqual(results, ['value'] * 8)
+
+    def test_invalidate_removes_entry(self):
+        cache = TTLCache(max_size=10, ttl=60)
+        cache.set('key', 'value')
+        cache.invalidate('key')
+
+        self.assertIsNone(cache.get('key'))
+
+
+class TestTTLCacheAsync(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_misses_await_single_load(self):
+        cache = TTLCache(max_size=10, ttl=60)
+
+        async def slow_loader(key):
+            await asyncio.sleep(0.01)
+            return 'value'
+
+        loader = AsyncMock(side_effect=slow_loader)
+        results = await asyncio.gather(*[cache.get_or_load_async('key', loader) for _ in range(8)])
+
+        self.assertEqual(results, ['value'] * 8)
+        loader.assert_awaited_once_with('key')
+
+    @patch('cache.time.monotonic')
+    async def test_ttl_can_be_set_per_load(self, mock_monotonic):
+        cache = TTLCache(max_size=10, ttl=60)
+        mock_monotonic.return_value = 100
+
+        await cache.get_or_load_async('short', AsyncMock(return_value='value'), ttl=5)
+        await cache.get_or_load_async('long', AsyncMock(return_value='value'))
+
+        mock_monotonic.return_value = 106
+        self.assertIsNone(cache.get('short'))
+        self.assertEqual(cache.get('long'), 'value')
+
+    async def test_negative_entries_raise_without_calling_loader(self):
+        cache = TTLCache(max_size=10, ttl=60, negative_ttl=30)
+        loader = AsyncMock(side_effect=LookupError('missing'))
+
+        for _ in range(3):
+            with self.assertRaises(LookupError):
+                await cache.get_or_load_async('key', loader, is_negative=lambda e: True)
+
+        loader.assert_awaited_once_with('key')
+
+    async def test_invalidate_during_load_discards_stale_value(self):
+        cache = TTLCache(max_size=10, ttl=60)
+
+        async def loader(key):
+            cache.invalidate(key)
+            return 'stale'
+
+        self.assertEqual(await cache.get_or_load_async('key', loader), 'stale')
+        self.assertIsNone(cache.get('key'))
@@ -0,0 +1,121 @@
+import gzip
+import unittest
+from dataclasses import replace
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import zstandard
+
+from fastapi import HTTPException
+from fastapi.responses import Response
+from compression import compress_response, compress_stream, negotiate, read_body
+from settings import get_settings
+
+
+async def stream(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def request_with(body, encoding):
+    request = MagicMock()
+    request.headers = {'content-encoding': encoding}
+    request.stream = lambda: stream(*[body[i:i + 100] for i in range(0, len(body), 100)])
+    return request
+
+
+class TestNegotiate(unittest.TestCase):
+
+    def test_picks_an_accepted_encoding(self):
+        self.assertEqual(negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(negotiate('br;q=1.0, gzip;q=0.5'), 'gzip')
+        self.assertIsNone(negotiate('gzip;q=0'))
+        self.assertIsNone(negotiate('br'))
+        self.assertIsNone(negotiate(None))
+
+    def test_prefers_zstd(self):
+        self.assertEqual(negotiate('gzip, zstd'), 'zstd')
+
+
+class TestReadBody(unittest.IsolatedAsyncioTestCase):
+
+    async def test_gzip_body_is_decompressed(self):
+        body = b'{"message": "ok"}\n' * 1000
+
+        self.assertEqual(await read_body(request_with(gzip.compress(body), 'gzip')), body)
+
+    async def test_gzip_bomb_is_rejected(self):
+        bomb = gzip.compress(b'\0' * 10_000_000)
+
+        with patch('compression.get_settings', return_value=replace(get_settings(), max_decompressed_body=10000)):
+            with self.assertRaises(HTTPException) as cm:
+                await read_body(request_with(bomb, 'gzip'))
+
+        self.assertEqual(cm.exception.status_code, 413)
+
+    async def test_invalid_or_unknown_encodings_are_rejected(self):
+        with self.assertRaises(HTTPException) as cm:
+            await read_body(request_with(b'not gzip', 'gzip'))
+        self.assertEqual(cm.exception.status_code, 400)
+
+        with self.assertRaises(HTTPException) as cm:
+            await read_body(request_with(b'data', 'br'))
+        self.assertEqual(cm.exception.status_code, 415)
+
+    async def test_zstd_body_is_decompressed(self):
+        body = b'{"message": "ok"}\n' * 1000
+
+        self.assertEqual(await read_body(request_with(zstandard.ZstdCompressor().compress(body), 'zstd')), body)
+
+    async def test_zstd_bomb_and_truncated_bodies_are_rejected(self):
+        # 200 MB of zeros in a few KB, sent as a single chunk
+        engine = zstandard.ZstdCompressor().compressobj()
+        bomb = b''.join(engine.compress(b'\0' * 1_000_000) for _ in range(200)) + engine.flush()
+        request = request_with(bomb, 'zstd')
+        request.stream = lambda: stream(bomb)
+
+        outputs = []
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+        def decompress(data):
+            part = decompressor.decompress(data)
+            outputs.append(len(part))
+            return part
+
+        limit = 1_000_000
+        with patch('compression.get_settings', return_value=replace(get_settings(), max_decompressed_body=limit)), \
+                patch('compression.zstandard.ZstdDecompressor') as factory:
+            factory.return_value.decompressobj.return_value = SimpleNamespace(decompress=decompress, eof=False)
+            with self.assertRaises(HTTPException) as cm:
+                await read_body(request)
+        self.assertEqual(cm.exception.status_code, 413)
+        # Every call is bounded by its input slice (a few MB at most), not by the received chunk
+        self.assertLessEqual(max(outputs), 4 * 1024 * 1024)
+        self.assertLessEqual(sum(outputs), limit + 4 * 1024 * 1024)
+
+        body = zstandard.ZstdCompressor().compress(b'{"message": "ok"}\n' * 1000)
+        with self.assertRaises(HTTPException) as cm:
+            await read_body(request_with(body[:-10], 'zstd'))
+        self.assertEqual(cm.exception.status_code, 400)
+
+
+class TestCompressResponse(unittest.IsolatedAsyncioTestCase):
+
+    def test_small_responses_stay_plain(self):
+        response = compress_response(Response(b'{"logs": []}'), 'gzip')
+
+        self.assertNotIn('content-encoding', response.headers)
+        self.assertEqual(response.headers['vary'], 'Accept-Encoding')
+
+    def test_large_responses_are_compressed(self):
+        body = b'{"message": "ok"}' * 1000
+        response = compress_response(Response(body), 'gzip')
+
+        self.assertEqual(response.headers['content-encoding'], 'gzip')
+        self.assertEqual(int(response.headers['content-length']), len(response.body))
+        self.assertEqual(gzip.decompress(response.body), body)
+
+    async def test_stream_is_compressed(self):
+        chunks = [chunk async for chunk in compress_stream(stream(b'a\n', b'b\n'), 'gzip')]
+
+        self.assertEqual(gzip.decompress(b''.join(chunks)), b'a\nb\n')
@@ -1,6 +1,7 @@
 import unittest
 from unittest.mock import patch, MagicMock
 from fastapi import HTTPException
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from db_nosql import Nosql
 
 class TestNosql(unittest.TestCase):
@@ -74,6 +75,16 @@ class TestNosql(unittest.TestCase):
 
         self.mock_collection.insert_one.assert_not_called()
 
+    def test_store_company_in_db_concurrent_duplicate_raises_exception(self):
+
+        self.mock_collection.find_one.return_value = None
+        self.mock_collection.insert_one.side_effect = DuplicateKeyError('E11000 duplicate key error')
+
+        with self.assertRaises(HTTPException) as cm:
+            self.nosql.store_company_in_db('ABC123', 'ABC123', 'MyCompany', {'a@example.com'})
+
+        self.assertEqual(cm.exception.status_code, 409)
+
     def test_store_company_in_db_successfully_inserts_company(self):
 
         self.mock_collection.find_one.return_value = None
@@ -141,4 +152,43 @@ class TestNosql(unittest.TestCase):
 
         self.mock_collection.find.assert_called_once_with(filters)
 
-        self.assertEqual(result, expected_result)
\ No newline at end of file
+        self.assertEqual(result, expected_result)
+    @patch('db_nosql.Nosql.get_company')
+    def test_store_logs_in_db_uses_single_unordered_insert_many(self, mock_get_company):
+        mock_get_company.return_value = {'company_id': '12345'}
+        logs = [{'level': 'INFO', 'message': 'one'}, {'level': 'ERROR', 'message': 'two'}]
+
+        result = self.nosql.store_logs_in_db(logs, 'MyCompany')
+
+        mock_get_company.assert_called_once_with('MyCompany')
+        args, kwargs = self.mock_collection.insert_many.call_args
+        self.assertEqual([doc['log']['message'] for doc in args[0]], ['one', 'two'])
+        self.assertTrue(all(doc['company_id'] == '12345' for doc in args[0]))
+        self.assertEqual(kwargs, {'ordered': False})
+        self.assertEqual(result, {})
+
+    @patch('db_nosql.Nosql.get_company')
+    def test_store_logs_in_db_returns_write_errors_by_position(self, mock_get_company):
+        mock_get_company.return_value = {'company_id': '12345'}
+        self.mock_collection.insert_many.side_effect = BulkWriteError(
+            {'writeErrors': [{'index': 1, 'errmsg': 'document too large'}]})
+
+        result = self.nosql.store_logs_in_db([{'level': 'INFO'}, {'level': 'INFO'}], 'MyCompany')
+
+        self.assertEqual(result, {1: 'document too large'})
+
+    def test_store_logs_in_db_empty_batch(self):
+        self.assertEqual(self.nosql.store_logs_in_db([], 'MyCompany'), {})
+        self.mock_collection.insert_many.assert_not_called()
+
+    @patch('db_nosql.Nosql.get_company')
+    def test_store_log_in_db_buffered_mode_queues_document(self, mock_get_company):
+        mock_get_company.return_value = {'company_id': '12345'}
+        self.nosql.write_buffer = MagicMock()
+
+        self.nosql.store_log_in_db({'level': 'INFO', 'message': 'queued'}, 'MyCompany')
+
+        args, _ = self.nosql.write_buffer.put.call_args
+        self.assertEqual(args[0]['company_id'], '12345')
+        self.assertEqual(args[0]['log']['message'], 'queued')
+        self.mock_collection.insert_one.assert_not_called()
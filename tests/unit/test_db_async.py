@@ -0,0 +1,198 @@
+import asyncio
+import unittest
+from dataclasses import replace
+from datetime import timedelta
+from unittest.mock import patch, MagicMock, AsyncMock
+from fastapi import HTTPException
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from db_nosql_async import AsyncNosql
+
+
+class TestAsyncNosql(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.mock_db = MagicMock()
+        self.mock_collection = MagicMock()
+        self.mock_collection.find_one = AsyncMock()
+        self.mock_collection.insert_one = AsyncMock()
+        self.mock_collection.insert_many = AsyncMock()
+        self.mock_db.__getitem__.return_value = self.mock_collection
+
+        self.nosql = AsyncNosql()
+        self.nosql.db = self.mock_db
+
+    def test_construction_does_not_create_the_client(self):
+        nosql = AsyncNosql()
+
+        self.assertIsNone(nosql.conn.client)
+        self.assertFalse(nosql.ready)
+
+    async def test_warm_up_retries_until_mongo_answers(self):
+        nosql = AsyncNosql(replace(self.nosql.settings, warmup_retry_seconds=0, ensure_indexes=False))
+        nosql.db = self.mock_db
+        nosql.conn.ping = AsyncMock(side_effect=[Exception('no servers'), None])
+
+        await nosql.warm_up()
+
+        self.assertEqual(nosql.conn.ping.await_count, 2)
+        self.assertTrue(nosql.ready)
+        self.assertIsNone(nosql.warmup_error)
+
+    async def test_start_returns_before_warm_up_finishes(self):
+        nosql = AsyncNosql()
+        started = asyncio.Event()
+
+        async def slow_ping():
+            started.set()
+            await asyncio.sleep(3600)
+        nosql.conn.ping = slow_ping
+
+        await nosql.start()
+        await started.wait()
+        self.assertFalse(nosql.ready)
+
+        nosql.conn.close = AsyncMock()
+        await nosql.close()
+
+    async def test_verify_company_returns_public_key(self):
+        self.mock_collection.find_one.return_value = {'company_name': 'MyCompany', 'company_public_key': 'ABC123'}
+
+        result = await self.nosql.verify_company('MyCompany')
+
+        self.assertEqual(result, 'ABC123')
+        self.mock_collection.find_one.assert_awaited_once_with({'company_name': 'MyCompany'})
+
+    async def test_verify_company_not_found_raises_exception(self):
+        self.mock_collection.find_one.return_value = None
+
+        with self.assertRaises(HTTPException) as cm:
+            await self.nosql.verify_company('UnknownCompany')
+
+        self.assertEqual(cm.exception.status_code, 404)
+
+    async def test_store_company_in_db_existing_company_raises_exception(self):
+        self.mock_collection.find_one.return_value = {'company_name': 'MyCompany'}
+
+        with self.assertRaises(HTTPException) as cm:
+            await self.nosql.store_company_in_db('ABC123', 'PUBKEY', 'MyCompany', ['a@example.com'])
+
+        self.assertEqual(cm.exception.status_code, 409)
+        self.mock_collection.insert_one.assert_not_awaited()
+
+    async def test_store_company_in_db_concurrent_duplicate_raises_exception(self):
+        self.mock_collection.find_one.return_value = None
+        self.mock_collection.insert_one.side_effect = DuplicateKeyError('E11000 duplicate key error')
+
+        with self.assertRaises(HTTPException) as cm:
+            await self.nosql.store_company_in_db('ABC123', 'PUBKEY', 'MyCompany', ['a@example.com'])
+
+        self.assertEqual(cm.exception.status_code, 409)
+
+    @patch('db_nosql_async.AsyncNosql.get_company')
+    async def test_store_log_in_db(self, mock_get_company):
+        mock_get_company.return_value = {'company_id': '12345'}
+
+        await self.nosql.store_log_in_db({'level': 'ERROR', 'message': 'Something happened.'}, 'MyCompany')
+
+        inserted_doc = self.mock_collection.insert_one.call_args.args[0]
+        self.assertEqual(inserted_doc['company_id'], '12345')
+        self.assertEqual(inserted_doc['company_name'], 'MyCompany')
+        self.assertEqual(inserted_doc['log']['message'], 'Something happened.')
+        self.assertIn('received_at', inserted_doc)
+
+    @patch('db_nosql_async.AsyncNosql.get_company')
+    async def test_store_logs_in_db_returns_write_errors_by_position(self, mock_get_company):
+        mock_get_company.return_value = {'company_id': '12345'}
+        self.mock_collection.insert_many.side_effect = BulkWriteError(
+            {'writeErrors': [{'index': 0, 'errmsg': 'document too large'}]})
+
+        result = await self.nosql.store_logs_in_db([{'level': 'INFO'}, {'level': 'INFO'}], 'MyCompany')
+
+        self.assertEqual(self.mock_collection.insert_many.call_args.kwargs, {'ordered': False})
+        self.assertEqual(result, {0: 'document too large'})
+
+    @patch('db_nosql_async.AsyncNosql.get_company')
+    async def test_store_logs_in_db_counts_only_stored_logs_in_rollups(self, mock_get_company):
+        mock_get_company.return_value = {'company_id': '12345'}
+        self.mock_collection.insert_many.side_effect = BulkWriteError(
+            {'writeErrors': [{'index': 0, 'errmsg': 'document too large'}]})
+        self.nosql.rollups = MagicMock()
+
+        await self.nosql.store_logs_in_db([{'level': 'INFO', 'message': 'a'}, {'level': 'INFO', 'message': 'b'}],
+                                          'MyCompany')
+
+        self.nosql.rollups.add.assert_called_once()
+        self.assertEqual(self.nosql.rollups.add.call_args.args[0]['log']['message'], 'b')
+
+    async def test_search_log_in_db_shapes_results_in_aggregation(self):
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=[{'message': 'ok', 'company_id': '12345'}])
+        self.mock_collection.aggregate = AsyncMock(return_value=cursor)
+
+        result = await self.nosql.search_log_in_db({'log.level': 'ERROR'}, limit=11)
+
+        pipeline = self.mock_collection.aggregate.call_args.args[0]
+        self.assertEqual(pipeline[:3], [{'$match': {'log.level': 'ERROR'}},
+                                        {'$sort': {'received_at': -1, '_id': -1}},
+                                        {'$limit': 11}])
+        self.assertEqual(pipeline[3]['$setWindowFields']['sortBy'], {'received_at': -1, '_id': -1})
+        self.assertIn('$replaceRoot', pipeline[4])
+        self.assertEqual(result, [{'message': 'ok', 'company_id': '12345'}])
+
+    async def test_search_ranked_logs_in_db_sorts_by_text_score(self):
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=[])
+        self.mock_collection.aggregate = AsyncMock(return_value=cursor)
+        after = {'$or': [{'score': {'$lt': 1.5}}]}
+
+        await self.nosql.search_ranked_logs_in_db({'company_id': '12345', '$text': {'$search': 'timeout'}},
+                                                  after=after, limit=11)
+
+        pipeline = self.mock_collection.aggregate.call_args.args[0]
+        self.assertEqual(pipeline[1], {'$addFields': {'score': {'$meta': 'textScore'}}})
+        self.assertEqual(pipeline[2], {'$match': after})
+        self.assertEqual(pipeline[3], {'$sort': {'score': -1, 'received_at': -1, '_id': -1}})
+        self.assertEqual(pipeline[4], {'$limit': 11})
+
+    async def test_count_logs_in_db_groups_by_bucket_and_dimensions(self):
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=[{'_id': None, 'time': ['t0', 't1'], 'd0': ['api', 'api'],
+                                                  'd1': ['db', 'db'], 'count': [3, 1]}])
+        self.mock_collection.aggregate = AsyncMock(return_value=cursor)
+
+        result = await self.nosql.count_logs_in_db({'company_id': '12345'}, ['service', 'tag'], 'minute', 5)
+
+        pipeline = self.mock_collection.aggregate.call_args.args[0]
+        self.assertEqual(pipeline[0], {'$match': {'company_id': '12345'}})
+        self.assertEqual(pipeline[1], {'$unwind': '$log.tags'})
+        self.assertEqual(pipeline[2]['$group']['_id'],
+                         {'d0': '$log.service', 'd1': '$log.tags',
+                          'time': {'$dateTrunc': {'date': '$received_at', 'unit': 'minute', 'binSize': 5}}})
+        self.assertEqual(result, {'time': ['t0', 't1'], 'service': ['api', 'api'], 'tag': ['db', 'db'],
+                                  'count': [3, 1]})
+
+    async def test_count_logs_in_db_without_matches_returns_empty_columns(self):
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=[])
+        self.mock_collection.aggregate = AsyncMock(return_value=cursor)
+
+        result = await self.nosql.count_logs_in_db({'company_id': '12345'}, ['level'])
+
+        self.assertEqual(result, {'level': [], 'count': []})
+
+    async def test_store_log_in_db_sets_expiry_from_company_retention(self):
+        company = {'company_id': '12345', 'company_name': 'MyCompany', 'retention': {'retention_days': 30}}
+
+        await self.nosql.store_log_in_db({'level': 'INFO', 'message': 'ok'}, 'MyCompany', company)
+
+        document = self.mock_collection.insert_one.call_args.args[0]
+        self.assertEqual(document['expires_at'] - document['received_at'], timedelta(days=30))
+
+    @patch('db_nosql_async.AsyncNosql.get_company')
+    async def test_store_log_in_db_with_resolved_company_skips_lookup(self, mock_get_company):
+        company = {'company_id': '12345', 'company_name': 'MyCompany'}
+
+        await self.nosql.store_log_in_db({'level': 'INFO', 'message': 'ok'}, 'MyCompany', company)
+
+        mock_get_company.assert_not_called()
+        self.assertEqual(self.mock_collection.insert_one.call_args.args[0]['company_id'], '12345')
@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure
+from indexes import IndexManager, declared_indexes
+
+
+class AsyncIterator:
+    def __init__(self, items):
+        self.items = list(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.items:
+            raise StopAsyncIteration
+        return self.items.pop(0)
+
+
+class TestIndexManager(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.collection = MagicMock()
+        self.collection.create_indexes = AsyncMock(return_value=['a_1'])
+        self.db = MagicMock()
+        self.db.__getitem__.return_value = self.collection
+        self.indexes = {'logs': [IndexModel([('a', 1)], name='a_1'), IndexModel([('b', 1)], name='b_1')]}
+
+    def test_declared_indexes_cover_search_filters_and_unique_company_name(self):
+        indexes = declared_indexes()
+        logs = {m.document['name']: m.document for m in indexes['logs']}
+        companies = {m.document['name']: m.document for m in indexes['companies']}
+
+        self.assertEqual(list(logs['company_received_at']['key']), ['company_id', 'received_at', '_id'])
+        self.assertEqual(list(logs['company_level_received_at']['key']),
+                         ['company_id', 'log.level', 'received_at', '_id'])
+        self.assertIn('log.tags', logs['company_tags_received_at']['key'])
+        self.assertTrue(companies['company_name_unique']['unique'])
+        self.assertEqual(logs['company_message_text']['key']['log.message'], 'text')
+        self.assertEqual(logs['expires_at_ttl']['expireAfterSeconds'], 0)
+
+    async def test_ensure_creates_declared_indexes(self):
+        manager = IndexManager(self.db, self.indexes)
+
+        result = await manager.ensure()
+
+        self.collection.create_indexes.assert_awaited_once_with(self.indexes['logs'])
+        self.assertEqual(result, {'logs': ['a_1']})
+
+    async def test_ensure_survives_conflicting_index(self):
+        self.collection.create_indexes.side_effect = OperationFailure('Index already exists with different options')
+        manager = IndexManager(self.db, self.indexes)
+
+        self.assertEqual(await manager.ensure(), {})
+
+    async def test_report_lists_missing_unused_and_undeclared(self):
+        self.collection.list_indexes = AsyncMock(return_value=AsyncIterator(
+            [{'name': '_id_'}, {'name': 'a_1'}, {'name': 'legacy_1'}]))
+        self.collection.aggregate = AsyncMock(return_value=AsyncIterator(
+            [{'name': '_id_', 'accesses': {'ops': 0}},
+             {'name': 'a_1', 'accesses': {'ops': 10}},
+             {'name': 'legacy_1', 'accesses': {'ops': 0}}]))
+        manager = IndexManager(self.db, self.indexes)
+
+        report = await manager.report()
+
+        self.assertEqual(report['logs'], {'missing': ['b_1'], 'unused': ['legacy_1'], 'undeclared': ['legacy_1']})
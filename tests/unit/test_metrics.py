@@ -0,0 +1,60 @@
+import unittest
+from types import SimpleNamespace
+
+from metrics import Counter, Gauge, Histogram, MongoCommandMetrics, MONGO_OPERATION_SECONDS, Registry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_is_rendered_with_cumulative_buckets(self):
+        registry = Registry()
+        histogram = registry.register(Histogram('stage_seconds', 'Stage time.', ('stage',), buckets=(0.1, 1)))
+        histogram.observe(0.05, 'store')
+        histogram.observe(0.5, 'store')
+        histogram.observe(5, 'store')
+
+        text = registry.render()
+
+        self.assertIn('# TYPE stage_seconds histogram', text)
+        self.assertIn('stage_seconds_bucket{stage="store",le="0.1"} 1', text)
+        self.assertIn('stage_seconds_bucket{stage="store",le="1"} 2', text)
+        self.assertIn('stage_seconds_bucket{stage="store",le="+Inf"} 3', text)
+        self.assertIn('stage_seconds_sum{stage="store"} 5.55', text)
+        self.assertIn('stage_seconds_count{stage="store"} 3', text)
+
+    def test_timer_observes_its_block(self):
+        histogram = Histogram('stage_seconds', 'Stage time.', ('stage',))
+
+        with histogram.time('validate'):
+            pass
+
+        (name, labels, value), = [sample for sample in histogram.samples() if sample[0].endswith('_count')]
+        self.assertEqual((labels, value), ('{stage="validate"}', 1))
+
+    def test_counter_and_gauge(self):
+        registry = Registry()
+        counter = registry.register(Counter('logs_total', 'Logs.', ('company',)))
+        registry.register(Gauge('threads', 'Threads.', lambda: {('busy',): 3}, ('state',)))
+        counter.inc('acme')
+        counter.inc('acme', amount=4)
+        counter.inc('we"ird')
+
+        text = registry.render()
+
+        self.assertIn('logs_total{company="acme"} 5', text)
+        self.assertIn('logs_total{company="we\\"ird"} 1', text)
+        self.assertIn('threads{state="busy"} 3', text)
+
+    def test_mongo_listener_records_collection_and_operation(self):
+        listener = MongoCommandMetrics()
+        started = SimpleNamespace(command={'insert': 'logs_test', 'documents': []}, command_name='insert',
+                                  connection_id=('localhost', 27017), request_id=7)
+
+        listener.started(started)
+        listener.succeeded(SimpleNamespace(command_name='insert', connection_id=('localhost', 27017),
+                                           request_id=7, duration_micros=1500))
+
+        counts = {labels: value for name, labels, value in MONGO_OPERATION_SECONDS.samples()
+                  if name.endswith('_count')}
+        self.assertGreaterEqual(counts['{collection="logs_test",operation="insert",outcome="ok"}'], 1)
+        self.assertEqual(listener._collections, {})
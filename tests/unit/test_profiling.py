@@ -0,0 +1,96 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from metrics import Histogram
+from profiling import RequestProfiler, SlowRequestLog, explain_summary, note, note_query
+
+EXPLAIN = {'stages': [{'$cursor': {'queryPlanner': {
+               'winningPlan': {'stage': 'LIMIT', 'inputStage': {
+                   'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': 'company_received_at'}}},
+               'rejectedPlans': [{}]}}},
+           {'$replaceRoot': {}}]}
+
+
+async def slow_search(scope, receive, send):
+    note('filters', {'company_id': 'c1'})
+    note_query('logs', [{'$match': {'company_id': 'c1'}}])
+    with Histogram('stage_seconds', 'Stage time.', ('stage',)).time('search.query'):
+        await asyncio.sleep(0.01)
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b'{}'})
+
+
+def http_scope(headers=()):
+    return {'type': 'http', 'method': 'POST', 'path': '/logs/search', 'query_string': b'', 'headers': list(headers)}
+
+
+async def call(middleware, scope):
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        pass
+
+    await middleware(scope, receive, send)
+
+
+class TestExplainSummary(unittest.TestCase):
+
+    def test_summary_of_an_aggregate_explain(self):
+        self.assertEqual(explain_summary(EXPLAIN), {'plan': ['LIMIT', 'FETCH', 'IXSCAN'],
+                                                    'indexes': ['company_received_at'],
+                                                    'collection_scan': False,
+                                                    'rejected_plans': 1,
+                                                    'pipeline': ['$replaceRoot']})
+
+    def test_collection_scan_is_flagged(self):
+        summary = explain_summary({'queryPlanner': {'winningPlan': {'stage': 'COLLSCAN'}}})
+
+        self.assertTrue(summary['collection_scan'])
+
+
+class TestRequestProfiler(unittest.IsolatedAsyncioTestCase):
+
+    def test_log_is_bounded(self):
+        log = SlowRequestLog(max_entries=2)
+        for i in range(3):
+            log.add({'path': str(i)})
+
+        self.assertEqual([entry['path'] for entry in log.recent()], ['2', '1'])
+
+    @patch.dict('os.environ', {'SLOW_REQUEST_SECONDS': '0.005'})
+    async def test_slow_request_is_captured_with_stages_and_explain(self):
+        log = SlowRequestLog()
+        explain = AsyncMock(return_value=EXPLAIN)
+        middleware = RequestProfiler(slow_search, explain=explain, log=log)
+
+        await call(middleware, http_scope())
+        await asyncio.gather(*middleware._explains)
+
+        capture, = log.recent()
+        self.assertEqual((capture['path'], capture['status']), ('/logs/search', 200))
+        self.assertEqual(capture['filters'], {'company_id': 'c1'})
+        self.assertGreaterEqual(capture['stages']['search.query'], 10)
+        self.assertEqual(capture['explain'][0]['indexes'], ['company_received_at'])
+        explain.assert_awaited_once_with('logs', [{'$match': {'company_id': 'c1'}}])
+
+    @patch.dict('os.environ', {'SLOW_REQUEST_SECONDS': '10'})
+    async def test_fast_requests_are_not_captured(self):
+        log = SlowRequestLog()
+
+        await call(RequestProfiler(slow_search, log=log), http_scope())
+
+        self.assertEqual(len(log), 0)
+
+    @patch.dict('os.environ', {'SLOW_REQUEST_SECONDS': '10', 'ADMIN_TOKEN': 'secret'})
+    async def test_profile_header_needs_the_admin_token(self):
+        log = SlowRequestLog()
+        middleware = RequestProfiler(slow_search, log=log)
+
+        await call(middleware, http_scope([(b'x-profile', b'wrong')]))
+        self.assertEqual(len(log), 0)
+
+        await call(middleware, http_scope([(b'x-profile', b'secret')]))
+        capture, = log.recent()
+        self.assertIn(capture['profile']['engine'], ('sampler', 'pyinstrument'))
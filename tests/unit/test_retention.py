@@ -0,0 +1,116 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+from bson import ObjectId
+from retention import LogArchive, LogArchiver, expires_at, matches, retention_policy
+
+
+def log_document(received_at, level='ERROR', tags=None):
+    return {'_id': ObjectId(), 'company_id': '12345', 'company_name': 'MyCompany', 'received_at': received_at,
+            'log': {'level': level, 'message': 'm', 'tags': tags or [], 'user': {'name': 'Alberto'}}}
+
+
+class TestRetentionPolicy(unittest.TestCase):
+
+    def test_company_settings_override_defaults(self):
+        company = {'retention': {'hot_days': 7, 'retention_days': 90}}
+
+        self.assertEqual(retention_policy(company, (0, 0)), (7, 90))
+        self.assertEqual(retention_policy({}, (0, 0)), (None, None))
+        self.assertEqual(retention_policy({'retention': {'hot_days': 3}}, (7, 30)), (3, 30))
+        self.assertEqual(expires_at(company, datetime(2024, 5, 1), (0, 0)), datetime(2024, 7, 30))
+        self.assertIsNone(expires_at({}, datetime(2024, 5, 1), (0, 0)))
+        self.assertEqual(expires_at({}, datetime(2024, 5, 1), (0, 1)), datetime(2024, 5, 2))
+
+    def test_matches_search_filters(self):
+        document = log_document(datetime(2024, 5, 1), tags=['db'])
+
+        self.assertTrue(matches(document, {'log.level': 'ERROR', 'log.tags': {'$in': ['db', 'api']}}))
+        self.assertFalse(matches(document, {'log.user.name': 'Other'}))
+        self.assertFalse(matches(document, {'log.tags': {'$in': ['api']}}))
+
+
+class TestLogArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.archive = LogArchive(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_write_partitions_by_day_and_search_newest_first(self):
+        documents = [log_document(datetime(2024, 5, 1, 10)), log_document(datetime(2024, 5, 1, 12), level='INFO'),
+                     log_document(datetime(2024, 5, 2, 9))]
+        self.archive.write('12345', documents)
+
+        manifest = self.archive.load_manifest()
+        self.assertEqual(sorted(manifest['12345']), ['2024-05-01', '2024-05-02'])
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, '12345', '2024', '05', '01.ndjson.gz')))
+
+        result = self.archive.search('12345', {'log.level': 'ERROR'}, datetime(2024, 5, 1), datetime(2024, 5, 3))
+        self.assertEqual([log['position']['received_at'] for log in result],
+                         [datetime(2024, 5, 2, 9), datetime(2024, 5, 1, 10)])
+        self.assertEqual(result[0]['position']['_id'], documents[2]['_id'])
+        self.assertEqual(result[0]['message'], 'm')
+
+        before = (documents[2]['received_at'], documents[2]['_id'])
+        result = self.archive.search('12345', {}, datetime(2024, 5, 1), datetime(2024, 5, 3), before=before, limit=1)
+        self.assertEqual([log['position']['_id'] for log in result], [documents[1]['_id']])
+
+    def test_rewriting_archived_documents_does_not_duplicate_them(self):
+        documents = [log_document(datetime(2024, 5, 1, 10))]
+        self.archive.write('12345', documents)
+        self.archive.write('12345', documents + [log_document(datetime(2024, 5, 1, 11))])
+
+        self.assertEqual(self.archive.load_manifest()['12345']['2024-05-01']['count'], 2)
+        self.assertEqual(len(self.archive.search('12345', {}, datetime(2024, 5, 1), datetime(2024, 5, 2))), 2)
+
+    def test_checked_days_are_read_back_once(self):
+        self.archive.write('12345', [log_document(datetime(2024, 5, 1, 10))])
+        checked_days = set()
+
+        with patch.object(self.archive, 'read_partition', wraps=self.archive.read_partition) as read_partition:
+            self.archive.write('12345', [log_document(datetime(2024, 5, 1, 11))], checked_days)
+            self.archive.write('12345', [log_document(datetime(2024, 5, 1, 12)),
+                                         log_document(datetime(2024, 5, 2, 9))], checked_days)
+
+        self.assertEqual(read_partition.call_count, 1)
+        self.assertEqual(checked_days, {datetime(2024, 5, 1).date(), datetime(2024, 5, 2).date()})
+        self.assertEqual(self.archive.load_manifest()['12345']['2024-05-01']['count'], 3)
+
+    def test_drop_before_removes_old_partitions(self):
+        self.archive.write('12345', [log_document(datetime(2024, 5, 1)), log_document(datetime(2024, 5, 3))])
+
+        removed = self.archive.drop_before('12345', datetime(2024, 5, 2).date())
+
+        self.assertEqual(removed, 1)
+        self.assertEqual(list(self.archive.load_manifest()['12345']), ['2024-05-03'])
+
+
+class TestLogArchiver(unittest.TestCase):
+
+    def test_moves_logs_older_than_hot_window_then_applies_retention(self):
+        logs, companies = MagicMock(), MagicMock()
+        db = MagicMock()
+        db.__getitem__.side_effect = lambda name: {'logs': logs, 'companies': companies}[name]
+        companies.find.return_value = [{'company_id': '12345', 'company_name': 'MyCompany',
+                                        'retention': {'hot_days': 7, 'retention_days': 30}}]
+        old = [log_document(datetime(2024, 5, 1, hour)) for hour in range(3)]
+        logs.find.return_value.sort.return_value.batch_size.return_value = iter(old)
+        archive = MagicMock()
+        archive.drop_before.return_value = 0
+
+        with patch.dict(os.environ, {'COLLECTION_LOGS': 'logs', 'COLLECTION_COMPANIES': 'companies'}):
+            summary = LogArchiver(db, archive, batch_size=2).run(now=datetime(2024, 5, 10, 15, 30))
+
+        self.assertEqual(logs.find.call_args.args[0],
+                         {'company_id': '12345', 'received_at': {'$lt': datetime(2024, 5, 3)}})
+        self.assertEqual([len(call.args[1]) for call in archive.write.call_args_list], [2, 1])
+        self.assertIs(archive.write.call_args_list[0].args[2], archive.write.call_args_list[1].args[2])
+        self.assertEqual(logs.delete_many.call_count, 2)
+        archive.drop_before.assert_called_once_with('12345', (datetime(2024, 5, 10) - timedelta(days=30)).date())
+        self.assertEqual(summary, {'MyCompany': {'archived': 3, 'dropped': 0}})
@@ -0,0 +1,142 @@
+import unittest
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+from rollups import RollupAggregator, RollupStore, rollup_segments
+
+
+class AsyncIterator:
+    def __init__(self, items):
+        self.items = list(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.items:
+            raise StopAsyncIteration
+        return self.items.pop(0)
+
+
+class TestRollupSegments(unittest.TestCase):
+
+    def test_uses_compacted_days_and_hours_for_the_middle_of_the_range(self):
+        start = datetime(2024, 5, 1, 22, 30)
+        end = datetime(2024, 5, 4, 1, 15)
+        watermarks = {'hour': datetime(2024, 5, 4, 0, 0), 'day': datetime(2024, 5, 4, 0, 0)}
+
+        segments = rollup_segments(start, end, watermarks)
+
+        self.assertEqual(segments, [('minute', start, datetime(2024, 5, 1, 23, 0)),
+                                    ('hour', datetime(2024, 5, 1, 23, 0), datetime(2024, 5, 2, 0, 0)),
+                                    ('day', datetime(2024, 5, 2, 0, 0), datetime(2024, 5, 4, 0, 0)),
+                                    ('minute', datetime(2024, 5, 4, 0, 0), end)])
+
+    def test_falls_back_to_minutes_without_watermarks_or_finer_buckets(self):
+        start, end = datetime(2024, 5, 1), datetime(2024, 5, 3)
+        watermarks = {'hour': datetime(2024, 5, 3), 'day': datetime(2024, 5, 3)}
+
+        self.assertEqual(rollup_segments(start, end, {}), [('minute', start, end)])
+        self.assertEqual(rollup_segments(start, end, watermarks, max_unit='minute'), [('minute', start, end)])
+        self.assertEqual(rollup_segments(start, end, watermarks, max_unit='hour'), [('hour', start, end)])
+
+
+class TestRollupStore(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.collection = MagicMock()
+        self.collection.name = 'log_rollups'
+        self.collection.bulk_write = AsyncMock()
+        self.collection.update_one = AsyncMock()
+        self.store = RollupStore(self.collection, grace=120)
+
+    async def test_increment_writes_one_upsert_per_key(self):
+        minute = datetime(2024, 5, 1, 12, 0)
+
+        await self.store.increment({('12345', minute, 'ERROR', 'api'): 3, ('12345', minute, 'INFO', 'api'): 1})
+
+        requests = self.collection.bulk_write.call_args.args[0]
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[0]._doc, {'$inc': {'count': 3}})
+        self.assertTrue(requests[0]._upsert)
+        self.assertFalse(self.collection.bulk_write.call_args.kwargs['ordered'])
+
+    async def test_counting_start_is_the_next_whole_minute_and_keeps_the_earliest(self):
+        await self.store.mark_start(datetime(2024, 5, 1, 12, 0, 30))
+
+        self.assertEqual(self.collection.update_one.call_args.args,
+                         (RollupStore.START_MARK, {'$min': {'counting_since': datetime(2024, 5, 1, 12, 1)}}))
+        self.assertTrue(self.collection.update_one.call_args.kwargs['upsert'])
+
+        self.collection.find_one = AsyncMock(return_value=None)
+        self.assertIsNone(await self.store.counting_since())
+        self.collection.find_one = AsyncMock(return_value={**RollupStore.START_MARK,
+                                                           'counting_since': datetime(2024, 5, 1, 12, 1)})
+        self.assertEqual(await self.store.counting_since(), datetime(2024, 5, 1, 12, 1))
+
+    async def test_compact_hours_after_the_watermark_and_moves_it(self):
+        self.collection.find = MagicMock(return_value=AsyncIterator(
+            [{'unit': 'hour', 'compacted_until': datetime(2024, 5, 1, 10, 0)}]))
+        cursor = MagicMock()
+        cursor.to_list = AsyncMock(return_value=[])
+        self.collection.aggregate = AsyncMock(return_value=cursor)
+
+        until = await self.store.compact('hour', now=datetime(2024, 5, 1, 12, 1))
+
+        self.assertEqual(until, datetime(2024, 5, 1, 11, 0))  # 12:00 is still inside the grace period
+        pipeline = self.collection.aggregate.call_args.args[0]
+        self.assertEqual(pipeline[0]['$match']['bucket'], {'$gte': datetime(2024, 5, 1, 10, 0),
+                                                           '$lt': datetime(2024, 5, 1, 11, 0)})
+        self.assertEqual(pipeline[-1]['$merge']['whenMatched'], 'replace')
+        self.collection.update_one.assert_awaited_once()
+        self.assertEqual(self.collection.update_one.call_args.args[1], {'$set': {'compacted_until': until}})
+
+    async def test_compact_days_waits_for_hour_compaction(self):
+        self.collection.find = MagicMock(return_value=AsyncIterator([]))
+        self.collection.aggregate = AsyncMock()
+
+        self.assertIsNone(await self.store.compact('day', now=datetime(2024, 5, 3)))
+        self.collection.aggregate.assert_not_called()
+
+
+class TestRollupAggregator(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.store = MagicMock()
+        self.store.increment = AsyncMock()
+        self.aggregator = RollupAggregator(self.store, flush_interval=0.05)
+
+    def document(self, second, level='ERROR'):
+        return {'company_id': '12345', 'received_at': datetime(2024, 5, 1, 12, 0, second),
+                'log': {'level': level, 'service': 'api'}}
+
+    async def test_counts_are_coalesced_per_minute_level_and_service(self):
+        for second in (1, 20, 59):
+            self.aggregator.add(self.document(second))
+        self.aggregator.add(self.document(5, level='INFO'))
+
+        await self.aggregator.flush()
+
+        self.store.increment.assert_awaited_once_with({
+            ('12345', datetime(2024, 5, 1, 12, 0), 'ERROR', 'api'): 3,
+            ('12345', datetime(2024, 5, 1, 12, 0), 'INFO', 'api'): 1})
+        self.assertEqual(self.aggregator.stats()['pending_keys'], 0)
+
+    async def test_failed_flush_keeps_the_counts(self):
+        self.store.increment.side_effect = Exception('mongo down')
+        self.aggregator.add(self.document(1))
+
+        await self.aggregator.flush()
+        self.aggregator.add(self.document(2))
+
+        self.assertEqual(self.aggregator._counters, {('12345', datetime(2024, 5, 1, 12, 0), 'ERROR', 'api'): 2})
+        self.assertEqual(self.aggregator.stats()['failed_flushes'], 1)
+
+    async def test_stop_flushes_pending_counters(self):
+        self.aggregator.start()
+        self.aggregator.add(self.document(1))
+
+        await self.aggregator.stop()
+
+        self.store.increment.assert_awaited()
+        self.assertEqual(self.aggregator.stats()['pending_keys'], 0)
@@ -1,16 +1,22 @@
+import gzip
+import json
+import time
 import unittest
+from dataclasses import replace
 from types import SimpleNamespace
 
 import jwt
 import uuid
+from bson import ObjectId
 from datetime import datetime, timezone, timedelta
 from services import Service
+from routers.router import AlertPolicySchema
 from fastapi import HTTPException
 from unittest.mock import MagicMock, patch
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 
-class TestServices(unittest.TestCase):
+class TestServices(unittest.IsolatedAsyncioTestCase):
     @classmethod
     def setUp(cls):
         cls.service = Service()
@@ -127,14 +133,14 @@ class TestServices(unittest.TestCase):
 
     @patch('services.config')
     @patch('services.Service.send_email')
-    def test_send_registration_email_calls_send_email_correctly(self, mock_send_email, mock_config):
+    async def test_send_registration_email_calls_send_email_correctly(self, mock_send_email, mock_config):
         mock_config.side_effect = lambda key: {
             'SENDER_MAIL': 'test@example.com',
             'PASSWORD': '1234'
         }[key]
 
         cls = self.__class__
-        cls.service.send_registration_email('user@example.com', 'token123')
+        await cls.service.send_registration_email('user@example.com', 'token123')
 
         mock_send_email.assert_called_once()
         args, kwargs = mock_send_email.call_args
@@ -171,43 +177,131 @@ class TestServices(unittest.TestCase):
         self.assertEqual(cm.exception.status_code, 401)
         self.assertEqual(cm.exception.detail, 'Invalid token.')
 
-    @patch('services.jwt.decode')
-    @patch('services.Nosql.verify_company')
-    def test_verify_logs_token(self, mock_verify_company, mock_jwt_decode):
+    @patch('services.AsyncNosql.verify_company')
+    async def test_verify_logs_token(self, mock_verify_company):
+        mock_verify_company.return_value = self.public_pem
+        token = jwt.encode({'iss': 'empresa_alberto', 'sub': 'alberto',
+                            'exp': datetime.now(timezone.utc) + timedelta(hours=1)},
+                           self.private_pem, algorithm='RS256')
         mock_credentials = MagicMock()
-        mock_credentials.credentials = 'fake.jwt.token'
-        mock_jwt_decode.side_effect = [{'iss': 'empresa_alberto'}, {'sub': 'alberto'}]
+        mock_credentials.credentials = token
 
-        mock_verify_company.return_value = 'mi_clave_publica'
+        result = await self.service.verify_logs_token(mock_credentials)
 
-        result = self.service.verify_logs_token(mock_credentials)
+        mock_verify_company.assert_called_once_with('empresa_alberto')
+        self.assertEqual(result['sub'], 'alberto')
 
-        assert mock_jwt_decode.call_count == 2
+    @patch('services.AsyncNosql.verify_company')
+    async def test_verify_logs_token_caches_verified_tokens(self, mock_verify_company):
+        mock_verify_company.return_value = self.public_pem
+        token = jwt.encode({'iss': 'empresa_alberto', 'exp': datetime.now(timezone.utc) + timedelta(hours=1)},
+                           self.private_pem, algorithm='RS256')
+        mock_credentials = MagicMock()
+        mock_credentials.credentials = token
+
+        with patch('services.jwt.decode', wraps=jwt.decode) as mock_decode:
+            first = await self.service.verify_logs_token(mock_credentials)
+            second = await self.service.verify_logs_token(mock_credentials)
+
+        # Unverified read of 'iss' and the verification, on the first call only
+        self.assertEqual(mock_decode.call_count, 2)
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.service.verified_tokens), 1)
+
+    @patch('services.AsyncNosql.verify_company')
+    async def test_claims_are_validated_by_pyjwt(self, mock_verify_company):
+        mock_verify_company.return_value = self.public_pem
+        exp = datetime.now(timezone.utc) + timedelta(hours=1)
+        cases = [({'sub': 123}, False), ({'jti': 123}, False), ({'aud': 'someone'}, False), ({'aud': []}, True)]
+
+        for claims, accepted in cases:
+            with self.subTest(claims=claims):
+                mock_credentials = MagicMock()
+                mock_credentials.credentials = jwt.encode({'iss': 'empresa_alberto', 'exp': exp, **claims},
+                                                          self.private_pem, algorithm='RS256')
+                if accepted:
+                    result = await self.service.verify_logs_token(mock_credentials)
+                    self.assertEqual(result['iss'], 'empresa_alberto')
+                else:
+                    with self.assertRaises(HTTPException) as cm:
+                        await self.service.verify_logs_token(mock_credentials)
+                    self.assertEqual(cm.exception.status_code, 401)
+
+    def test_token_lifetime(self):
+        self.assertEqual(Service.token_lifetime({}, 3600), 3600)
+        self.assertEqual(Service.token_lifetime({'exp': time.time() + 10 ** 6}, 3600), 3600)
+        self.assertAlmostEqual(Service.token_lifetime({'exp': time.time() + 30}, 3600), 30, delta=1)
+
+    @patch('services.AsyncNosql.verify_company')
+    async def test_verified_token_is_checked_again_after_re_registration(self, mock_verify_company):
+        mock_verify_company.return_value = self.public_pem
+        token = jwt.encode({'iss': 'empresa_alberto', 'exp': datetime.now(timezone.utc) + timedelta(hours=1)},
+                           self.private_pem, algorithm='RS256')
+        mock_credentials = MagicMock()
+        mock_credentials.credentials = token
+        await self.service.verify_logs_token(mock_credentials)
 
-        mock_jwt_decode.assert_any_call(
-            mock_credentials.credentials,
-            options={'verify_signature': False},
-        )
+        # The company registers again with a new key: tokens signed with the old one stop working
+        new_key = rsa.generate_private_key(public_exponent=65537, key_size=2048).public_key()
+        mock_verify_company.return_value = new_key.public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo).decode('utf-8')
+        self.service.issuer_keys.invalidate('empresa_alberto')
+
+        with self.assertRaises(HTTPException) as cm:
+            await self.service.verify_logs_token(mock_credentials)
+        self.assertEqual(cm.exception.status_code, 401)
+
+    @patch('services.AsyncNosql.verify_company')
+    async def test_expired_token_is_rejected(self, mock_verify_company):
+        mock_verify_company.return_value = self.public_pem
+        token = jwt.encode({'iss': 'empresa_alberto', 'exp': datetime.now(timezone.utc) - timedelta(seconds=5)},
+                           self.private_pem, algorithm='RS256')
+        mock_credentials = MagicMock()
+        mock_credentials.credentials = token
+
+        with self.assertRaises(HTTPException) as cm:
+            await self.service.verify_logs_token(mock_credentials)
+
+        self.assertEqual(cm.exception.detail, 'Token has expired.')
+        self.assertEqual(len(self.service.verified_tokens), 0)
+
+    @patch('services.AsyncNosql.verify_company')
+    async def test_verify_logs_token_reuses_cached_issuer_key(self, mock_verify_company):
+        mock_verify_company.return_value = self.public_pem
+        token = jwt.encode({'iss': 'empresa_alberto', 'exp': datetime.now(timezone.utc) + timedelta(hours=1)},
+                           self.private_pem, algorithm='RS256')
+        mock_credentials = MagicMock()
+        mock_credentials.credentials = token
+
+        first = await self.service.verify_logs_token(mock_credentials)
+        second = await self.service.verify_logs_token(mock_credentials)
 
         mock_verify_company.assert_called_once_with('empresa_alberto')
+        self.assertEqual(first['iss'], 'empresa_alberto')
+        self.assertEqual(first, second)
 
-        mock_jwt_decode.assert_any_call(
-            mock_credentials.credentials,
-            'mi_clave_publica',
-            algorithms='RS256',
-        )
+    @patch('services.AsyncNosql.verify_company')
+    async def test_verify_logs_token_caches_unknown_issuer(self, mock_verify_company):
+        mock_verify_company.side_effect = HTTPException(status_code=404, detail='Company does not exist.')
+        token = jwt.encode({'iss': 'desconocida'}, self.private_pem, algorithm='RS256')
+        mock_credentials = MagicMock()
+        mock_credentials.credentials = token
+
+        for _ in range(3):
+            with self.assertRaises(HTTPException) as cm:
+                await self.service.verify_logs_token(mock_credentials)
+            self.assertEqual(cm.exception.status_code, 404)
 
-        self.assertEqual(result, {'sub': 'alberto'})
+        mock_verify_company.assert_called_once_with('desconocida')
 
-    @patch('services.jwt.decode')
-    @patch('services.Nosql.verify_company')
-    def test_verify_logs_token_raise_when_missing_iss_field(self, mock_verify_company, mock_jwt_decode):
+    @patch('services.AsyncNosql.verify_company')
+    async def test_verify_logs_token_raise_when_missing_iss_field(self, mock_verify_company):
         mock_credentials = MagicMock()
-        mock_credentials.credentials = 'fake.jwt.token'
-        mock_jwt_decode.side_effect = [{'sub': 'alberto'}, Exception('No se debería llamar')]
+        mock_credentials.credentials = jwt.encode({'sub': 'alberto'}, self.private_pem, algorithm='RS256')
 
         with self.assertRaises(HTTPException) as cm:
-            self.service.verify_logs_token(mock_credentials)
+            await self.service.verify_logs_token(mock_credentials)
 
         self.assertEqual(cm.exception.status_code, 401)
         self.assertEqual(cm.exception.detail, 'Invalid token: missing "iss" field.')
@@ -238,10 +332,10 @@ class TestServices(unittest.TestCase):
         self.assertEqual(cm.exception.status_code, 400)
         self.assertTrue(cm.exception.detail.startswith('Invalid public key'))
 
-    @patch('services.Nosql')
+    @patch('services.AsyncNosql', autospec=True)
     @patch('services.Service.validate_public_key')
     @patch('services.uuid.uuid4')
-    def test_register_company(self, mock_uuid, mock_validate, mock_nosql):
+    async def test_register_company(self, mock_uuid, mock_validate, mock_nosql):
         mock_uuid.return_value = uuid.UUID('12345678-1234-5678-1234-567812345678')
         mock_validate.return_value = None
 
@@ -254,7 +348,7 @@ class TestServices(unittest.TestCase):
             company_name='MyCompany',
             alert_emails=['alert1@example.com', 'alert2@example.com']
         )
-        result = service.register_company(data)
+        result = await service.register_company(data)
 
         mock_uuid.assert_called_once()
 
@@ -267,36 +361,76 @@ class TestServices(unittest.TestCase):
 
         self.assertEqual(result, '12345678-1234-5678-1234-567812345678')
 
-    @patch('services.Nosql')
+    @patch('services.AsyncNosql', autospec=True)
+    @patch('services.Service.validate_public_key')
+    async def test_register_company_stores_alert_policy(self, mock_validate, mock_nosql):
+        service = Service()
+        data = SimpleNamespace(company_public_key='public_key_example', company_name='MyCompany',
+                               alert_emails=['alert1@example.com'],
+                               alert_policy=AlertPolicySchema(window_seconds=60))
+
+        await service.register_company(data)
+
+        kwargs = mock_nosql.return_value.store_company_in_db.call_args.kwargs
+        self.assertEqual(kwargs['alert_policy'], {'window_seconds': 60})
+
+    @patch('services.AsyncNosql', autospec=True)
+    @patch('services.Service.validate_public_key')
+    async def test_register_company_invalidates_cached_issuer_key(self, mock_validate, mock_nosql):
+        service = Service()
+        service.issuer_keys.set('MyCompany', 'old_key')
+
+        data = SimpleNamespace(company_public_key='public_key_example', company_name='MyCompany',
+                               alert_emails=['alert1@example.com'])
+        await service.register_company(data)
+
+        self.assertIsNone(service.issuer_keys.get('MyCompany'))
+
+    @patch('services.AsyncNosql', autospec=True)
     @patch('services.Service.send_email')
-    def test_send_critical_alert_sends_emails_to_all_alert_recipients(self, mock_send_email, mock_nosql):
+    async def test_send_critical_alert_queues_one_alert_for_all_recipients(self, mock_send_email, mock_nosql):
         mock_nosql_instance = mock_nosql.return_value
         mock_nosql_instance.get_company.return_value = {'alert_emails': ['a@example.com', 'b@example.com']}
 
-        log_data = 'ERROR: Something critical happened!'
+        log_data = {'level': 'ERROR', 'service': 'backend', 'message': 'Something critical happened!'}
         company_name = 'MyCompany'
 
         service = Service()
-        service.send_critical_alert(log_data, company_name)
+        service.alerts = service.alert_coalescer.dispatcher = MagicMock()
+        await service.send_critical_alert(log_data, company_name)
+        self.addCleanup(service.alert_coalescer.flush)
 
         mock_nosql_instance.get_company.assert_called_once_with(company_name)
-        calls = [
-            unittest.mock.call(
-                subject='Critical Alert - Severe Error Detected.',
-                addressee='a@example.com',
-                content_text=log_data,
-            ),
-            unittest.mock.call(
-                subject='Critical Alert - Severe Error Detected.',
-                addressee='b@example.com',
-                content_text=log_data,
-            ),
-        ]
-        mock_send_email.assert_has_calls(calls, any_order=True)
+        service.alerts.submit.assert_called_once_with(
+            subject='Critical Alert - Severe Error Detected.',
+            recipients=['a@example.com', 'b@example.com'],
+            content=log_data,
+        )
+        mock_send_email.assert_not_called()
+
+    @patch('services.AsyncNosql', autospec=True)
+    async def test_get_company_served_from_cache_until_registration(self, mock_nosql):
+        mock_nosql_instance = mock_nosql.return_value
+        mock_nosql_instance.get_company.return_value = {'company_id': '12345', 'company_name': 'MyCompany'}
+
+        service = Service()
+        for _ in range(3):
+            company = await service.get_company('MyCompany')
+
+        self.assertEqual(company['company_id'], '12345')
+        mock_nosql_instance.get_company.assert_called_once_with('MyCompany')
 
+        with patch('services.Service.validate_public_key'):
+            await service.register_company(SimpleNamespace(company_public_key='pem', company_name='MyCompany',
+                                                           alert_emails=[]))
+        await service.get_company('MyCompany')
+
+        self.assertEqual(mock_nosql_instance.get_company.call_count, 2)
+
+    @patch('services.Service.get_company')
     @patch('services.Service.send_critical_alert')
-    @patch('services.Nosql.store_log_in_db')
-    def test_process_logs_error_level(self, mock_send_critical_alert, mock_store_log_in_db):
+    @patch('services.AsyncNosql.store_log_in_db')
+    async def test_process_logs_error_level(self, mock_send_critical_alert, mock_store_log_in_db, mock_get_company):
         log_data = {'timestamp': '2024-05-30T12:34:56Z',
                     'host': 'server-01',
                     'service': 'backend',
@@ -308,15 +442,21 @@ class TestServices(unittest.TestCase):
 
         company_name = 'MyCompany'
 
-        result = self.service.process_log(log_data, company_name)
+        company = {'company_id': '12345', 'company_name': company_name, 'alert_emails': ['a@example.com']}
+        mock_get_company.return_value = company
 
-        mock_store_log_in_db.assert_called_once_with(log_data, company_name)
-        mock_send_critical_alert.assert_called_once_with(log_data, company_name)
+        result = await self.service.process_log(log_data, company_name)
+
+        mock_get_company.assert_called_once_with(company_name)
+        mock_store_log_in_db.assert_called_once_with(log_data, company_name, company)
+        mock_send_critical_alert.assert_called_once_with(log_data, company_name, company)
         self.assertEqual(result, {'message': 'Log stored and support alert sent.'})
 
-    @patch('services.Nosql.store_log_in_db')
+    @patch('services.Service.get_company')
+    @patch('services.AsyncNosql.store_log_in_db')
     @patch('services.Service.send_critical_alert')
-    def test_process_logs_non_error_level(self, mock_send_critical_alert, mock_store_log_in_db):
+    async def test_process_logs_non_error_level(self, mock_send_critical_alert, mock_store_log_in_db,
+                                                mock_get_company):
         log_data = {'timestamp': '2024-05-30T12:34:56Z',
                     'host': 'server-01',
                     'service': 'backend',
@@ -328,14 +468,35 @@ class TestServices(unittest.TestCase):
 
         company_name = 'MyCompany'
 
-        result = self.service.process_log(log_data, company_name)
+        company = {'company_id': '12345', 'company_name': company_name}
+        mock_get_company.return_value = company
+
+        result = await self.service.process_log(log_data, company_name)
 
-        mock_store_log_in_db.assert_called_once_with(log_data, company_name)
+        mock_store_log_in_db.assert_called_once_with(log_data, company_name, company)
         mock_send_critical_alert.assert_not_called()
         self.assertEqual(result, {'message': 'Log stored successfully.'})
 
-    @patch('services.Nosql.search_log_in_db')
-    def test_consult_filtered_logs_builds_query_correctly(self, mock_search_log_in_db):
+    @patch('services.Service.get_company')
+    @patch('services.Service.send_critical_alert')
+    @patch('services.AsyncNosql.store_logs_in_db')
+    async def test_process_logs_batch_alerts_only_stored_error_logs(self, mock_store_logs_in_db, mock_send_critical_alert,
+                                                                    mock_get_company):
+        logs = [{'level': 'ERROR', 'message': 'stored'},
+                {'level': 'INFO', 'message': 'info'},
+                {'level': 'ERROR', 'message': 'rejected'}]
+        mock_store_logs_in_db.return_value = {2: 'write error'}
+        company = {'company_id': '12345', 'company_name': 'MyCompany'}
+        mock_get_company.return_value = company
+
+        result = await self.service.process_logs_batch(logs, 'MyCompany')
+
+        mock_store_logs_in_db.assert_called_once_with(logs, 'MyCompany', company)
+        mock_send_critical_alert.assert_called_once_with(logs[0], 'MyCompany', company)
+        self.assertEqual(result, {2: 'write error'})
+
+    @patch('services.AsyncNosql.search_log_in_db')
+    async def test_consult_filtered_logs_builds_query_correctly(self, mock_search_log_in_db):
         data = {
             'company_id': '12345',
             'level': 'ERROR',
@@ -348,7 +509,7 @@ class TestServices(unittest.TestCase):
         mock_search_log_in_db.return_value = [{'company_id': '12345', 'company_name': 'MyCompany'},
                                               {'company_id': '12345', 'company_name': 'AnotherCompany'}]
 
-        result = self.service.consult_filtered_logs(data)
+        result = await self.service.consult_filtered_logs(data)
 
         args, kwargs = mock_search_log_in_db.call_args
         query_used = args[0]
@@ -360,11 +521,12 @@ class TestServices(unittest.TestCase):
         assert query_used['received_at']['$gte'] == datetime(2024, 5, 1 ,0, 0, tzinfo=timezone.utc)
         assert query_used['received_at']['$lte'] == datetime(2024, 5, 30, 23, 59, 59, tzinfo=timezone.utc)
 
-        self.assertEqual(result, [{'company_id': '12345', 'company_name': 'MyCompany'},
-                                              {'company_id': '12345', 'company_name': 'AnotherCompany'}])
+        self.assertEqual(result, {'logs': [{'company_id': '12345', 'company_name': 'MyCompany'},
+                                           {'company_id': '12345', 'company_name': 'AnotherCompany'}],
+                                  'next_cursor': None})
 
-    @patch('services.Nosql.search_log_in_db')
-    def test_consult_filtered_logs_builds_partial_query(self, mock_search_log_in_db):
+    @patch('services.AsyncNosql.search_log_in_db')
+    async def test_consult_filtered_logs_builds_partial_query(self, mock_search_log_in_db):
         data = {
             'company_id': '12345',
             'level': 'ERROR',
@@ -379,15 +541,268 @@ class TestServices(unittest.TestCase):
         mock_search_log_in_db.return_value = [{'company_id': '12345', 'company_name': 'MyCompany'},
                                               {'company_id': '12345', 'company_name': 'AnotherCompany'}]
 
-        result = self.service.consult_filtered_logs(data)
+        result = await self.service.consult_filtered_logs(data)
+
+        mock_search_log_in_db.assert_called_once_with(expected_query, limit=101)
+        self.assertEqual(result, {'logs': [{'company_id': '12345', 'company_name': 'MyCompany'},
+                                           {'company_id': '12345', 'company_name': 'AnotherCompany'}],
+                                  'next_cursor': None})
+
+    @patch('services.AsyncNosql.search_log_in_db')
+    async def test_consult_filtered_logs_returns_next_cursor_when_more_results(self, mock_search_log_in_db):
+        positions = [{'_id': ObjectId(), 'received_at': datetime(2024, 5, 1, 12, 0, i)} for i in (2, 1)]
+        docs = [{'message': '3'}, {'message': '2', 'position': positions[0]},
+                {'message': '1', 'position': positions[1]}]
+        mock_search_log_in_db.return_value = docs
+
+        result = await self.service.consult_filtered_logs({'company_id': '12345', 'page_size': 2})
+
+        mock_search_log_in_db.assert_called_once_with({'company_id': '12345'}, limit=3)
+        self.assertEqual(result['logs'], [{'message': '3'}, {'message': '2'}])
+        self.assertEqual(self.service.decode_cursor(result['next_cursor']),
+                         (positions[0]['received_at'], positions[0]['_id']))
+
+    @patch('services.AsyncNosql.search_log_in_db')
+    async def test_consult_filtered_logs_continues_after_cursor(self, mock_search_log_in_db):
+        last_id = ObjectId()
+        received_at = datetime(2024, 5, 1, 12, 0, 0)
+        cursor = self.service.encode_cursor({'_id': last_id, 'received_at': received_at})
+        mock_search_log_in_db.return_value = []
+
+        result = await self.service.consult_filtered_logs({'company_id': '12345', 'cursor': cursor})
+
+        query_used = mock_search_log_in_db.call_args.args[0]
+        self.assertEqual(query_used, {'$and': [{'company_id': '12345'},
+                                               {'$or': [{'received_at': {'$lt': received_at}},
+                                                        {'received_at': received_at, '_id': {'$lt': last_id}}]}]})
+        self.assertEqual(result, {'logs': [], 'next_cursor': None})
+
+    @patch('services.AsyncNosql.search_log_in_db')
+    async def test_consult_filtered_logs_continues_in_archive(self, mock_search_log_in_db):
+        hot = {'message': 'hot', 'position': {'_id': ObjectId(), 'received_at': datetime(2024, 5, 20)}}
+        hot_position = hot['position']
+        archived = [{'message': 'old'}] + [{'message': 'old', 'position': {'_id': ObjectId(),
+                                                                           'received_at': datetime(2024, 5, 2, i)}}
+                                           for i in (1, 0)]
+        archived_position = archived[1]['position']
+        mock_search_log_in_db.return_value = [hot]
+        archive = self.service.archive = MagicMock()
+        archive.search.return_value = archived
+        data = {'company_id': '12345', 'level': 'ERROR', 'page_size': 3,
+                'start_date': '2024-05-01T00:00:00Z', 'end_date': '2024-05-30T00:00:00Z'}
+
+        try:
+            result = await self.service.consult_filtered_logs(data)
+        finally:
+            self.service.archive = None
+
+        archive.search.assert_called_once_with('12345', {'company_id': '12345', 'log.level': 'ERROR'},
+                                               datetime(2024, 5, 1), datetime(2024, 5, 30),
+                                               before=(hot_position['received_at'], hot_position['_id']), limit=3)
+        self.assertEqual(result['logs'], [{'message': 'hot'}, {'message': 'old'}, {'message': 'old'}])
+        self.assertEqual(self.service.decode_cursor(result['next_cursor']),
+                         (archived_position['received_at'], archived_position['_id']))
+
+    def test_build_log_query_text_search_with_window(self):
+        query = self.service.build_log_query({'company_id': '12345', 'text': ' timeout ', 'text_window_hours': 6})
+
+        self.assertEqual(query['$text'], {'$search': 'timeout'})
+        since = query['$and'][0]['received_at']['$gte']
+        self.assertAlmostEqual((datetime.now() - since).total_seconds(), 6 * 3600, delta=5)
+
+    def test_build_log_query_text_search_requires_company(self):
+        with self.assertRaises(HTTPException) as cm:
+            self.service.build_log_query({'level': 'ERROR', 'text': 'timeout'})
+
+        self.assertEqual(cm.exception.status_code, 400)
+
+    def test_build_log_query_text_search_is_rejected_in_timeseries_mode(self):
+        with patch.object(self.service, 'settings', replace(self.service.settings, log_storage_mode='timeseries')):
+            with self.assertRaises(HTTPException) as cm:
+                self.service.build_log_query({'company_id': '12345', 'text': 'timeout'})
+
+        self.assertEqual(cm.exception.status_code, 400)
+        self.assertEqual(cm.exception.detail, 'Text search is not available in time-series mode.')
+
+    @patch('services.AsyncNosql.search_ranked_logs_in_db')
+    async def test_consult_filtered_logs_ranks_text_searches(self, mock_search_ranked_logs_in_db):
+        docs = [{'message': str(i), 'position': {'_id': ObjectId(), 'received_at': datetime(2024, 5, 1, 12),
+                                                 'score': 2.5 - i}} for i in range(3)]
+        position = docs[1]['position']
+        mock_search_ranked_logs_in_db.return_value = docs
+
+        result = await self.service.consult_filtered_logs({'company_id': '12345', 'text': 'timeout',
+                                                           'page_size': 2})
+        cursor = self.service.decode_cursor(result['next_cursor'])
+        self.assertEqual(cursor, (position['received_at'], position['_id'], 1.5))
+
+        mock_search_ranked_logs_in_db.return_value = []
+        await self.service.consult_filtered_logs({'company_id': '12345', 'text': 'timeout',
+                                                  'cursor': result['next_cursor']})
+
+        after = mock_search_ranked_logs_in_db.call_args.kwargs['after']
+        self.assertEqual(after['$or'][0], {'score': {'$lt': 1.5}})
+        self.assertEqual(after['$or'][2], {'score': 1.5, 'received_at': position['received_at'],
+                                           '_id': {'$lt': position['_id']}})
+
+    @patch('services.AsyncNosql.search_log_in_db')
+    async def test_consult_filtered_logs_caches_past_ranges(self, mock_search_log_in_db):
+        mock_search_log_in_db.return_value = [{'company_id': '12345', 'message': 'ok'}]
+        data = {'company_id': '12345', 'tags': ['b', 'a'],
+                'start_date': '2024-05-01T00:00:00Z', 'end_date': '2024-05-02T00:00:00Z'}
+
+        first = await self.service.consult_filtered_logs(data)
+        self.service.logs_changed('12345')
+        second = await self.service.consult_filtered_logs({**data, 'company_id': ' 12345', 'tags': ['a', 'b']})
+
+        mock_search_log_in_db.assert_called_once()
+        self.assertEqual(first, second)
+
+    @patch('services.AsyncNosql.search_log_in_db')
+    async def test_consult_filtered_logs_live_ranges_follow_ingest(self, mock_search_log_in_db):
+        mock_search_log_in_db.return_value = []
+        data = {'company_id': '12345', 'level': 'ERROR'}
+
+        await self.service.consult_filtered_logs(data)
+        await self.service.consult_filtered_logs(data)
+        self.assertEqual(mock_search_log_in_db.call_count, 1)
+
+        self.service.logs_changed('12345')
+        await self.service.consult_filtered_logs(data)
+        self.assertEqual(mock_search_log_in_db.call_count, 2)
+
+    def test_search_cache_key_ignores_other_companies_ingest(self):
+        data = {'company_id': 'A', 'level': 'ERROR'}
+        key_a, _ = self.service.search_cache_key(data, 100)
+        key_all, _ = self.service.search_cache_key({'level': 'ERROR'}, 100)
+
+        self.service.logs_changed('B')
+
+        self.assertEqual(self.service.search_cache_key(data, 100)[0], key_a)
+        self.assertNotEqual(self.service.search_cache_key({'level': 'ERROR'}, 100)[0], key_all)
+
+        self.service.logs_changed('A')
+        self.assertNotEqual(self.service.search_cache_key(data, 100)[0], key_a)
+
+    def test_search_cache_key_text_window_makes_past_ranges_live(self):
+        data = {'company_id': 'A', 'text': 'timeout',
+                'start_date': '2024-05-01T00:00:00Z', 'end_date': '2024-05-02T00:00:00Z'}
+
+        self.assertTrue(self.service.search_cache_key(data, 100)[1])
+        self.assertFalse(self.service.search_cache_key({**data, 'text_window_hours': 6}, 100)[1])
+        with patch.object(self.service, 'settings', replace(self.service.settings, text_search_window_hours=24)):
+            key, immutable = self.service.search_cache_key(data, 100)
+            self.assertFalse(immutable)
+            self.assertIn('"text_window_hours": 24', key[0])
+            # Without text no window applies
+            self.assertTrue(self.service.search_cache_key({**data, 'text': None}, 100)[1])
+
+    async def test_consult_filtered_logs_invalid_cursor(self):
+        with self.assertRaises(HTTPException) as cm:
+            await self.service.consult_filtered_logs({'company_id': '12345', 'cursor': 'not-a-cursor'})
+
+        self.assertEqual(cm.exception.status_code, 400)
+
+    @patch('services.AsyncNosql.count_logs_in_db')
+    async def test_analyze_logs_counts_per_bucket(self, mock_count_logs_in_db):
+        mock_count_logs_in_db.return_value = {'time': [], 'level': [], 'count': []}
+
+        result = await self.service.analyze_logs({'company_id': '12345', 'group_by': ['level', 'level'],
+                                                  'bucket': 'hour', 'bucket_size': 2})
+
+        mock_count_logs_in_db.assert_called_once_with({'company_id': '12345'}, ['level'], 'hour', 2, limit=10001)
+        self.assertEqual(result, {'bucket': 'hour', 'bucket_size': 2, 'group_by': ['level'],
+                                  'columns': {'time': [], 'level': [], 'count': []}})
+
+    @patch('services.AsyncNosql.rollups_cover', return_value=True)
+    @patch('services.AsyncNosql.count_logs_in_db')
+    @patch('services.AsyncNosql.count_rollups_in_db')
+    async def test_analyze_logs_reads_rollups_for_long_ranges(self, mock_count_rollups_in_db,
+                                                               mock_count_logs_in_db, mock_rollups_cover):
+        mock_count_rollups_in_db.return_value = {'time': [], 'count': []}
+        self.service.nosql.rollups = MagicMock()
+        data = {'company_id': '12345', 'level': 'ERROR', 'group_by': ['service'], 'bucket': 'day',
+                'start_date': '2024-05-01T00:00:00Z', 'end_date': '2024-05-31T00:00:00Z'}
+
+        try:
+            await self.service.analyze_logs(data)
+            await self.service.analyze_logs({**data, 'tags': ['db']})
+        finally:
+            self.service.nosql.rollups = None
+
+        mock_count_rollups_in_db.assert_called_once_with('12345', datetime(2024, 5, 1), datetime(2024, 5, 31),
+                                                         level='ERROR', group_by=['service'], unit='day',
+                                                         bin_size=1, limit=10001)
+        mock_count_logs_in_db.assert_called_once()
+
+    @patch('services.AsyncNosql.rollups_cover', return_value=False)
+    @patch('services.AsyncNosql.count_logs_in_db')
+    @patch('services.AsyncNosql.count_rollups_in_db')
+    async def test_analyze_logs_counts_logs_before_the_rollups_start(self, mock_count_rollups_in_db,
+                                                                      mock_count_logs_in_db, mock_rollups_cover):
+        mock_count_logs_in_db.return_value = {'time': [], 'count': []}
+        self.service.nosql.rollups = MagicMock()
+
+        try:
+            await self.service.analyze_logs({'company_id': '12345', 'bucket': 'day',
+                                             'start_date': '2024-05-01T00:00:00Z', 'end_date': '2024-05-31T00:00:00Z'})
+        finally:
+            self.service.nosql.rollups = None
+
+        mock_rollups_cover.assert_awaited_once_with(datetime(2024, 5, 1))
+        mock_count_rollups_in_db.assert_not_called()
+        mock_count_logs_in_db.assert_called_once()
+
+    @patch('services.AsyncNosql.count_logs_in_db')
+    async def test_analyze_logs_rejects_more_groups_than_the_limit(self, mock_count_logs_in_db):
+        mock_count_logs_in_db.return_value = {'time': [1, 2, 3], 'count': [5, 5, 5]}
+
+        with patch.object(self.service, 'settings', replace(self.service.settings, analytics_max_groups=2)):
+            with self.assertRaises(HTTPException) as cm:
+                await self.service.analyze_logs({'company_id': '12345', 'bucket': 'minute'})
+
+        self.assertEqual(cm.exception.status_code, 400)
+        self.assertIn('larger bucket', cm.exception.detail)
+        self.assertEqual(mock_count_logs_in_db.call_args.kwargs['limit'], 3)
+
+    async def test_analyze_logs_requires_company_id(self):
+        with self.assertRaises(HTTPException) as cm:
+            await self.service.analyze_logs({'level': 'ERROR'})
+
+        self.assertEqual(cm.exception.status_code, 400)
+
+    async def test_export_filtered_logs_streams_ndjson(self):
+        docs = [{'company_id': '12345', 'company_name': 'MyCompany', 'message': str(i)} for i in range(3)]
+
+        async def iter_logs(query, batch_size):
+            self.assertEqual(query, {'company_id': '12345'})
+            for doc in docs:
+                yield doc
+
+        with patch.object(self.service.nosql, 'iter_logs_in_db', iter_logs):
+            chunks = [chunk async for chunk in self.service.export_filtered_logs({'company_id': '12345'})]
+
+        lines = b''.join(chunks).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['message'] for line in lines], ['0', '1', '2'])
+        self.assertEqual(json.loads(lines[0])['company_name'], 'MyCompany')
+
+    async def test_export_filtered_logs_gzip(self):
+        async def iter_logs(query, batch_size):
+            yield {'company_id': '12345', 'company_name': 'MyCompany', 'message': 'hola'}
+
+        with patch.object(self.service.nosql, 'iter_logs_in_db', iter_logs):
+            chunks = [chunk async for chunk in self.service.export_filtered_logs({'company_id': '12345'},
+                                                                                 compress=True)]
+
+        self.assertEqual(json.loads(gzip.decompress(b''.join(chunks)))['message'], 'hola')
 
-        mock_search_log_in_db.assert_called_once_with(expected_query)
-        self.assertEqual(result, [{'company_id': '12345', 'company_name': 'MyCompany'},
-                                              {'company_id': '12345', 'company_name': 'AnotherCompany'}])
+    def test_export_filtered_logs_requires_filters(self):
+        with self.assertRaises(ValueError):
+            self.service.export_filtered_logs({})
 
-    @patch('services.Nosql.search_log_in_db')
-    def test_consult_filtered_logs_with_no_filters_returns_all(self, _):
+    @patch('services.AsyncNosql.search_log_in_db')
+    async def test_consult_filtered_logs_with_no_filters_returns_all(self, _):
         with self.assertRaises(ValueError) as context:
-            self.service.consult_filtered_logs({})
+            await self.service.consult_filtered_logs({})
 
         self.assertIn('No filters provided for log search', str(context.exception))
@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from start import available_cpus, cgroup_cpu_limit, serve, server_options
+
+
+def write(root, name, content):
+    path = os.path.join(root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class TestCgroupCpuLimit(unittest.TestCase):
+
+    def test_cgroup_v2_quota(self):
+        with tempfile.TemporaryDirectory() as root:
+            write(root, 'cpu.max', '150000 100000\n')
+
+            self.assertEqual(cgroup_cpu_limit(root), 1.5)
+
+    def test_cgroup_v2_without_quota(self):
+        with tempfile.TemporaryDirectory() as root:
+            write(root, 'cpu.max', 'max 100000\n')
+
+            self.assertIsNone(cgroup_cpu_limit(root))
+
+    def test_cgroup_v1_quota(self):
+        with tempfile.TemporaryDirectory() as root:
+            write(root, 'cpu/cpu.cfs_quota_us', '200000\n')
+            write(root, 'cpu/cpu.cfs_period_us', '100000\n')
+
+            self.assertEqual(cgroup_cpu_limit(root), 2)
+
+            write(root, 'cpu/cpu.cfs_quota_us', '-1\n')
+            self.assertIsNone(cgroup_cpu_limit(root))
+
+    def test_no_cgroup_files(self):
+        with tempfile.TemporaryDirectory() as root:
+            self.assertIsNone(cgroup_cpu_limit(root))
+
+
+class TestServerOptions(unittest.TestCase):
+
+    @patch('start.cgroup_cpu_limit', return_value=1.5)
+    @patch('start.os.sched_getaffinity', return_value=set(range(8)), create=True)
+    def test_workers_follow_the_cpu_quota(self, _affinity, _limit):
+        self.assertEqual(available_cpus(), 2)
+
+    @patch('start.cgroup_cpu_limit', return_value=None)
+    @patch('start.os.sched_getaffinity', return_value={0, 1, 2}, create=True)
+    def test_workers_follow_the_affinity_mask(self, _affinity, _limit):
+        self.assertEqual(available_cpus(), 3)
+
+    @patch.dict('os.environ', {'WORKERS': '4', 'WORKER_MAX_REQUESTS': '10000', 'PORT': '9000'})
+    def test_options_from_config(self):
+        options = server_options()
+
+        self.assertEqual(options['workers'], 4)
+        self.assertEqual(options['limit_max_requests'], 10000)
+        self.assertEqual(options['port'], 9000)
+        self.assertIn(options['loop'], ('uvloop', 'asyncio'))
+
+    @patch.dict('os.environ', {'WORKERS': '0', 'WORKER_MAX_REQUESTS': '0'})
+    @patch('start.available_cpus', return_value=6)
+    def test_defaults(self, _cpus):
+        options = server_options()
+
+        self.assertEqual(options['workers'], 6)
+        self.assertIsNone(options['limit_max_requests'])
+
+
+class TestServe(unittest.TestCase):
+
+    @patch('start.uvicorn.run')
+    @patch('start.uvicorn.Config.bind_socket')
+    @patch('start.Multiprocess')
+    def test_single_recycled_worker_runs_under_the_supervisor(self, mock_multiprocess, _bind, mock_run):
+        with patch.dict('os.environ', {'WORKERS': '1', 'WORKER_MAX_REQUESTS': '10000'}):
+            serve('main:app', server_options())
+
+        mock_run.assert_not_called()
+        server_config = mock_multiprocess.call_args.args[0]
+        self.assertEqual(server_config.workers, 1)
+        self.assertEqual(server_config.limit_max_requests, 10000)
+        mock_multiprocess.return_value.run.assert_called_once()
+
+    @patch('start.uvicorn.run')
+    @patch('start.Multiprocess')
+    def test_other_cases_use_uvicorn_run(self, mock_multiprocess, mock_run):
+        for workers, max_requests in (('1', '0'), ('4', '10000')):
+            with patch.dict('os.environ', {'WORKERS': workers, 'WORKER_MAX_REQUESTS': max_requests}):
+                serve('main:app', server_options())
+
+        self.assertEqual(mock_run.call_count, 2)
+        mock_multiprocess.assert_not_called()
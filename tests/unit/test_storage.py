@@ -0,0 +1,68 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from bson import ObjectId
+from storage import ensure_log_collection, migrate_to_timeseries
+
+
+class TestEnsureLogCollection(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.db = MagicMock()
+        self.db.create_collection = AsyncMock()
+        self.listing = MagicMock()
+        self.db.list_collections = AsyncMock(return_value=self.listing)
+
+    async def test_plain_mode_does_nothing(self):
+        self.assertIsNone(await ensure_log_collection(self.db, 'logs'))
+        self.db.list_collections.assert_not_called()
+
+    @patch('storage.storage_mode', return_value='timeseries')
+    async def test_creates_timeseries_collection_when_missing(self, _):
+        self.listing.to_list = AsyncMock(return_value=[])
+
+        result = await ensure_log_collection(self.db, 'logs')
+
+        self.assertEqual(result, 'created')
+        options = self.db.create_collection.call_args.kwargs['timeseries']
+        self.assertEqual((options['timeField'], options['metaField']), ('received_at', 'company_id'))
+
+    @patch('storage.storage_mode', return_value='timeseries')
+    async def test_existing_plain_collection_is_left_untouched(self, _):
+        self.listing.to_list = AsyncMock(return_value=[{'name': 'logs', 'type': 'collection'}])
+
+        result = await ensure_log_collection(self.db, 'logs')
+
+        self.assertEqual(result, 'plain')
+        self.db.create_collection.assert_not_called()
+
+
+class TestMigrateToTimeseries(unittest.TestCase):
+
+    def setUp(self):
+        self.source = MagicMock()
+        self.target = MagicMock()
+        self.db = MagicMock()
+        self.db.__getitem__.side_effect = lambda name: {'logs': self.source, 'logs_ts': self.target}[name]
+        self.db.list_collection_names.return_value = []
+        self.documents = [{'_id': ObjectId(), 'company_id': '12345'} for _ in range(5)]
+
+    def test_copies_in_batches_and_creates_target(self):
+        self.source.find.return_value.sort.return_value.batch_size.return_value = iter(self.documents)
+
+        copied, last_id = migrate_to_timeseries(self.db, 'logs', 'logs_ts', batch_size=2)
+
+        self.db.create_collection.assert_called_once()
+        self.assertEqual([len(call.args[0]) for call in self.target.insert_many.call_args_list], [2, 2, 1])
+        self.assertEqual((copied, last_id), (5, self.documents[-1]['_id']))
+
+    def test_resumes_after_given_id(self):
+        self.db.list_collection_names.return_value = ['logs_ts']
+        self.source.find.return_value.sort.return_value.batch_size.return_value = iter([])
+        after = ObjectId()
+
+        copied, last_id = migrate_to_timeseries(self.db, 'logs', 'logs_ts', after=after)
+
+        self.source.find.assert_called_once_with({'_id': {'$gt': after}})
+        self.db.create_collection.assert_not_called()
+        self.assertEqual((copied, last_id), (0, after))